@@ -0,0 +1,68 @@
+'''Startup time of the vamtb command line
+
+    python bench/startup.py [runs]
+
+Each command runs in a new interpreter from an empty directory (vars.db and vamtb.yml get created there).
+Prints best and median wall time per command, then the slowest modules imported by vamtb.vamtb.
+'''
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+CLI = "import vamtb.vamtb as v; v.cli()"
+# Budget for commands only touching sqlite
+BUDGET_MS = 200
+
+def run(args, cwd, env, importtime = False):
+    cmd = [ sys.executable ] + ([ "-X", "importtime" ] if importtime else []) + [ "-c", CLI ] + args
+    start = time.perf_counter()
+    res = subprocess.run(cmd, cwd=cwd, env=env, capture_output=True, text=True, input="")
+    return (time.perf_counter() - start) * 1000, res
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    with tempfile.TemporaryDirectory(prefix="vamtb_bench_") as cwd:
+        addondir = Path(cwd, "AddonPackages")
+        addondir.mkdir()
+        commands = {
+            "--help": [ "--help" ],
+            "dep": [ "-d", str(addondir), "-f", "A.B.1", "dep" ],
+            "latest": [ "-d", str(addondir), "-f", "A.B.latest", "latest" ],
+        }
+        # Create database and compile bytecode once
+        run(commands["dep"], cwd, env)
+        over = False
+        for name, args in commands.items():
+            timings = sorted(run(args, cwd, env)[0] for _ in range(runs))
+            median = statistics.median(timings)
+            over |= median > BUDGET_MS
+            print(f"{name:<10} best {timings[0]:6.0f}ms  median {median:6.0f}ms")
+
+        _, res = run(commands["--help"], cwd, env, importtime=True)
+        imports = []
+        children = []
+        for line in res.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                _, cumulative, module = line.split("|")
+                if not cumulative.strip().isdigit():
+                    continue
+                # Imports are listed after the imports they trigger, nested ones being indented by 2 spaces
+                if not module.startswith("  "):
+                    if module.strip() == "vamtb.vamtb":
+                        imports = children
+                    children = []
+                elif not module.startswith("     "):
+                    children.append((int(cumulative), module.strip()))
+        print("\nSlowest imports of vamtb.vamtb:")
+        for cumulative, module in sorted(imports, reverse=True)[:10]:
+            print(f"{cumulative/1000:8.1f}ms {module}")
+    return 1 if over else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,12 +15,18 @@ setup(
         'vamtb',
         'vamtb.config',
         'vamtb.db',
+        'vamtb.depgraph',
+        'vamtb.dup',
         'vamtb.file',
         'vamtb.graph',
         'vamtb.hub',
+        'vamtb.ia',
+        'vamtb.image',
         'vamtb.log',
         'vamtb.meta',
         'vamtb.profile',
+        'vamtb.scan',
+        'vamtb.serve',
         'vamtb.utils',
         'vamtb.vamex',
         'vamtb.var',
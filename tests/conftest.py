@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# vamtb opens log-vamtb.txt in the current directory when imported,
+# its other files (vars.db, dirindex.json, caches) are next to the script being run
+workdir = tempfile.mkdtemp(prefix="vamtb_tests_")
+os.chdir(workdir)
+argv0, sys.argv[0] = sys.argv[0], os.path.join(workdir, "vamtb.py")
+from vamtb.db import Dbs
+sys.argv[0] = argv0
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    """ Each test gets an empty database in its own directory """
+    monkeypatch.chdir(tmp_path)
+    Dbs._Dbs__instance = None
+    Dbs._Dbs__conn = None
+    Dbs._Dbs__pending = 0
+    Dbs._Dbs__versions = None
+    Dbs._Dbs__data_version = None
+    Dbs(str(tmp_path / "vars.db"))
+    yield Dbs
+    Dbs.getConn().close()
+    Dbs._Dbs__instance = None
+    Dbs._Dbs__conn = None
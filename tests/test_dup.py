@@ -0,0 +1,26 @@
+import pytest
+
+from vamtb.db import Dbs
+from vamtb.dup import DupMgr
+
+@pytest.fixture
+def files():
+    """ A.Look.1 shares a texture with B.Look.1, C.Look.1 and D.Look.1 share another one """
+    rows = [
+        ("Custom/a.vap", "A.Look.1", 100, "0000000A"),
+        ("Custom/skin.jpg", "A.Look.1", 5000, "00000001"),
+        ("Custom/skin.jpg", "B.Look.1", 5000, "00000001"),
+        ("Custom/b.vap", "B.Look.1", 100, "0000000B"),
+        ("Custom/hair.jpg", "C.Look.1", 6000, "00000002"),
+        ("Custom/hair.jpg", "D.Look.1", 6000, "00000002"),
+    ]
+    Dbs.executemany("INSERT INTO FILES(FILENAME, ISREF, VARNAME, SIZE, CKSUM) VALUES (?, 'NO', ?, ?, ?)", [ (f, v, s, c) for f, v, s, c in rows ])
+    Dbs.commit()
+
+@pytest.mark.parametrize("varnames", [ None, [ "A.Look.1" ], [ "A.Look.1", "B.Look.1", "E.Look.1" ] ])
+def test_dupinfo_of_given_vars(files, varnames):
+    dupmgr = DupMgr(varnames=varnames)
+    assert dupmgr.dupinfo("A.Look.1") == { "numdupfiles": 1, "dupsize": 5000 }
+    assert dupmgr.numfiles("A.Look.1") == 2
+    # Only groups holding a file of the given vars are loaded
+    assert len(dupmgr._DupMgr__clusters) == (2 if varnames is None else 1)
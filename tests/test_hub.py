@@ -0,0 +1,175 @@
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from vamtb.hub import HubMgr, PageCache
+
+class Response:
+    """ Streamed download, waits for go before sending its second chunk """
+    def __init__(self, content, go = None):
+        self.status_code = 200
+        self.headers = { 'content-length': str(len(content)) }
+        self.__content = content
+        self.__go = go
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        yield self.__content[:10]
+        if self.__go:
+            self.__go.wait(5)
+        yield self.__content[10:]
+
+    def close(self):
+        self.closed = True
+
+def test_same_file_written_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    hub = HubMgr(jobs=2)
+    content = b"A.B.1 var content" * 100
+    go = threading.Event()
+    first = Response(content, go)
+    crcs = []
+    worker = threading.Thread(target=lambda: crcs.append(hub.write_var("A.B.1.var", first, "http://hub/1")))
+    worker.start()
+    for _ in range(500):
+        if (tmp_path / "A.B.1.var.part").exists():
+            break
+        time.sleep(0.01)
+    # Another resource giving the same file while it is written
+    second = Response(b"other content" * 100)
+    assert hub.write_var("A.B.1.var", second, "http://hub/2") is None
+    assert second.closed
+    go.set()
+    worker.join()
+    assert crcs == [ "%08X" % zlib.crc32(content) ]
+    assert (tmp_path / "A.B.1.var").read_bytes() == content
+    assert not (tmp_path / "A.B.1.var.part").exists()
+
+@pytest.fixture
+def hub_site():
+    """ Hub where the listing of author old.1 moved to new.1, with one resource """
+    requests = []
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def send(self, code, body = b"", headers = {}):
+            requests.append(self.path)
+            self.send_response(code)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def do_GET(self):
+            if self.path.startswith("/resources/authors/old.1/"):
+                return self.send(301, headers={ "Location": self.path.replace("old.1", "new.1") })
+            if self.path == "/resources/authors/new.1/?page=1":
+                return self.send(200, b'<a href="/resources/dress.1/">Dress</a>', { "ETag": '"p1"' })
+            if self.path.startswith("/resources/authors/new.1/"):
+                return self.send(303, headers={ "Location": "/" })
+            if self.path == "/resources/dress.1/":
+                return self.send(200, b'<a href="resources/dress.1/download">Download</a>')
+            if self.path == "/resources/dress.1/download":
+                return self.send(200, b"var", { "content-disposition": 'attachment; filename="A.Dress.1.var";' })
+            self.send(404)
+        def log_message(self, format, *args):
+            pass
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", requests
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.mark.parametrize("cached", [ False, True ])
+def test_redirected_author(tmp_path, monkeypatch, capsys, hub_site, cached):
+    monkeypatch.chdir(tmp_path)
+    url, requests = hub_site
+    cache = PageCache(str(tmp_path / "hubcache")) if cached else None
+    for _ in range(2):
+        requests.clear()
+        hub = HubMgr(jobs=2, rate=1000, url=url, cache=cache, dir=str(tmp_path), dryrun=True)
+        hub.get_resources_from_author("old.1", creatoruid=True)
+        assert "Plan for old.1: 1 files to download, 0 skipped" in capsys.readouterr().out
+        assert sum(1 for r in requests if "old.1" in r) == 2
+
+def test_redirect_not_cached(tmp_path, hub_site):
+    url, requests = hub_site
+    hub = HubMgr(rate=1000, url=url, cache=PageCache(str(tmp_path / "hubcache")))
+    old = f"{url}/resources/authors/old.1/?page=1"
+    assert hub.get_page(old, allow_redirects=False)['status'] == 301
+    page = hub.get_page(old)
+    assert page['status'] == 200 and "dress.1" in page['text']
+    requests.clear()
+    # Followed page is fresh in cache, the redirect is asked again
+    assert hub.get_page(old)['status'] == 200
+    assert hub.get_page(old, allow_redirects=False)['status'] == 301
+    assert requests == [ "/resources/authors/old.1/?page=1" ]
+
+def test_plan_resumes_part(tmp_path):
+    (tmp_path / "A.Dress.2.var").write_bytes(b"var")
+    (tmp_path / "A.Dress.3.var.part").write_bytes(b"va")
+    hub = HubMgr(dir=str(tmp_path))
+    assert hub.plan([ ("http://hub/2", "A.Dress.2.var"), ("http://hub/3", "A.Dress.3.var") ]) == [
+        ("http://hub/2", "A.Dress.2.var", False, "already there"),
+        ("http://hub/3", "A.Dress.3.var", True, "newer than version 2"),
+    ]
+
+@pytest.fixture
+def var_site():
+    """ Download of a var with ranges, /nolength doesn't tell the size of the whole content """
+    content = bytes(range(256)) * 40
+    requests = []
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.headers.get("Range"))
+            headers = { "ETag": '"v2"', "Accept-Ranges": "bytes", "Content-Disposition": 'attachment; filename="A.B.2.var";' }
+            body = content
+            code = 200
+            if self.headers.get("Range") and self.headers.get("If-Range") == '"v2"':
+                start = int(self.headers["Range"][6:-1])
+                if start >= len(content):
+                    code, body = 416, b""
+                else:
+                    code, body = 206, content[start:]
+                    headers["Content-Range"] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+            self.send_response(code)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            if code != 200 or self.path != "/nolength":
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args):
+            pass
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", content, requests
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.mark.parametrize("path, part, etag, ranges", [
+    # Same content: resumed
+    ("/", 1000, '"v2"', [ None, "bytes=1000-" ]),
+    # Content changed or unknown: started over
+    ("/", 1000, '"v1"', [ None ]),
+    ("/", 1000, None, [ None ]),
+    # Complete: only renamed
+    ("/", 10240, '"v2"', [ None ]),
+    ("/", 20000, '"v2"', [ None ]),
+    # Beyond the end of a content of unknown size
+    ("/nolength", 20000, '"v2"', [ None, "bytes=20000-", None ]),
+])
+def test_resume_part(tmp_path, monkeypatch, var_site, path, part, etag, ranges):
+    monkeypatch.chdir(tmp_path)
+    url, content, requests = var_site
+    (tmp_path / "A.B.2.var.part").write_bytes((content * 2)[:part])
+    if etag:
+        (tmp_path / "A.B.2.var.part.etag").write_text(etag)
+    hub = HubMgr(rate=1000, url=url)
+    assert hub.dl_file(url + path) == [ ("A.B.2.var", "%08X" % zlib.crc32(content)) ]
+    assert (tmp_path / "A.B.2.var").read_bytes() == content
+    assert not (tmp_path / "A.B.2.var.part").exists()
+    assert not (tmp_path / "A.B.2.var.part.etag").exists()
+    assert requests == ranges
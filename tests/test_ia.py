@@ -0,0 +1,154 @@
+import builtins
+import hashlib
+import json
+import zipfile
+
+import pytest
+
+from vamtb import ia
+from vamtb.db import Dbs
+from vamtb.ia import IaMgr
+from vamtb.scan import ScanMgr
+from vamtb.var import Var
+from vamtb.utils import search_files_indir
+
+class Response:
+    status_code = 200
+    content = b""
+
+class IaFile:
+    def __init__(self, md5):
+        self.md5 = md5
+
+class Item:
+    def __init__(self, session, identifier):
+        self.__session = session
+        self.identifier = identifier
+        self.tasks = []
+
+    @property
+    def exists(self):
+        return self.identifier in self.__session.items
+
+    def identifier_available(self):
+        return not self.exists
+
+    def get_file(self, key):
+        md5 = self.__session.items.get(self.identifier, {}).get(key)
+        return IaFile(md5) if md5 else None
+
+    def upload_file(self, body, key, metadata, headers, queue_derive, validate_identifier, verbose):
+        content = body.read()
+        assert hashlib.md5(content).hexdigest() == headers['Content-MD5']
+        if self.__session.failures.get(key):
+            self.__session.failures[key] -= 1
+            raise ConnectionError(f"Connection dropped while sending {key}")
+        self.__session.items.setdefault(self.identifier, {})[key] = headers['Content-MD5']
+        self.__session.uploads.append((self.identifier, key))
+        return Response()
+
+class Session:
+    """ Internet Archive endpoint, items are { identifier: { key: md5 } } """
+    def __init__(self):
+        self.items = {}
+        self.uploads = []
+        self.failures = {}
+
+    def get_item(self, identifier):
+        return Item(self, identifier)
+
+@pytest.fixture
+def addondir(tmp_path):
+    addondir = tmp_path / "AddonPackages"
+    addondir.mkdir()
+    for name, members in (
+        ("A.Look.1", { "Custom/look.vap": "{}", "Custom/look.jpg": "look" * 100 }),
+        ("B.Scene.1", { "Saves/scene/s.json": "{}", "Saves/scene/s.jpg": "scene" * 100, "old.json": "{}", "old.jpg": "old" * 100 }),
+    ):
+        creator, resource, _ = name.split(".")
+        with zipfile.ZipFile(addondir / f"{name}.var", "w") as z:
+            z.writestr("meta.json", json.dumps({ "licenseType": "CC BY", "creatorName": creator, "packageName": resource, "dependencies": {} }))
+            for member, content in members.items():
+                z.writestr(member, content)
+    ScanMgr(str(addondir), confirm=False).scan(search_files_indir(addondir, r".*\.var"))
+    return addondir
+
+def upload(addondir, session, monkeypatch, answer = "Y", **kwargs):
+    """ Upload all vars, returns number uploaded and the prompts """
+    prompts = []
+    monkeypatch.setattr(builtins, "input", lambda prompt: prompts.append(prompt) or answer)
+    def vars():
+        for varfile in search_files_indir(addondir, r".*\.var"):
+            with Var(varfile, addondir, use_db=True) as var:
+                yield var
+    return IaMgr(jobs=2, session=session, **kwargs).upload(vars()), prompts
+
+def uploaded():
+    return sorted(varname for varname, in Dbs.fetchall("SELECT VARNAME FROM UPLOAD WHERE IA='YES'", ()))
+
+def test_upload_retry(addondir, monkeypatch):
+    session = Session()
+    session.failures["A.Look.1.var"] = 1
+    n, prompts = upload(addondir, session, monkeypatch)
+    assert n == 2
+    # Retry after the thumbnail was sent doesn't ask to overwrite
+    assert prompts == []
+    assert sorted(session.uploads) == [
+        ("vam1__A.Look.1", "A.Look.1.var"), ("vam1__A.Look.1", "look.jpg"),
+        ("vam1__B.Scene.1", "00-s.jpg"), ("vam1__B.Scene.1", "B.Scene.1.var"),
+    ]
+    assert uploaded() == [ "A.Look.1", "B.Scene.1" ]
+    # md5 of vars and of the thumbnails
+    assert len(Dbs.fetchall("SELECT * FROM FILEMD5", ())) == 4
+
+def test_upload_gives_up(addondir, monkeypatch):
+    session = Session()
+    session.failures["A.Look.1.var"] = 3
+    n, _ = upload(addondir, session, monkeypatch, retries=2)
+    assert n == 1
+    assert uploaded() == [ "B.Scene.1" ]
+
+def test_existing_item_confirmed(addondir, monkeypatch):
+    session = Session()
+    upload(addondir, session, monkeypatch)
+    Dbs.execute("UPDATE UPLOAD SET IA='NO'", ())
+    Dbs.commit()
+    session.uploads.clear()
+    # md5 are taken from the database
+    monkeypatch.setattr(ia, "md5f", lambda fname: pytest.fail(f"{fname} hashed again"))
+    n, prompts = upload(addondir, session, monkeypatch, answer="Y")
+    assert sorted(prompts) == [ "Item A.Look.1 exists, update if different Y [N] ? ", "Item B.Scene.1 exists, update if different Y [N] ? " ]
+    # Same checksums, nothing sent
+    assert session.uploads == []
+    assert n == 2
+
+def test_existing_item_declined(addondir, monkeypatch):
+    session = Session()
+    session.items = { "vam1__A.Look.1": {}, "vam1__B.Scene.1": {} }
+    n, prompts = upload(addondir, session, monkeypatch, answer="N")
+    assert len(prompts) == 2
+    assert n == 0 and session.uploads == []
+    # Not asked again
+    assert uploaded() == [ "A.Look.1", "B.Scene.1" ]
+
+def test_job_not_modified(addondir, monkeypatch):
+    session = Session()
+    job = { 'identifier': "vam1__A.Look.1", 'confirm': True, 'meta_only': False, 'dry_run': True, 'scene_files': [], 'files': [] }
+    res = ia.upload_item(session, job)
+    assert res['status'] == "skipped"
+    assert job['confirm'] and not res['job']['confirm']
+
+def test_results_while_preparing(addondir, monkeypatch):
+    events = []
+    result = IaMgr.result
+    monkeypatch.setattr(IaMgr, "result", lambda self, res: events.append(f"result {res['job']['var']}") or result(self, res))
+    def vars():
+        for varfile in search_files_indir(addondir, r".*\.var"):
+            with Var(varfile, addondir, use_db=True) as var:
+                events.append(f"prepare {var.var}")
+                yield var
+        events.append("prepared")
+    assert IaMgr(jobs=1, session=Session()).upload(vars()) == 2
+    # Two jobs wait for the only worker, the first is handled before looking for more vars
+    assert events.index("result A.Look.1") < events.index("prepared")
+    assert uploaded() == [ "A.Look.1", "B.Scene.1" ]
@@ -0,0 +1,22 @@
+import io
+import zipfile
+
+from PIL import Image
+
+from vamtb.image import opt_image
+
+def test_corrupt_image_is_kept(tmp_path):
+    good = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 10, 10)).save(good, format="PNG")
+    var = tmp_path / "A.B.1.var"
+    with zipfile.ZipFile(var, "w") as z:
+        z.writestr("Custom/good.png", good.getvalue())
+        z.writestr("Custom/bad.png", b"\x89PNG\r\n\x1a\n" + b"garbage" * 100)
+
+    res = opt_image((str(var), "Custom/bad.png", 1, None))
+    assert res['data'] is None
+    assert res['newmember'] == "Custom/bad.png"
+    assert "could not be optimized" in res['msg']
+
+    res = opt_image((str(var), "Custom/good.png", 1, None))
+    assert res['data'] and res['newmember'] == "Custom/good.jpg"
@@ -0,0 +1,39 @@
+import pytest
+
+from vamtb import utils
+from vamtb.utils import json_refpairs, dep_fromjson
+
+SCENE = r'''{
+    "id": "Person",
+    "storables": [
+        { "id": "geometry", "clothing": [ { "id": "A.Dress.1:/Custom/Clothing/Female/A/Dress/dress.vam", "enabled": "true" } ] },
+        { "id": "textures", "faceDiffuseUrl": "SELF:\/Custom\/Atom\/Person\/Textures\/face.jpg" },
+        { "id": "plugin", "plugin#0": "B.Plugin.latest:/Custom/Scripts/B/plugin.cslist" },
+        { "id": "preset", "presetName": "Custom/Atom/Person/Pose/pose.vap" }
+    ]
+}'''
+
+class NoTokenizer:
+    def finditer(self, text):
+        raise AssertionError("tokenized a json without references")
+
+def test_refpairs():
+    assert dep_fromjson(None, SCENE) == {
+        'embed': [ "Custom/Atom/Person/Pose/pose.vap" ],
+        'var': [ "A.Dress.1:/Custom/Clothing/Female/A/Dress/dress.vam", "B.Plugin.latest:/Custom/Scripts/B/plugin.cslist" ],
+        'self': [ "SELF:/Custom/Atom/Person/Textures/face.jpg" ],
+    }
+
+def test_no_reference_skips_tokenizer(monkeypatch):
+    monkeypatch.setattr(utils, "C_JSON_STRPAIR", NoTokenizer())
+    text = '{ "id": "Person", "position": { "x": "0.5", "y": "1" }, "on": "true", "time": "12:30" }'
+    assert list(json_refpairs(text)) == []
+    assert dep_fromjson(None, text) == { 'embed': [], 'var': [], 'self': [] }
+
+@pytest.mark.parametrize("other", [ "", ', "url": "https://hub.virtamate.com"' ])
+def test_link_without_slash(other):
+    # Not a link VaM resolves, whatever else the file holds
+    text = '{ "id": "plugin", "plugin#0": "A.B.1:Custom/Scripts/x.cs"%s }' % other
+    assert dep_fromjson(None, text) == { 'embed': [], 'var': [], 'self': [] }
+    text = '{ "id": "plugin", "plugin#0": "A.B.1:/Custom/Scripts/x.cs"%s }' % other
+    assert dep_fromjson(None, text) == { 'embed': [], 'var': [ "A.B.1:/Custom/Scripts/x.cs" ], 'self': [] }
@@ -0,0 +1,67 @@
+import json
+import sqlite3
+import zipfile
+
+import pytest
+
+from vamtb.db import Dbs
+from vamtb.scan import ScanMgr, scan_var
+from vamtb.var import Var
+from vamtb.varfile import VarFile
+from vamtb.utils import search_files_indir
+
+def write_var(addondir, name):
+    creator, resource, _ = name.split(".")
+    with zipfile.ZipFile(addondir / f"{name}.var", "w") as z:
+        z.writestr("meta.json", json.dumps({ "licenseType": "CC BY", "creatorName": creator, "packageName": resource, "dependencies": {} }))
+        z.writestr(f"Custom/{resource}.vap", "{}")
+
+def scanned():
+    return sorted(varname for varname, in Dbs.fetchall("SELECT VARNAME FROM VARS", ()))
+
+@pytest.fixture
+def addondir(tmp_path, monkeypatch):
+    """ Vars A.Good.1 and C.Good.1, reading B.Bad.1 fails with an unexpected error """
+    addondir = tmp_path / "AddonPackages"
+    addondir.mkdir()
+    for name in ("A.Good.1", "B.Bad.1", "C.Good.1"):
+        write_var(addondir, name)
+    var_rows = Var._var_rows
+    def failing_var_rows(var):
+        if var.var == "B.Bad.1":
+            raise OSError("Input/output error")
+        return var_rows(var)
+    # Workers are forked and keep the patch
+    monkeypatch.setattr(Var, "_var_rows", failing_var_rows)
+    return addondir
+
+def test_worker_returns_error(addondir):
+    res = scan_var((str(addondir / "B.Bad.1.var"), str(addondir), False))
+    assert res['var'] == "B.Bad.1"
+    assert res['error'] == "Var B.Bad.1 could not be scanned: OSError: Input/output error"
+
+@pytest.mark.parametrize("jobs", [ 1, 2 ])
+def test_failing_var_doesnt_stop_scan(addondir, jobs):
+    stored = ScanMgr(str(addondir), jobs=jobs, confirm=False).scan(search_files_indir(addondir, r".*\.var"))
+    assert stored == 2
+    assert scanned() == [ "A.Good.1", "C.Good.1" ]
+
+def test_failing_store_doesnt_stop_scan(tmp_path, monkeypatch):
+    addondir = tmp_path / "AddonPackages"
+    addondir.mkdir()
+    for name in ("A.Good.1", "B.Bad.1", "C.Good.1"):
+        write_var(addondir, name)
+    store_rows = VarFile._store_rows
+    def failing_store_rows(var, rows):
+        store_rows(var, rows)
+        if var.var == "B.Bad.1":
+            raise sqlite3.IntegrityError("constraint failed")
+    monkeypatch.setattr(VarFile, "_store_rows", failing_store_rows)
+    Dbs.set_commit_interval(10)
+    try:
+        stored = ScanMgr(str(addondir), confirm=False).scan(search_files_indir(addondir, r".*\.var"))
+    finally:
+        Dbs.set_commit_interval(1)
+    assert stored == 2
+    assert scanned() == [ "A.Good.1", "C.Good.1" ]
+    assert Dbs.fetchall("SELECT COUNT(*) FROM FILES WHERE VARNAME=?", ("B.Bad.1", )) == [ (0, ) ]
@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from vamtb import serve
+from vamtb.serve import QueryClient
+
+def stub(body):
+    """ Another service answering every POST with body """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args):
+            pass
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+@pytest.mark.parametrize("body", [ b"<html>not json</html>", b'{"result": {"pid": 1}}', b'{"result": "pong"}', b'{"error": "Oops", "message": ""}' ])
+def test_stale_state_falls_back(tmp_path, monkeypatch, body):
+    httpd = stub(body)
+    state = tmp_path / "serve.json"
+    state.write_text(json.dumps({ 'pid': 4242, 'port': httpd.server_address[1] }))
+    monkeypatch.setattr(serve, "C_SERVE_STATE", str(state))
+    try:
+        assert QueryClient.running() is None
+    finally:
+        httpd.shutdown()
+
+def test_running_server(tmp_path, monkeypatch):
+    httpd = stub(b'{"result": {"pid": 4242}}')
+    state = tmp_path / "serve.json"
+    state.write_text(json.dumps({ 'pid': 4242, 'port': httpd.server_address[1] }))
+    monkeypatch.setattr(serve, "C_SERVE_STATE", str(state))
+    try:
+        assert QueryClient.running() is not None
+    finally:
+        httpd.shutdown()
+
+def test_not_http_falls_back(tmp_path, monkeypatch):
+    import socketserver
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.wfile.write(b"SSH-2.0-OpenSSH\r\n")
+    server = socketserver.TCPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state = tmp_path / "serve.json"
+    state.write_text(json.dumps({ 'pid': 4242, 'port': server.server_address[1] }))
+    monkeypatch.setattr(serve, "C_SERVE_STATE", str(state))
+    try:
+        assert QueryClient.running() is None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_var_exception_forwarded(tmp_path, monkeypatch):
+    import http.server
+    from vamtb.serve import QueryServer
+    from vamtb.vamex import VarNotFound
+    servers = []
+    class Server(http.server.HTTPServer):
+        def __init__(self, *args):
+            super().__init__(*args)
+            servers.append(self)
+    monkeypatch.setattr(http.server, "HTTPServer", Server)
+    # Served from a thread: no signal handler and no database
+    monkeypatch.setattr(serve.signal, "signal", lambda signum, handler: None)
+    monkeypatch.setattr(QueryServer, "depgraph", lambda self: None)
+    def latest(self, name, dir):
+        raise VarNotFound(name)
+    monkeypatch.setattr(QueryServer, "latest", latest)
+    state = tmp_path / "serve.json"
+    monkeypatch.setattr(serve, "C_SERVE_STATE", str(state))
+    threading.Thread(target=QueryServer().serve, daemon=True).start()
+    try:
+        for _ in range(500):
+            if servers and state.exists():
+                break
+            time.sleep(0.01)
+        client = QueryClient.running()
+        assert client is not None
+        with pytest.raises(VarNotFound) as e:
+            client.latest("A.B.1", str(tmp_path))
+        assert str(e.value) == "A.B.1"
+    finally:
+        servers[0].shutdown()
@@ -0,0 +1,48 @@
+import json
+import zipfile
+
+import pytest
+
+from vamtb.db import Dbs, C_MEMBERDEPS_PARSER
+from vamtb.var import Var
+
+@pytest.fixture
+def var(tmp_path):
+    """ Var A.Scene.1 whose scene references B.Look.1 """
+    addondir = tmp_path / "AddonPackages"
+    addondir.mkdir()
+    with zipfile.ZipFile(addondir / "A.Scene.1.var", "w") as z:
+        z.writestr("meta.json", json.dumps({ "licenseType": "CC BY", "creatorName": "A", "packageName": "Scene", "dependencies": {} }))
+        z.writestr("Saves/scene/a.json", json.dumps({ "id": "look", "storables": [ { "id": "geometry", "presetUrl": "B.Look.1:/Custom/look.vap" } ] }))
+        zinfo = z.getinfo("Saves/scene/a.json")
+    with Var(str(addondir / "A.Scene.1.var"), str(addondir)) as var:
+        yield var, ("%08X" % zinfo.CRC, zinfo.file_size)
+
+def memberdeps():
+    return Dbs.fetchall("SELECT CRC, SIZE, DEPS, PARSER FROM MEMBERDEPS", ())
+
+def test_refs_cached_in_transaction(var):
+    var, member = var
+    Dbs.set_commit_interval(10)
+    try:
+        with pytest.raises(KeyError):
+            with Dbs.var_transaction():
+                assert var.dep_fromfiles() == [ "B.Look.1" ]
+                raise KeyError
+        # Rolled back with the var
+        assert memberdeps() == []
+        with Dbs.var_transaction():
+            assert var.dep_fromfiles() == [ "B.Look.1" ]
+        assert Dbs.getConn().in_transaction
+    finally:
+        Dbs.set_commit_interval(1)
+    assert memberdeps() == [ member + ('["B.Look.1:/Custom/look.vap"]', C_MEMBERDEPS_PARSER) ]
+
+def test_refs_of_older_parser_ignored(var):
+    var, member = var
+    Dbs.execute("INSERT INTO MEMBERDEPS(CRC, SIZE, DEPS, PARSER) VALUES (?,?,?,?)", member + ('["C.Old.1:/x.vap"]', C_MEMBERDEPS_PARSER - 1))
+    assert var.dep_fromfiles() == [ "B.Look.1" ]
+    assert memberdeps() == [ member + ('["B.Look.1:/Custom/look.vap"]', C_MEMBERDEPS_PARSER) ]
+    # Up to date references are not parsed again
+    Dbs.execute("UPDATE MEMBERDEPS SET DEPS=?", ('["C.New.1:/x.vap"]', ))
+    assert var.dep_fromfiles() == [ "C.New.1" ]
@@ -0,0 +1,68 @@
+import shutil
+import subprocess
+import zipfile
+
+import pytest
+
+from vamtb import utils
+from vamtb.utils import zip_rewrite
+
+MEMBERS = {
+    "meta.json": b'{"creatorName": "A"}',
+    "Custom/Atom/Person/Pose/p.vap": b"pose" * 1000,
+    "Custom/Atom/Person/Pose/p.jpg": bytes(range(256)) * 10,
+    "old.txt": b"old",
+}
+
+@pytest.fixture
+def var(tmp_path):
+    path = tmp_path / "A.B.1.var"
+    with zipfile.ZipFile(path, "w") as z:
+        for name, content in MEMBERS.items():
+            z.writestr(name, content, zipfile.ZIP_STORED if name.endswith(".jpg") else zipfile.ZIP_DEFLATED)
+    return path
+
+def rewrite(var, tmp_path):
+    dst = tmp_path / "out.var"
+    zip_rewrite(var, dst, replace={ "meta.json": b'{"creatorName": "B"}', "new.txt": b"new" }, delete=("old.txt", ))
+    with zipfile.ZipFile(dst) as z:
+        assert z.testzip() is None
+        return { zinfo.filename: (zinfo.compress_type, z.read(zinfo)) for zinfo in z.infolist() }
+
+def test_rewrite_copies_members(var, tmp_path):
+    assert utils.zip_can_copy_raw(zipfile.ZipFile(var))
+    members = rewrite(var, tmp_path)
+    assert members == {
+        "meta.json": (zipfile.ZIP_DEFLATED, b'{"creatorName": "B"}'),
+        "Custom/Atom/Person/Pose/p.vap": (zipfile.ZIP_DEFLATED, b"pose" * 1000),
+        "Custom/Atom/Person/Pose/p.jpg": (zipfile.ZIP_STORED, bytes(range(256)) * 10),
+        "new.txt": (zipfile.ZIP_DEFLATED, b"new"),
+    }
+
+def test_rewrite_without_zipfile_internals(var, tmp_path, monkeypatch):
+    raw = rewrite(var, tmp_path)
+    monkeypatch.setattr(utils, "C_ZIP_INTERNALS", utils.C_ZIP_INTERNALS + ("_not_in_zipfile", ))
+    assert rewrite(var, tmp_path) == raw
+
+def test_delete_wins_over_replace(var, tmp_path):
+    dst = tmp_path / "out.var"
+    zip_rewrite(var, dst, replace={ "Custom/Atom/Person/Pose/p.vap": b"x", "new.txt": b"new" }, delete=("Custom/Atom/Person/Pose/p.vap", "new.txt"))
+    with zipfile.ZipFile(dst) as z:
+        assert z.namelist() == [ "meta.json", "Custom/Atom/Person/Pose/p.jpg", "old.txt" ]
+
+@pytest.mark.skipif(not shutil.which("zip"), reason="zip is needed to write encrypted members")
+def test_rewrite_encrypted(tmp_path):
+    (tmp_path / "secret.txt").write_bytes(b"secret" * 100)
+    (tmp_path / "meta.json").write_bytes(b"{}")
+    src = tmp_path / "A.B.1.var"
+    # zip -P writes a data descriptor after encrypted data
+    subprocess.run([ "zip", "-q", "-P", "pw", src.name, "secret.txt" ], cwd=tmp_path, check=True)
+    subprocess.run([ "zip", "-q", src.name, "meta.json" ], cwd=tmp_path, check=True)
+    dst = tmp_path / "out.var"
+    zip_rewrite(src, dst, replace={ "meta.json": b'{"creatorName": "A"}' })
+    with zipfile.ZipFile(dst) as z:
+        z.setpassword(b"pw")
+        assert z.testzip() is None
+        assert z.read("secret.txt") == b"secret" * 100
+        assert z.read("meta.json") == b'{"creatorName": "A"}'
+    assert subprocess.run([ "unzip", "-qq", "-t", "-P", "pw", str(dst) ], capture_output=True).returncode == 0
@@ -1,5 +1,4 @@
 from pathlib import Path
-import yaml
 
 from vamtb.vamex import *
 from vamtb.utils import *
@@ -27,6 +26,7 @@ class ConfigMgr:
         """
         Read whole configuration
         """
+        import yaml
         with open(ConfigMgr.__streamname, 'r') as stream:
             conf = yaml.load(stream, Loader=yaml.BaseLoader)
             ConfigMgr.__conf = conf if conf else {}
@@ -50,6 +50,7 @@ class ConfigMgr:
         """
         Write value to configuration
         """
+        import yaml
         self.read_conf()
         ConfigMgr.__conf[key_name] = value
         with open(ConfigMgr.__streamname, 'w') as outfile:
@@ -66,6 +67,7 @@ class ConfigMgr:
         except KeyError:
             pass
         else:
+            import yaml
             with open(ConfigMgr.__streamname, 'w') as outfile:
                 yaml.dump(ConfigMgr.__conf, outfile, default_flow_style=False)
                 debug(f"Removed entry {key_name} from config file.")
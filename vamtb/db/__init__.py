@@ -1,5 +1,9 @@
 '''Vam dir structure'''
+import json
 import sqlite3
+import time
+from bisect import insort
+from contextlib import contextmanager
 from pprint import pprint
 
 from vamtb.vamex import *
@@ -10,9 +14,138 @@ from vamtb.log import *
 global C_DB
 global exec_dir
 
+# Schema migrations: C_DB_MIGRATIONS[i] upgrades the schema from version i to i+1
+C_DB_MIGRATIONS = [
+    # 1: Indexes covering hot queries
+    (
+        # get_prop_files, get_file_cksum, get_file_size, db_files, get_numfiles
+        "CREATE INDEX IF NOT EXISTS IDX_FILES_VARNAME ON FILES(VARNAME, FILENAME, SIZE, CKSUM)",
+        # get_refvar_forfile, dupinfo
+        "CREATE INDEX IF NOT EXISTS IDX_FILES_CKSUM ON FILES(CKSUM, SIZE, ISREF, VARNAME, FILENAME)",
+        # get_dep
+        "CREATE INDEX IF NOT EXISTS IDX_DEPS_VAR ON DEPS(VAR, DEPVAR)",
+        # get_rdep
+        "CREATE INDEX IF NOT EXISTS IDX_DEPS_DEPVAR ON DEPS(DEPVAR, VAR)",
+        # latest, min (LIKE ... COLLATE NOCASE)
+        "CREATE INDEX IF NOT EXISTS IDX_VARS_VARNAME_NOCASE ON VARS(VARNAME COLLATE NOCASE)",
+    ),
+    # 2: Var references of json members by zip CRC and size, shared by all vars holding the same member
+    (
+        """CREATE TABLE IF NOT EXISTS MEMBERDEPS
+            (CRC  TEXT NOT NULL,
+            SIZE  INT  NOT NULL,
+            DEPS  TEXT NOT NULL,
+            PRIMARY KEY (CRC, SIZE)) WITHOUT ROWID""",
+    ),
+    # 3: Hub uid of creators and file names given by hub download urls
+    (
+        """CREATE TABLE IF NOT EXISTS HUBCREATORS
+            (NAME TEXT PRIMARY KEY NOT NULL,
+            UID   TEXT NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS HUBFILES
+            (URL     TEXT PRIMARY KEY NOT NULL,
+            FILENAME TEXT NOT NULL)""",
+    ),
+    # 4: MD5 of uploaded files and members by CRC and size, as Internet Archive wants them
+    (
+        """CREATE TABLE IF NOT EXISTS FILEMD5
+            (CRC  TEXT NOT NULL,
+            SIZE  INT  NOT NULL,
+            MD5   TEXT NOT NULL,
+            PRIMARY KEY (CRC, SIZE)) WITHOUT ROWID""",
+    ),
+    # 5: Version of the parser which found cached member references
+    (
+        "DELETE FROM MEMBERDEPS",
+        "ALTER TABLE MEMBERDEPS ADD COLUMN PARSER INT NOT NULL DEFAULT 0",
+    ),
+]
+
+# Bump when FileName.jsonDeps finds references differently, cached member references are then parsed again
+C_MEMBERDEPS_PARSER = 1
+
+class VersionIndex:
+    """
+    Versions of vars in VARS by lowercase creator.resource, to resolve latest and minN without a query
+    """
+
+    def __init__(self, varnames = ()):
+        self.__versions = {}
+        for varname in varnames:
+            self.add(varname)
+
+    @staticmethod
+    def split(varname):
+        try:
+            creator, resource, version = varname.split('.', 3)[0:3]
+            return f"{creator}.{resource}".lower(), int(version)
+        except ValueError:
+            return None, None
+
+    def add(self, varname):
+        var_nov, version = VersionIndex.split(varname)
+        if var_nov is None:
+            return
+        versions = self.__versions.setdefault(var_nov, [])
+        if version not in versions:
+            insort(versions, version)
+
+    def remove(self, varname):
+        var_nov, version = VersionIndex.split(varname)
+        versions = self.__versions.get(var_nov)
+        if versions and version in versions:
+            versions.remove(version)
+            if not versions:
+                del self.__versions[var_nov]
+
+    def latest(self, var_nov):
+        """ Highest version or None """
+        versions = self.__versions.get(var_nov.lower())
+        return versions[-1] if versions else None
+
+    def min(self, var_nov, minver):
+        """ Highest version if at least minver or None """
+        version = self.latest(var_nov)
+        return version if version is not None and version >= minver else None
+
+    def resolve(self, varname):
+        """
+        (lowercase creator.resource, version) of the var a reference stands for or (None, None)
+        latest is the highest version, minN the highest version at least N
+        """
+        try:
+            creator, resource, version = varname.split('.', 3)[0:3]
+        except ValueError:
+            return None, None
+        var_nov = f"{creator}.{resource}".lower()
+        if version == "latest":
+            iversion = self.latest(var_nov)
+        elif version.startswith("min"):
+            try:
+                iversion = self.min(var_nov, int(version[3:]))
+            except ValueError:
+                return None, None
+        else:
+            try:
+                iversion = int(version)
+            except ValueError:
+                return None, None
+            if iversion not in self.__versions.get(var_nov, ()):
+                return None, None
+        return (var_nov, iversion) if iversion is not None else (None, None)
+
 class Dbs:
     __instance = None
     __conn = None
+    # Log query timings and plans
+    __timing = False
+    __explained = set()
+    # Number of vars written in one transaction
+    __commit_interval = 1
+    __pending = 0
+    # Version index and data_version it was loaded at
+    __versions = None
+    __data_version = None
 
     def __init__(self, dbfilename=C_DB):
         """
@@ -22,13 +155,70 @@ class Dbs:
         if not Dbs.__instance:
             #print(f"Opened database {dbfilename}")
             Dbs.__conn = sqlite3.connect(dbfilename)
+            Dbs.init_pragmas()
             Dbs.init_dbs()
+            Dbs.migrate()
             Dbs.__instance = self
 
     @staticmethod 
     def getConn():
+        """ Database is opened on first use """
+        if not Dbs.__conn:
+            Dbs()
         return Dbs.__conn
 
+    @staticmethod
+    def init_pragmas():
+        """
+        WAL lets readers work while dbscan writes, synchronous=NORMAL is safe with WAL
+        """
+        Dbs.getConn().execute("PRAGMA journal_mode=WAL")
+        Dbs.getConn().execute("PRAGMA synchronous=NORMAL")
+        # Negative means KiB: 64MB of page cache
+        Dbs.getConn().execute("PRAGMA cache_size=-65536")
+        Dbs.getConn().execute("PRAGMA temp_store=MEMORY")
+
+    @staticmethod
+    def schema_version() -> int:
+        return Dbs.getConn().execute("PRAGMA user_version").fetchone()[0]
+
+    @staticmethod
+    def migrate():
+        """
+        Upgrade schema to latest version
+        """
+        version = Dbs.schema_version()
+        for nversion in range(version + 1, len(C_DB_MIGRATIONS) + 1):
+            info(f"Migrating database schema to version {nversion}")
+            for sql in C_DB_MIGRATIONS[nversion - 1]:
+                Dbs.getConn().execute(sql)
+            # Pragma doesn't accept parameters
+            Dbs.getConn().execute(f"PRAGMA user_version={int(nversion)}")
+            Dbs.getConn().commit()
+
+    @staticmethod
+    def set_timing(timing: bool):
+        Dbs.__timing = timing
+
+    @staticmethod
+    def run(cur, sql, row):
+        """
+        Execute on cursor, logging timing and query plan (once per statement) when asked
+        """
+        if not Dbs.__timing:
+            return cur.execute(sql, row) if row else cur.execute(sql)
+        if sql not in Dbs.__explained:
+            Dbs.__explained.add(sql)
+            try:
+                plan = Dbs.getConn().execute(f"EXPLAIN QUERY PLAN {sql}", row or ()).fetchall()
+                debug(f"Query plan for {sql}: {' / '.join(e[-1] for e in plan)}")
+            except sqlite3.Error:
+                pass
+        start = time.perf_counter()
+        res = cur.execute(sql, row) if row else cur.execute(sql)
+        debug(f"Query took {(time.perf_counter() - start)*1000:.3f}ms: {sql} {row}")
+        return res
+
     @staticmethod
     def init_dbs():
         """
@@ -69,7 +259,136 @@ class Dbs:
         Execute query and don't return anything
         """
         cur = Dbs.getConn().cursor()
-        cur.execute(sql, row)
+        Dbs.run(cur, sql, row)
+
+    @staticmethod
+    def executemany(sql, rows):
+        """
+        Execute query for all rows and don't return anything
+        """
+        cur = Dbs.getConn().cursor()
+        cur.executemany(sql, rows)
+
+    @staticmethod
+    def get_member_refs(members) -> dict:
+        """
+        Cached var references of json members given as (crc, size), one query per chunk of members
+        Returns { (crc, size): list of references }, members not cached are missing
+        """
+        res = {}
+        crcs = list(set(crc for crc, _ in members))
+        for i in range(0, len(crcs), C_DB_CHUNK):
+            chunk = crcs[i:i + C_DB_CHUNK]
+            sql = f"SELECT CRC, SIZE, DEPS FROM MEMBERDEPS WHERE PARSER=? AND CRC IN ({','.join('?' * len(chunk))})"
+            for crc, size, deps in Dbs.fetchall(sql, [ C_MEMBERDEPS_PARSER ] + chunk):
+                res[(crc, size)] = json.loads(deps)
+        return res
+
+    @staticmethod
+    def store_member_refs(rows):
+        """
+        Cache var references of json members, rows are (crc, size, list of references)
+        Written in the current transaction, the caller commits
+        """
+        sql = "INSERT OR REPLACE INTO MEMBERDEPS(CRC, SIZE, DEPS, PARSER) VALUES (?,?,?,?)"
+        Dbs.executemany(sql, [ (crc, size, json.dumps(refs), C_MEMBERDEPS_PARSER) for crc, size, refs in rows ])
+
+    @staticmethod
+    def get_hub_uid(creator):
+        res = Dbs.fetchall("SELECT UID FROM HUBCREATORS WHERE NAME=?", (creator.lower(),))
+        return res[0][0] if res else None
+
+    @staticmethod
+    def store_hub_uid(creator, uid):
+        Dbs.execute("INSERT OR REPLACE INTO HUBCREATORS(NAME, UID) VALUES (?,?)", (creator.lower(), uid))
+        Dbs.commit()
+
+    @staticmethod
+    def get_hub_files() -> dict:
+        """
+        Download url -> file name it gives, for urls of the hub
+        """
+        return dict(Dbs.fetchall("SELECT URL, FILENAME FROM HUBFILES", None))
+
+    @staticmethod
+    def store_hub_files(rows):
+        """
+        Record file names of hub downloads, rows are (download url, file name)
+        """
+        Dbs.executemany("INSERT OR REPLACE INTO HUBFILES(URL, FILENAME) VALUES (?,?)", rows)
+        Dbs.commit()
+
+    @staticmethod
+    def get_md5(crc, size):
+        res = Dbs.fetchall("SELECT MD5 FROM FILEMD5 WHERE CRC=? AND SIZE=?", (crc, size))
+        return res[0][0] if res else None
+
+    @staticmethod
+    def store_md5s(rows):
+        """
+        Keep MD5 of contents, rows are (crc, size, md5)
+        """
+        Dbs.executemany("INSERT OR IGNORE INTO FILEMD5(CRC, SIZE, MD5) VALUES (?,?,?)", rows)
+        Dbs.commit()
+
+    @staticmethod
+    def set_uploaded(varnames, target):
+        """
+        Mark vars as uploaded to target, IA or ANON
+        """
+        Dbs.executemany(f"UPDATE UPLOAD SET {target}='YES' WHERE VARNAME=?", [ (varname,) for varname in varnames ])
+        Dbs.commit()
+
+    @staticmethod
+    def set_commit_interval(interval: int):
+        Dbs.__commit_interval = max(1, interval)
+
+    @staticmethod
+    def commit():
+        Dbs.getConn().commit()
+        Dbs.__pending = 0
+
+    @staticmethod
+    def rollback():
+        Dbs.getConn().rollback()
+        Dbs.__pending = 0
+        Dbs.__versions = None
+
+    @staticmethod
+    def versions() -> VersionIndex:
+        """
+        Version index, loaded once and kept in sync by writes of this process
+        Reloaded when another process modified the database
+        """
+        data_version = Dbs.getConn().execute("PRAGMA data_version").fetchone()[0]
+        if Dbs.__versions is None or data_version != Dbs.__data_version:
+            Dbs.__versions = VersionIndex(Dbs.get_vars())
+            Dbs.__data_version = data_version
+        return Dbs.__versions
+
+    @staticmethod
+    @contextmanager
+    def var_transaction():
+        """
+        Writes of one var happen in a savepoint: if they fail, only that var is rolled back.
+        The enclosing transaction is committed every commit_interval vars.
+        """
+        conn = Dbs.getConn()
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        conn.execute("SAVEPOINT VAR")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK TO VAR")
+            conn.execute("RELEASE VAR")
+            Dbs.__versions = None
+            raise
+        else:
+            conn.execute("RELEASE VAR")
+            Dbs.__pending += 1
+            if Dbs.__pending >= Dbs.__commit_interval:
+                Dbs.commit()
 
     @staticmethod
     def fetchall(sql, row):
@@ -78,10 +397,7 @@ class Dbs:
         """
         cur = Dbs.getConn().cursor()
         # debug(f"Fetchall({sql}, {row})")
-        if row:
-            cur.execute(sql, row)
-        else:
-            cur.execute(sql)
+        Dbs.run(cur, sql, row)
         res = cur.fetchall()
         # debug(f"Fetchall={res}")
         return res
@@ -94,6 +410,19 @@ class Dbs:
     def get_vars():
         return [ e[0] for e in Dbs.fetchall("SELECT VARNAME FROM VARS", None) ]
 
+    @staticmethod
+    def get_vars_with_files(varnames, patterns):
+        """
+        Vars of varnames having a file matching one of the LIKE patterns, one query per chunk of vars
+        """
+        res = set()
+        where = " OR ".join("FILENAME LIKE ?" for _ in patterns)
+        for i in range(0, len(varnames), C_DB_CHUNK):
+            chunk = varnames[i:i + C_DB_CHUNK]
+            sql = f"SELECT DISTINCT VARNAME FROM FILES WHERE VARNAME IN ({','.join('?' * len(chunk))}) AND ({where})"
+            res.update(e[0] for e in Dbs.fetchall(sql, list(chunk) + [ f"%{pattern}%" for pattern in patterns ]))
+        return res
+
     @staticmethod
     def update_values(table, d_sel: dict, d_col: dict):
         """
@@ -105,6 +434,3 @@ class Dbs:
         sql = f"UPDATE {table} {set_clause} WHERE {where_clause}"
         Dbs.execute(sql, ())
 
-# Singleton as Global variable 
-# FIXME make it testable
-__dbs = Dbs()
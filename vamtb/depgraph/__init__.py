@@ -0,0 +1,299 @@
+'''Dependency graph of the database'''
+from vamtb.db import Dbs, VersionIndex
+from vamtb.utils import *
+from vamtb.log import *
+
+class DepGraph:
+    """
+    VARS and DEPS loaded once in memory.
+    Every var or reference (a.b.latest, a.b.min2, missing vars..) is a node indexed by an integer.
+    Forward edges go from a var to the references found in its files, reverse edges go from a var
+    to the vars depending on it once references are resolved.
+    """
+
+    def __init__(self):
+        # node id -> name and name -> node id
+        self.__names = []
+        self.__ids = {}
+        # node id -> (size, license) for vars in VARS, None for references only
+        self.__props = []
+        # lowercase creator.resource -> sorted list of (version, node id)
+        self.__versions = {}
+        # node id -> node ids of referenced vars as stored in DEPS
+        self.__deps = []
+        # node id -> node ids of vars depending on it (resolved)
+        self.__rdeps = []
+        # node id -> resolved node id or -1
+        self.__resolved = []
+        # Dependency loops, computed once
+        self.__cycles = None
+        self.load()
+
+    def __node(self, name) -> int:
+        nid = self.__ids.get(name)
+        if nid is None:
+            nid = len(self.__names)
+            self.__ids[name] = nid
+            self.__names.append(name)
+            self.__props.append(None)
+            self.__deps.append([])
+            self.__rdeps.append([])
+        return nid
+
+    def load(self):
+        for varname, size, license in Dbs.fetchall("SELECT VARNAME, SIZE, LICENSE FROM VARS", None):
+            nid = self.__node(varname)
+            self.__props[nid] = (size, license)
+            try:
+                creator, resource, version = varname.split('.', 3)[0:3]
+                self.__versions.setdefault(f"{creator}.{resource}".lower(), []).append((int(version), nid))
+            except ValueError:
+                debug(f"Var {varname} has no numeric version, not used for latest or min")
+        for versions in self.__versions.values():
+            versions.sort()
+
+        for var, depvar in Dbs.fetchall("SELECT DISTINCT VAR, DEPVAR FROM DEPS", None):
+            self.__deps[self.__node(var)].append(self.__node(depvar))
+
+        self.__resolved = [ self.__resolve(nid) for nid in range(len(self.__names)) ]
+        for nid, deps in enumerate(self.__deps):
+            for dep in set(self.__resolved[d] for d in deps):
+                if dep != -1 and dep != nid:
+                    self.__rdeps[dep].append(nid)
+        debug(f"Loaded dependency graph of {len(self.__names)} nodes")
+
+    def __resolve(self, nid) -> int:
+        """
+        Node id of the var in VARS a node stands for, -1 if none
+        latest is the highest version, minN the highest version at least N
+        """
+        if self.__props[nid] is not None:
+            return nid
+        try:
+            creator, resource, version = self.__names[nid].split('.', 3)[0:3]
+        except ValueError:
+            return -1
+        versions = self.__versions.get(f"{creator}.{resource}".lower())
+        if not versions:
+            return -1
+        if version == "latest":
+            return versions[-1][1]
+        if version.startswith("min"):
+            try:
+                minver = int(version[3:])
+            except ValueError:
+                return -1
+            return versions[-1][1] if versions[-1][0] >= minver else -1
+        try:
+            iversion = int(version)
+        except ValueError:
+            return -1
+        return next((vid for ver, vid in versions if ver == iversion), -1)
+
+    def __id(self, name) -> int:
+        """ Resolved node id of name, -1 if not in database """
+        try:
+            return self.__resolved[self.__ids[name]]
+        except KeyError:
+            # Reference not found in DEPS, resolve it anyway
+            nid = self.__node(name)
+            self.__resolved.append(self.__resolve(nid))
+            return self.__resolved[nid]
+
+    def resolve(self, name):
+        """ Var name of reference in database or None """
+        nid = self.__id(name)
+        return self.__names[nid] if nid != -1 else None
+
+    def exists(self, name) -> bool:
+        return self.__id(name) != -1
+
+    def size(self, name):
+        nid = self.__id(name)
+        return self.__props[nid][0] if nid != -1 else None
+
+    def license(self, name):
+        nid = self.__id(name)
+        return self.__props[nid][1] if nid != -1 else None
+
+    def deps(self, name) -> list:
+        """ References found in files of the var """
+        nid = self.__id(name)
+        if nid == -1:
+            return []
+        return sorted([ self.__names[d] for d in self.__deps[nid] ], key=str.casefold)
+
+    def rdeps(self, name) -> list:
+        """ Vars having a reference resolving to the var """
+        nid = self.__id(name)
+        if nid == -1:
+            return []
+        return sorted([ self.__names[r] for r in self.__rdeps[nid] ], key=str.casefold)
+
+    def rdeps_many(self, names) -> list:
+        """ rdeps of each name, in one call """
+        return [ self.rdeps(name) for name in names ]
+
+    @staticmethod
+    def rdeps_db(names):
+        """
+        Same as rdeps for each name without loading the graph.
+        References by var name are joined with names in database, chunk by chunk.
+        Other references (latest, minN, other case..) are fetched in one query and resolved once with the version index.
+        Yields (name, rdeps) in order of names.
+        """
+        versions = Dbs.versions()
+        # (creator.resource, version) -> vars having a reference resolving to it
+        resolved = {}
+        for var, depvar in Dbs.fetchall("SELECT DISTINCT VAR, DEPVAR FROM DEPS WHERE DEPVAR NOT IN (SELECT VARNAME FROM VARS)", None):
+            key = versions.resolve(depvar)
+            if key[0] is not None:
+                resolved.setdefault(key, set()).add(var)
+
+        def exact_rdeps(varnames):
+            res = {}
+            for i in range(0, len(varnames), C_DB_CHUNK):
+                chunk = varnames[i:i + C_DB_CHUNK]
+                sql = f"SELECT DISTINCT DEPVAR, VAR FROM DEPS WHERE DEPVAR IN ({','.join('?' * len(chunk))})"
+                for depvar, var in Dbs.fetchall(sql, chunk):
+                    res.setdefault(depvar, set()).add(var)
+            return res
+
+        for i in range(0, len(names), C_DB_CHUNK):
+            chunk = names[i:i + C_DB_CHUNK]
+            sql = f"SELECT VARNAME FROM VARS WHERE VARNAME IN ({','.join('?' * len(chunk))})"
+            indb = { e[0] for e in Dbs.fetchall(sql, chunk) }
+            exact = exact_rdeps([ name for name in chunk if name in indb ])
+            for name in chunk:
+                if name in indb:
+                    varname, key = name, VersionIndex.split(name)
+                else:
+                    # Resolves to a var of another name, seldom
+                    key = versions.resolve(name)
+                    if key[0] is None:
+                        yield name, []
+                        continue
+                    sql = "SELECT VARNAME FROM VARS WHERE VARNAME LIKE ?"
+                    varname = next((e[0] for e in Dbs.fetchall(sql, (f"{key[0]}.%",)) if VersionIndex.split(e[0]) == key), None)
+                    if varname is None:
+                        yield name, []
+                        continue
+                    exact.update(exact_rdeps([ varname ]))
+                rvars = exact.get(varname, set()) | resolved.get(key, set())
+                rvars.discard(varname)
+                yield name, sorted(rvars, key=str.casefold)
+
+    def walk(self, name, maxdepth = None):
+        """
+        Depth first walk of the dependencies of name, without recursion
+        Yields (depth, reference, resolved var or None, loop) for each reference down to maxdepth.
+        Each var is descended once, loop is the chain of references when a reference points back to a var of the chain.
+        """
+        nid = self.__id(name)
+        yield 0, name, self.resolve(name), None
+        if nid == -1 or maxdepth == 0:
+            return
+        descended = { nid }
+        chain = [ name ]
+        path = [ nid ]
+        onpath = { nid }
+        stack = [ iter(sorted(self.__deps[nid], key=lambda d: self.__names[d].casefold())) ]
+        while stack:
+            dep = next(stack[-1], None)
+            if dep is None:
+                stack.pop()
+                onpath.discard(path.pop())
+                chain.pop()
+                continue
+            ref = self.__names[dep]
+            rid = self.__resolved[dep]
+            if rid in onpath:
+                yield len(stack), ref, self.__names[rid], chain + [ ref ]
+                continue
+            yield len(stack), ref, self.__names[rid] if rid != -1 else None, None
+            if rid == -1 or rid in descended or (maxdepth is not None and len(stack) >= maxdepth):
+                continue
+            descended.add(rid)
+            path.append(rid)
+            onpath.add(rid)
+            chain.append(ref)
+            stack.append(iter(sorted(self.__deps[rid], key=lambda d: self.__names[d].casefold())))
+
+    def cycles(self) -> list:
+        """
+        Dependency loops as strongly connected components of more than one var (iterative Tarjan)
+        Returns list of sorted var names lists
+        """
+        if self.__cycles is not None:
+            return self.__cycles
+        n = len(self.__names)
+        index = [ -1 ] * n
+        lowlink = [ 0 ] * n
+        onstack = [ False ] * n
+        stack = []
+        res = []
+        counter = 0
+        succ = [ [ r for r in set(self.__resolved[d] for d in deps) if r != -1 and r != nid ] for nid, deps in enumerate(self.__deps) ]
+        for root in range(n):
+            if index[root] != -1:
+                continue
+            work = [ (root, iter(succ[root])) ]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            onstack[root] = True
+            while work:
+                nid, it = work[-1]
+                child = next(it, None)
+                if child is not None:
+                    if index[child] == -1:
+                        index[child] = lowlink[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        onstack[child] = True
+                        work.append((child, iter(succ[child])))
+                    elif onstack[child]:
+                        lowlink[nid] = min(lowlink[nid], index[child])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[nid])
+                if lowlink[nid] == index[nid]:
+                    scc = []
+                    while True:
+                        member = stack.pop()
+                        onstack[member] = False
+                        scc.append(self.__names[member])
+                        if member == nid:
+                            break
+                    if len(scc) > 1:
+                        res.append(sorted(scc, key=str.casefold))
+        self.__cycles = sorted(res, key=lambda scc: scc[0].casefold())
+        return self.__cycles
+
+    def closure(self, name) -> list:
+        """ All references reachable from name, each var once """
+        res = []
+        seen = set()
+        for depth, ref, var, _ in self.walk(name):
+            if depth and (var or ref) not in seen:
+                seen.add(var or ref)
+                res.append(ref)
+        return res
+
+    def treedown(self, name) -> dict:
+        """
+        Down dependency graph of name: for each var, resolved dependencies, size and size of direct dependencies
+        """
+        td_vars = {}
+        for depth, ref, var, loop in self.walk(name):
+            if var is None or var in td_vars:
+                continue
+            td_vars[var] = { 'dep': [], 'size': self.size(var), 'totsize': 0 }
+            for dep in self.deps(var):
+                rdep = self.resolve(dep)
+                td_vars[var]['dep'].append(rdep or dep)
+                if rdep and rdep != var:
+                    td_vars[var]['totsize'] += self.size(rdep)
+        return td_vars
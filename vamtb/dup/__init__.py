@@ -0,0 +1,115 @@
+'''Duplicate files analysis'''
+from collections import Counter, defaultdict
+
+from vamtb.db import Dbs
+from vamtb.utils import *
+from vamtb.log import *
+
+class DupMgr:
+    """
+    Files duplicated between vars, computed from one pass on FILES grouped by (CKSUM, SIZE)
+    """
+
+    def __init__(self, hide_same_creator = False, varnames = None):
+        """
+        varnames: only duplicates of files of these vars are loaded, all of them when None
+        """
+        self.__hide_same_creator = hide_same_creator
+        # var -> list of (filename, cluster id) of its duplicated files
+        self.__varfiles = defaultdict(list)
+        # cluster id -> list of (varname, filename)
+        self.__clusters = []
+        # cluster id -> counters of files by creator and by creator and resource
+        self.__cluster_counts = {}
+        # var -> number of files without meta.json
+        self.__numfiles = {}
+        self.load(varnames)
+
+    @staticmethod
+    def split(varname):
+        creator, resource = (varname.split('.', 3) + [ "" ])[0:2]
+        return creator, resource
+
+    def load(self, varnames = None):
+        if varnames is None:
+            sql = """SELECT F.CKSUM, F.SIZE, F.VARNAME, F.FILENAME FROM FILES F JOIN
+                        (SELECT CKSUM, SIZE FROM FILES WHERE SIZE > 4 GROUP BY CKSUM, SIZE HAVING COUNT(DISTINCT VARNAME) > 1) D
+                     ON F.CKSUM = D.CKSUM AND F.SIZE = D.SIZE ORDER BY F.CKSUM, F.SIZE, F.VARNAME, F.FILENAME"""
+            rows = Dbs.fetchall(sql, None)
+        else:
+            rows = DupMgr.__rows_of(varnames)
+        key = None
+        for cksum, size, varname, filename in rows:
+            if (cksum, size) != key:
+                key = (cksum, size)
+                self.__clusters.append((size, []))
+            self.__clusters[-1][1].append((varname, filename))
+            if not filename.lower().endswith("meta.json"):
+                self.__varfiles[varname].append((filename, len(self.__clusters) - 1))
+        debug(f"Found {len(self.__clusters)} groups of duplicated files")
+
+        if varnames is None:
+            sql = "SELECT VARNAME, COUNT(*) FROM FILES WHERE FILENAME != 'meta.json' GROUP BY VARNAME"
+            self.__numfiles = dict(Dbs.fetchall(sql, None))
+        else:
+            for i in range(0, len(varnames), C_DB_CHUNK):
+                chunk = varnames[i:i + C_DB_CHUNK]
+                sql = f"SELECT VARNAME, COUNT(*) FROM FILES WHERE FILENAME != 'meta.json' AND VARNAME IN ({','.join('?' * len(chunk))}) GROUP BY VARNAME"
+                self.__numfiles.update(Dbs.fetchall(sql, chunk))
+
+    @staticmethod
+    def __rows_of(varnames) -> list:
+        """
+        Files having the (CKSUM, SIZE) of a file of varnames, when it is in several vars, one query per chunk of vars
+        Sorted as rows of the whole table
+        """
+        found = set()
+        for i in range(0, len(varnames), C_DB_CHUNK):
+            chunk = varnames[i:i + C_DB_CHUNK]
+            sql = f"""SELECT F.CKSUM, F.SIZE, F.VARNAME, F.FILENAME FROM FILES F JOIN
+                        (SELECT DISTINCT CKSUM, SIZE FROM FILES WHERE SIZE > 4 AND VARNAME IN ({','.join('?' * len(chunk))})) D
+                     ON F.CKSUM = D.CKSUM AND F.SIZE = D.SIZE"""
+            found.update(Dbs.fetchall(sql, chunk))
+        vars_of = defaultdict(set)
+        for cksum, size, varname, _ in found:
+            vars_of[(cksum, size)].add(varname)
+        return sorted(row for row in found if len(vars_of[row[0:2]]) > 1)
+
+    def numfiles(self, varname) -> int:
+        return self.__numfiles.get(varname, 0)
+
+    def dupinfo(self, varname) -> dict:
+        """
+        Returns dict about duplication of files of var with other creators vars
+        A file is counted when found in a var of another creator or resource (another creator when hiding same creator)
+        """
+        dups = { "numdupfiles": 0, "dupsize": 0 }
+        creator, resource = DupMgr.split(varname)
+        for filename, cid in sorted(self.__varfiles.get(varname, [])):
+            size, members = self.__clusters[cid]
+            creators, resources = self.__counts(cid)
+            if self.__hide_same_creator:
+                found = len(members) > creators[creator]
+            else:
+                found = len(members) > resources[(creator, resource)]
+            if found:
+                dups['numdupfiles'] += 1
+                dups['dupsize'] += size
+                for dupvar, dupfile in members:
+                    if dupvar != varname:
+                        info(f"{varname}:/{filename} is dup of {dupvar}:/{dupfile}")
+            else:
+                debug(f"No dup for {varname}:/{filename}")
+        return dups
+
+    def __counts(self, cid):
+        """ Number of files of the group by creator and by creator and resource """
+        if cid not in self.__cluster_counts:
+            creators = Counter()
+            resources = Counter()
+            for v, _ in self.__clusters[cid][1]:
+                creator, resource = DupMgr.split(v)
+                creators[creator] += 1
+                resources[(creator, resource)] += 1
+            self.__cluster_counts[cid] = (creators, resources)
+        return self.__cluster_counts[cid]
@@ -1,14 +1,19 @@
+import io
 import json
+import time
 from json import decoder
 from pathlib import Path
 import os
 import json
 from vamtb.utils import *
+from vamtb.log import *
 
 class FileName:
     def __init__(self, fname, calc_crc = False) -> None:
         self.__fname = Path(fname)
         self.__crc = 0
+        # References of the json file, or the exception raised when it was not json
+        self.__deps = None
         if calc_crc:
             self.__crc = self.crc
 
@@ -29,22 +34,29 @@ class FileName:
     @property
     def crc(self):
         if not self.__crc:
-            content = self.read()
-            try:
-                # Normalize json content
-                json_content = json.loads(content)
-            except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                #Was not json or not UTF-8 json
-                pass
-            else:
-                #TODO check for vaj: displayName (, creatorName)
-                if self.path.suffix == ".vmi":
-                    json_content.pop('group')
-                    json_content.pop('region')
-                content = json.dumps(json_content).encode('utf8')
-            self.__crc = crc32c(content)
+            self.__scan()
         return self.__crc
 
+    def __scan(self):
+        """
+        Read and parse the file once for both its normalized checksum and the references it holds
+        """
+        content = self.read()
+        try:
+            # Normalize json content
+            json_content = json.loads(content)
+        except (UnicodeDecodeError, json.decoder.JSONDecodeError) as e:
+            #Was not json or not UTF-8 json
+            self.__deps = e
+        else:
+            self.__deps = self.__refs(content.decode(json.detect_encoding(content), 'surrogatepass'))
+            #TODO check for vaj: displayName (, creatorName)
+            if self.path.suffix == ".vmi":
+                json_content.pop('group')
+                json_content.pop('region')
+            content = json.dumps(json_content).encode('utf8')
+        self.__crc = crc32c(content)
+
     @property
     def mtime(self):
         self.__mtime = os.path.getmtime(self.path)
@@ -66,33 +78,175 @@ class FileName:
         return open(self.__fname)
 
     @property
-    def jsonDeps(self, fuzzy=False):
+    def jsonDeps(self):
         """
         Get  dependency from inspecting json
         FIXME "MeshedVR.PresetsPack.latest:MeshedVR/PresetsPack/Ren_Tina" is also correct
         FIXME "UserLUT" : "Oeshii.Hani.1:/Custom/Assets/MacGruber/PostMagic/LUT32/PhotoStudio_LUT02.png" as parameter of plugin#1_MacGruber.PostMagic.UserLUT 
+        Raises UnicodeDecodeError or JSONDecodeError if file is not json
         """
+        if self.__deps is None:
+            self.__scan()
+        if isinstance(self.__deps, Exception):
+            raise self.__deps
+        # debug(f"Decoded json from {self.name()}, deps={deps}")
+        return self.__deps
+
+    @staticmethod
+    def __refs(text, fuzzy=False):
+        """ References found in the string values of a json text """
         deps = { 'embed': [], 'var': [] , 'self': [] }
-        def _decode_dict(a_dict):
-            for id, ref in a_dict.items():  # pylint: disable=unused-variable
-                if not fuzzy and not id_is_ref(id):
+        for id, ref in json_refpairs(text):
+            if not fuzzy and not id_is_ref(id):
+                continue
+            if ref.startswith("SELF:/"):
+                # Link to self (embedded)
+                deps['self'].append(ref)
+            elif ":/" in ref[1:]:
+                # Link to Other
+                name = ref.split(':')
+                if len(name) == 2:
+                    name = name[0]
+                    ndot = len(name.split('.'))
+                    if ndot == 3:
+                        deps['var'].append(ref)
+            elif any(ref.endswith(s) for s in C_EMBED_EXT):
+                # Local to file (embedded) without SELF
+                deps['embed'].append(ref)
+        return deps
+
+class ZipFileName(FileName):
+    """
+    A file member of a var, read straight from the zip without extracting it
+    The zip must stay open while the member is used
+    """
+    def __init__(self, zipf, zinfo, calc_crc = False) -> None:
+        self.__zipf = zipf
+        self.__zinfo = zinfo
+        super().__init__(zinfo.filename, calc_crc)
+
+    @property
+    def zinfo(self):
+        return self.__zinfo
+
+    @property
+    def is_json(self):
+        return self.path.suffix.lower() in C_JSON_EXT
+
+    @property
+    def zipcrc(self):
+        """ Checksum of the member content as stored in the zip central directory """
+        return "%08X" % self.__zinfo.CRC
+
+    @property
+    def crc(self):
+        """
+        Non json members never get normalized: their checksum is the one of the zip central directory
+        """
+        if self.is_json:
+            return super().crc
+        return self.zipcrc
+
+    @property
+    def mtime(self):
+        return time.mktime(self.__zinfo.date_time + (0, 0, -1))
+
+    @property
+    def size(self):
+        return self.__zinfo.file_size
+
+    def read(self):
+        return self.__zipf.read(self.__zinfo)
+
+    def open(self):
+        return io.TextIOWrapper(self.__zipf.open(self.__zinfo))
+
+class DirIndex:
+    """
+    Vars of a directory (not recursive) by lowercase creator.resource: { version: file name }
+    Listing is done once and kept in memory and in C_DIRINDEX, it is redone when directory mtime changes
+    """
+    __indexes = {}
+
+    @staticmethod
+    def get(dir):
+        """ Up to date index of dir """
+        dir = os.path.abspath(dir)
+        mtime = os.stat(dir).st_mtime_ns
+        index = DirIndex.__indexes.get(dir)
+        if not index or index.mtime != mtime:
+            index = DirIndex(dir, mtime)
+            DirIndex.__indexes[dir] = index
+        return index
+
+    def __init__(self, dir, mtime):
+        self.__dir = dir
+        self.__mtime = mtime
+        self.__vars = None
+        self.load()
+        if self.__vars is None:
+            self.scan()
+            self.save()
+
+    @property
+    def mtime(self):
+        return self.__mtime
+
+    def load(self):
+        try:
+            with open(C_DIRINDEX, "r") as f:
+                saved = json.load(f)[self.__dir]
+        except (FileNotFoundError, KeyError, ValueError):
+            return
+        if saved['mtime'] == self.__mtime:
+            # Indexes saved by older versions could hold .part files
+            self.__vars = { k: { int(v): name for v, name in versions.items() if name.lower().endswith(".var") } for k, versions in saved['vars'].items() }
+            debug(f"Loaded index of {self.__dir}")
+
+    def scan(self):
+        self.__vars = {}
+        with os.scandir(self.__dir) as it:
+            for entry in it:
+                # A.B.1.var.part is a download in progress, not a var
+                try:
+                    creator, resource, version, ext = entry.name.split('.')
+                    version = int(version)
+                except ValueError:
                     continue
-                if type(ref) == str:
-                    if ref.startswith("SELF:/"):
-                        # Link to self (embedded)
-                        deps['self'].append(ref)
-                    elif ":/" in ref[1:]:
-                        # Link to Other
-                        name = ref.split(':')
-                        if len(name) == 2:
-                            name = name[0]
-                            ndot = len(name.split('.'))
-                            if ndot == 3:
-                                deps['var'].append(ref)
-                    elif any(ref.endswith(s) for s in ['.vmi', ".vam", ".vap",".json"]):
-                        # Local to file (embedded) without SELF
-                        deps['embed'].append(ref)
-
-        _ = json.loads(self.read(), object_hook=_decode_dict)
-        # debug(f"Decoded json from {self.name()}, deps={deps}")
-        return deps
\ No newline at end of file
+                if ext.lower() != "var" or not entry.is_file():
+                    continue
+                self.__vars.setdefault(f"{creator}.{resource}".lower(), {})[version] = entry.name
+        debug(f"Indexed {len(self.__vars)} resources in {self.__dir}")
+
+    def save(self):
+        try:
+            with open(C_DIRINDEX, "r") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            saved = {}
+        saved[self.__dir] = { 'mtime': self.__mtime, 'vars': self.__vars }
+        tmpname = f"{C_DIRINDEX}.tmp"
+        try:
+            with open(tmpname, "w") as f:
+                json.dump(saved, f)
+            os.replace(tmpname, C_DIRINDEX)
+        except OSError as e:
+            warn(f"Could not save directory index: {e}")
+
+    def versions(self, creator, resource) -> dict:
+        return self.__vars.get(f"{creator}.{resource}".lower(), {})
+
+    def find(self, creator, resource, version = None, minversion = 0):
+        """
+        Path of var: exact version, or highest version when version is None, or lowest version at least minversion
+        None if not found
+        """
+        versions = self.versions(creator, resource)
+        if version is not None:
+            name = versions.get(version)
+        elif minversion:
+            candidates = [ v for v in versions if v >= minversion ]
+            name = versions[min(candidates)] if candidates else None
+        else:
+            name = versions[max(versions)] if versions else None
+        return Path(self.__dir, name) if name else None
@@ -1,6 +1,6 @@
 import subprocess
 import os
-from vamtb.varfile import VarFile
+from vamtb.depgraph import DepGraph
 from vamtb.utils import *
 from vamtb.log import *
 
@@ -12,12 +12,11 @@ class Graph:
             Graph.__instance = self
     
     @staticmethod
-    def get_props(var_list)->str:
+    def get_props(depgraph, var_list)->str:
         res = []
         for svar in var_list:
-            var = VarFile(svar, use_db=True)
-            res.append(f'"{svar}" [color={"blue" if var.exists() else "red"}];')
-            license = var.license
+            res.append(f'"{svar}" [color={"blue" if depgraph.exists(svar) else "red"}];')
+            license = depgraph.license(svar)
             if license in ("PC", "Questionable"):
                 res.append(f'"{svar}" [shape=box];')
         return res
@@ -36,12 +35,13 @@ class Graph:
         return res
 
     @staticmethod
-    def dotty(lvar=None, ext = "pdf"):
+    def dotty(lvar=None, ext = "pdf", depgraph = None):
 
         direct_graphs=[]
 
-        tree = lvar.treedown()
-        if not len(tree[lvar.var]['dep']):
+        depgraph = depgraph or DepGraph()
+        tree = depgraph.treedown(lvar.var)
+        if lvar.var not in tree or not len(tree[lvar.var]['dep']):
             info("No deps, no graph")
             return
         for var in tree:
@@ -54,7 +54,7 @@ class Graph:
             all_vars.extend(tree[var]['dep'])
         all_vars = list(set(all_vars))
 
-        dot_lines = Graph.get_props(all_vars)
+        dot_lines = Graph.get_props(depgraph, all_vars)
         # Calculate real size of top var
         tree[lvar.var]['totsize'] = tree[lvar.var]['size']
         for v in all_vars:
@@ -83,5 +83,3 @@ class Graph:
         os.unlink("deps.dot")
         info("Graph generated")
 
-# Singleton as Global variable 
-__graph = Graph()
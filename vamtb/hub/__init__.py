@@ -1,25 +1,123 @@
+import binascii
+import hashlib
+import json
 import re
 import os
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
 import requests
 from bs4 import BeautifulSoup
-from tenacity import wait_random_exponential, stop_after_delay, retry, retry_if_not_exception_type
+from tenacity import wait_random_exponential, stop_after_delay, retry, retry_if_not_exception_type, RetryError
 from vamtb.vamex import HubResponse
 #import pyrfc6266
 
+from vamtb.db import Dbs
+from vamtb.file import DirIndex
 from vamtb.log import *
 from vamtb.utils import *
 
 base_url = "https://hub.virtamate.com"
 base_resource_url = f"{base_url}/resources"
 base_resource_per_author_url = f"{base_resource_url}/authors"
+# Vars are written to disk by chunks of this size
+C_DL_CHUNK = 1024 * 1024
+
+class RateLimiter:
+    """
+    Spaces requests to a same host by 1/rate seconds, whatever the worker doing them.
+    A host can be paused for all workers, for instance after connection errors.
+    """
+
+    def __init__(self, rate = C_HUB_RATE):
+        self.__interval = 1 / rate if rate else 0
+        self.__lock = threading.Lock()
+        # host -> time of next request
+        self.__next = {}
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self.__lock:
+            now = time.monotonic()
+            start = max(now, self.__next.get(host, now))
+            self.__next[host] = start + self.__interval
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, url, seconds):
+        host = urlsplit(url).netloc
+        with self.__lock:
+            self.__next[host] = max(self.__next.get(host, 0), time.monotonic() + seconds)
+
+class PageCache:
+    """
+    Hub pages by url: status, text and validators (ETag, Last-Modified) of the response.
+    A page younger than ttl seconds is used as is, an older one is revalidated with a conditional request.
+    A page got without following redirects is kept apart from the one got following them.
+    """
+
+    def __init__(self, dir = C_HUBCACHE, ttl = C_HUBCACHE_TTL):
+        self.__dir = dir
+        self.__ttl = ttl
+
+    @property
+    def ttl(self):
+        return self.__ttl
+
+    def __path(self, url, allow_redirects) -> str:
+        key = hashlib.sha1(f"{url} {allow_redirects}".encode('utf-8')).hexdigest()
+        return os.path.join(self.__dir, key[0:2], f"{key}.json")
+
+    def get(self, url, allow_redirects = True):
+        """ Cached page as dict or None """
+        try:
+            with open(self.__path(url, allow_redirects), "r", encoding='utf-8') as f:
+                page = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return page if page['url'] == url and page.get('allow_redirects') == allow_redirects else None
+
+    def put(self, page):
+        path = self.__path(page['url'], page['allow_redirects'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Workers can write the same page
+        tmpfd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(tmpfd, "w", encoding='utf-8') as f:
+            json.dump(page, f)
+        os.replace(tmpname, path)
 
 class HubMgr:
 
     __session = None
+    # Lock of each .part being written, two resources may give the same file
+    __parts = {}
+    __parts_lock = threading.Lock()
 
-    def __init__(self):
+    def __init__(self, jobs = 1, rate = C_HUB_RATE, url = base_url, cache = None, dir = None, dryrun = False):
+        """
+        jobs resources are downloaded at once, sharing the connection pool of the session
+        rate is the number of requests per second to a host
+        url of the hub, a local stand-in can be used
+        cache of hub pages, a PageCache
+        dir of vars, with the database and the current directory it tells which files are already there
+        dryrun only prints what would be downloaded
+        """
+        self.__jobs = jobs
+        self.__dir = dir
+        self.__dryrun = dryrun
+        self.__limiter = RateLimiter(rate)
+        self.__base_url = url
+        self.__cache = cache
+        # Download url -> file name it gives, loaded with first creator
+        self.__files = None
+        # (download url, file name) found by workers, recorded in database by main thread
+        self.__new_files = []
         HubMgr.__session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(jobs, 10))
+        HubMgr.__session.mount("https://", adapter)
+        HubMgr.__session.mount("http://", adapter)
         #TODO ask user once, set in conf
         HubMgr.__session.cookies['vamhubconsent'] = "yes"
         HubMgr.__session.headers.update({'User-Agent': 'Vamtb see https://github.com/vaminator/vamtb'})
@@ -28,11 +126,14 @@ class HubMgr:
     def get(self, url, **kwargs):
         #FIXME this shouldn't be needed
         HubMgr.__session.cookies['vamhubconsent'] = "yes"
+        self.__limiter.wait(url)
         try:
             res = HubMgr.__session.get(url, **kwargs)
             if not( 
                 200 <= res.status_code < 300 or
-                (res.status_code in (301,303) and kwargs.get("allow_redirects") == False)):
+                (res.status_code in (301,303) and kwargs.get("allow_redirects") == False) or
+                (res.status_code == 304 and kwargs.get("headers", {}).keys() & { 'If-None-Match', 'If-Modified-Since' }) or
+                (res.status_code == 416 and 'Range' in kwargs.get("headers", {}))):
                 warn(f"Getting url {url} returned status code {res.status_code}")
                 raise HubResponse
         except requests.exceptions.ConnectionError as e:
@@ -44,6 +145,7 @@ class HubMgr:
     def post(self, url, **kwargs):
         #FIXME this shouldn't be needed
         HubMgr.__session.cookies['vamhubconsent'] = "yes"
+        self.__limiter.wait(url)
         try:
             res = HubMgr.__session.post(url, **kwargs)
             if not( 200 <= res.status_code < 300 ):
@@ -54,41 +156,232 @@ class HubMgr:
             raise
         return res
 
-    def write_var(self, file_name, content):
+    def write_var(self, file_name, response, url, ntry = 3):
+        """
+        Stream response to file_name.part, synced and renamed to file_name once complete.
+        Only one worker writes a .part, others give up on the same file.
+        A previous .part is resumed when the server supports ranges, so is a transfer interrupted by a connection drop.
+        Returns crc of content, computed while writing.
+        """
+        part = f"{file_name}.part"
+        with HubMgr.__parts_lock:
+            lock = HubMgr.__parts.setdefault(os.path.abspath(part), threading.Lock())
+        if not lock.acquire(blocking=False):
+            warn(f"{file_name} is already being downloaded")
+            response.close()
+            return None
+        try:
+            return self.__write_part(file_name, part, response, url, ntry)
+        finally:
+            lock.release()
+
+    def __write_part(self, file_name, part, response, url, ntry):
+        crc = 0
+        size = 0
+        # ETag or Last-Modified of the content written to part, kept along for the next run
+        validator_file = f"{part}.etag"
+        validator = HubMgr.__validator(response)
+        if os.path.exists(part):
+            # Only the part of a same content can be resumed
+            size = os.path.getsize(part)
+            total = self.__total_size(response, 0)
+            if not validator or HubMgr.__read_validator(validator_file) != validator:
+                info(f"{part} is from another content, starting over")
+                size = 0
+            elif total is not None and size >= total:
+                if size == total:
+                    # Only the rename was missing
+                    response.close()
+                    return self.__finish(file_name, part, validator_file, int(crc32f(part), 16), size)
+                size = 0
+            elif response.headers.get('accept-ranges') == "bytes":
+                info(f"Resuming {file_name} from {toh(size)}")
+                response.close()
+                response, resumed = self.__resume(url, size, validator)
+                if resumed:
+                    crc = int(crc32f(part), 16)
+                else:
+                    size = 0
+            else:
+                size = 0
+        while True:
+            if not size:
+                validator = HubMgr.__validator(response)
+                HubMgr.__write_validator(validator_file, validator)
+            total = self.__total_size(response, size)
+            try:
+                with open(part, "ab" if size else "wb") as fd:
+                    for chunk in response.iter_content(chunk_size=C_DL_CHUNK):
+                        fd.write(chunk)
+                        crc = binascii.crc32(chunk, crc)
+                        size += len(chunk)
+                    fd.flush()
+                    os.fsync(fd.fileno())
+                if total is not None and size < total:
+                    raise requests.exceptions.ConnectionError(f"Got {size} bytes out of {total}")
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                response.close()
+                ntry = ntry - 1
+                if not ntry or not validator or response.headers.get('accept-ranges') != "bytes":
+                    raise
+                warn(f"Download of {file_name} interrupted at {toh(size)} ({e}), resuming")
+                response, resumed = self.__resume(url, size, validator)
+                if not resumed:
+                    crc = 0
+                    size = 0
+        response.close()
+        return self.__finish(file_name, part, validator_file, crc, size)
+
+    def __finish(self, file_name, part, validator_file, crc, size):
+        """ Rename complete part to file_name """
+        if os.path.exists(validator_file):
+            os.unlink(validator_file)
         if os.path.exists(file_name):
             warn(f"{file_name} already exists, not overwritting")
-            return
+            os.unlink(part)
+            return None
+        os.replace(part, file_name)
+        print(green(f" > Downloaded {file_name} [{toh(size)}]"))
+        return "%08X" % (crc & 0xFFFFFFFF)
+
+    def __resume(self, url, start, validator):
+        """
+        Content from start when it is still the one of validator, otherwise the whole content
+        Returns the response and whether it is the rest of the content
+        """
+        response = self.__get_range(url, start, validator)
+        if response.status_code == 206:
+            return response, True
+        if response.status_code == 416:
+            # Range beyond the end of the content, which changed
+            response.close()
+            response = self.get(url, stream=True, headers={ 'Accept-Encoding': "identity" })
+        return response, False
+
+    def __get_range(self, url, start, validator):
+        headers = { 'Range': f"bytes={start}-", 'Accept-Encoding': "identity" }
+        if validator:
+            headers['If-Range'] = validator
+        return self.get(url, stream=True, headers=headers)
 
-        with open(file_name, 'wb') as fd:
-            fd.write(content)
-        print(green(f" > Downloaded {file_name} [{toh(os.path.getsize(file_name))}]"))
+    @staticmethod
+    def __validator(response):
+        """ ETag or Last-Modified of a response, None if there's none """
+        return response.headers.get('etag') or response.headers.get('last-modified')
+
+    @staticmethod
+    def __read_validator(validator_file):
+        try:
+            with open(validator_file, "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def __write_validator(validator_file, validator):
+        """ Record validator of a part being written, a part without one is not resumed """
+        if validator:
+            with open(validator_file, "w") as f:
+                f.write(validator)
+        elif os.path.exists(validator_file):
+            os.unlink(validator_file)
+
+    @staticmethod
+    def __total_size(response, start):
+        """ Size of the whole content once the response is read, None if unknown """
+        if response.status_code == 206:
+            content_range = response.headers.get('content-range', "")
+            total = content_range.rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+        length = response.headers.get('content-length')
+        return int(length) if length and length.isdigit() else None
+
+    def get_page(self, url, allow_redirects = True) -> dict:
+        """
+        Hub page as dict with url, status, text, etag, last_modified and location.
+        Taken from cache while fresh, otherwise fetched with a conditional request when cached.
+        """
+        page = self.__cache.get(url, allow_redirects) if self.__cache else None
+        if page and time.time() - page['time'] < self.__cache.ttl:
+            debug(f"Using cached {url}")
+            return page
+        headers = {}
+        if page and page['etag']:
+            headers['If-None-Match'] = page['etag']
+        if page and page['last_modified']:
+            headers['If-Modified-Since'] = page['last_modified']
+        res = self.get(url, allow_redirects=allow_redirects, headers=headers)
+        if res.status_code == 304:
+            debug(f"Cached {url} is still valid")
+        else:
+            page = { 'url': url, 'allow_redirects': allow_redirects, 'status': res.status_code, 'text': res.text,
+                     'etag': res.headers.get('etag'), 'last_modified': res.headers.get('last-modified'),
+                     'location': res.headers.get('location') }
+        page['time'] = time.time()
+        # Redirects are followed again next time, their target may change
+        if self.__cache and not 300 <= page['status'] < 400:
+            self.__cache.put(page)
+        return page
 
     def dl_file(self, url):
+        """
+        Download file at url in current directory
+        Returns list of (file name, crc) of downloaded vars
+        """
         print(f" > Downloading from {url}...")
 
-        response = self.get(url)
+        # Not decoded by requests, offsets of ranges are those of the file
+        response = self.get(url, stream=True, headers={ 'Accept-Encoding': "identity" })
         if 200 <= response.status_code < 300:
            pass 
         else:
             error(f"Getting url {url} returned status code {response.status_code}")
             debug(response.text)
-            return
-        file_names = []
-        try:
-            #FIXME
-            #file_name = pyrfc6266.requests_response_to_filename(response)
-            file_name = response.headers['content-disposition'][:-2].split('=')[1][1:]
-            if not file_name.endswith("depend.txt"):
-                self.write_var(file_name, response.content)
-        except KeyError:
+            return []
+        file_name = HubMgr.__file_name(response)
+        if not file_name:
             # No content disposition
             # Might be multiple downloads
             # FIXME that's horrible
             content = response.text
             mult_links = self.get_links(content)
+            downloaded = []
             for l in mult_links:
-                self.dl_file(f"{base_url}/{l}")
-            return
+                downloaded.extend(self.dl_file(f"{self.__base_url}/{l}"))
+            return downloaded
+        if file_name.endswith("depend.txt") or os.path.exists(file_name):
+            if not file_name.endswith("depend.txt"):
+                warn(f"{file_name} already exists, not overwritting")
+                self.__new_files.append((url, file_name))
+            response.close()
+            return []
+        crc = self.write_var(file_name, response, url)
+        self.__new_files.append((url, file_name))
+        return [ (file_name, crc) ] if crc else []
+
+    @staticmethod
+    def __file_name(response):
+        """ File name given by a download response, None if there's none """
+        try:
+            #FIXME
+            #file_name = pyrfc6266.requests_response_to_filename(response)
+            return response.headers['content-disposition'][:-2].split('=')[1][1:]
+        except KeyError:
+            return None
+
+    def file_name(self, url):
+        """
+        File name of a download, known from a previous download or from headers of the response, None if unknown
+        """
+        if self.__files and url in self.__files:
+            return self.__files[url]
+        # Only headers are read
+        with self.get(url, stream=True, headers={ 'Accept-Encoding': "identity" }) as response:
+            file_name = HubMgr.__file_name(response)
+        if file_name:
+            self.__new_files.append((url, file_name))
+        return file_name
 
     def get_links(self, page_text):
         bs = BeautifulSoup(page_text, "html.parser")
@@ -97,7 +390,7 @@ class HubMgr:
         return res
 
     def get_token(self):
-        resource_url = f"https://hub.virtamate.com/members/"
+        resource_url = f"{self.__base_url}/members/"
         try:
             page = self.get(resource_url)
         except:
@@ -113,6 +406,10 @@ class HubMgr:
         """
         Get creator uid from creator name
         """
+        uid = Dbs.get_hub_uid(creator)
+        if uid:
+            debug(f"Creator uid of {creator} is {uid}")
+            return uid
         info(f"Getting creator uid for {creator}")
         tk = self.get_token()
         if not tk:
@@ -121,7 +418,7 @@ class HubMgr:
         else:
             debug(f"Got hub token {tk}")
 
-        resource_url = "https://hub.virtamate.com/members"
+        resource_url = f"{self.__base_url}/members"
         try:
             page = self.post(resource_url, data = {"username": creator, "_xfToken": tk} )
         except: 
@@ -134,76 +431,159 @@ class HubMgr:
         res = soup.find(href=re.compile("/search/member\\?user_id=.*"))
         if res:
             uid = res.get("href").replace("/search/member?user_id=", "")
+            Dbs.store_hub_uid(creator, f"{creator.lower()}.{uid}")
             return f"{creator.lower()}.{uid}"
         else:
             error(f"Didn't find member {creator}")
             return None
 
-    def dl_resource(self, resource_url):
+    def plan_resource(self, resource_url):
         """
-        Download a resource
+        Returns list of (download url, file name or None) of a resource
         """
         try:
-            page = self.get(resource_url)
+            page = self.get_page(resource_url)
         except:
-            error(f"Couln't download resource from {resource_url}")
-            return
+            error(f"Couln't get resource from {resource_url}")
+            return []
 
-        dl_links = self.get_links(page.text)
+        dl_links = self.get_links(page['text'])
         if len(dl_links) > 1:
             error(f"We got more than one download link for {resource_url}, please check {','.join(dl_links)}")
         elif not dl_links:
             # Paid link
             print(f" > {resource_url} can't be downloaded (offsite)")
-            return
         else:
-            self.dl_file(f"{base_url}/{dl_links[0]}")
+            url = f"{self.__base_url}/{dl_links[0]}"
+            return [ (url, self.file_name(url)) ]
+        return []
+
+    def plan(self, files) -> list:
+        """
+        Decide for each (download url, file name) whether to download it, comparing with vars in database,
+        in dir and in current directory.
+        Returns list of (download url, file name, download or not, reason)
+        """
+        versions = Dbs.versions()
+        indexes = [ DirIndex.get(d) for d in (self.__dir, os.getcwd()) if d ]
+        res = []
+        for url, file_name in files:
+            if not file_name:
+                res.append((url, url, True, "name unknown"))
+                continue
+            if file_name.endswith("depend.txt"):
+                continue
+            var_nov, version = versions.split(file_name)
+            if var_nov is None:
+                exists = os.path.exists(file_name)
+                res.append((url, file_name, not exists, "on disk" if exists else "new"))
+                continue
+            creator, resource = file_name.split('.', 2)[0:2]
+            have = set(v for index in indexes for v in index.versions(creator, resource))
+            if versions.latest(var_nov) is not None:
+                have.add(versions.latest(var_nov))
+            if version in have or versions.resolve(file_name)[0] is not None:
+                res.append((url, file_name, False, "already there"))
+            elif have and max(have) > version:
+                res.append((url, file_name, False, f"older than version {max(have)}"))
+            else:
+                res.append((url, file_name, True, f"newer than version {max(have)}" if have else "new"))
+        return res
+
+    def retry_host(self, func, url, cooldown_seconds, ntry = 3):
+        """
+        func(url) returning a list, pausing the host for all workers on connection errors
+        """
+        while True:
+            try:
+                return func(url)
+            except (requests.exceptions.ConnectionError, RetryError) as e:
+                if isinstance(e, RetryError) and not isinstance(e.last_attempt.exception(), requests.exceptions.ConnectionError):
+                    error(f"Couln't get {url}")
+                    return []
+                ntry = ntry - 1
+                if not ntry:
+                    error(f"Couln't get {url}, giving up")
+                    return []
+                warn(f"Got {e}, pausing {urlsplit(url).netloc} for {cooldown_seconds}s, remaining attempts:{ntry}")
+                self.__limiter.pause(url, cooldown_seconds)
+
+    def __store_files(self):
+        """ Record file names found by workers, they are not asked again """
+        new_files, self.__new_files = self.__new_files, []
+        if new_files:
+            Dbs.store_hub_files(new_files)
+            self.__files.update(new_files)
 
     def get_resources_from_author(self, creator, creatoruid=None, cooldown_seconds=60, resource_name=None):
         """
         Get resources links from creator
+        Listing pages are parsed while workers look for the files of resources of previous pages.
+        Once planned, only files missing or newer than those already there are downloaded.
+        Returns list of (file name, crc) of downloaded vars
         """
         resource_found = False
+        failed = False
+        downloaded = []
         if not creatoruid:
             hubname = get_hub_name(creator)
             creator = self.get_creator_uid(hubname or creator)
             if not creator:
-                return
-        for page in range(1,101):
-            url = f"{base_resource_per_author_url}/{creator}/?page={page}"
-
-            try:
-                check_end = self.get(url, allow_redirects=False)
-            except:
-                error(f"Couldn't fetch page {page} for resource of member {creator}")
-                return
-            if check_end.status_code == 303:
-                break
-            info(f"Fetching resources from {url}")
+                return downloaded
+        if self.__files is None:
+            self.__files = Dbs.get_hub_files()
+        submitted = set()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.__jobs, thread_name_prefix="hub") as pool:
             try:
-                page = self.get(url)
-            except:
-                error(f"Couldn't fetch page {page} for resource of member {creator}")
-                return
-
-            bs = BeautifulSoup(page.text, "html.parser")
-            regexp = re.compile(r"/resources/[^/]*/$")
-            links = [ f.get('href') for f in bs.find_all('a', href=True) ]
-            links = list(set([ f[1:] for  f in links if re.match(regexp, f)]))
-            if resource_name:
-                reduced_list = [ l for l in links if resource_name.lower() in l.lower() ]
-                links = reduced_list
-                if links:
-                    resource_found = True
-            idx = 0
-            ntry = 3
-            while idx < len(links) and ntry:
-                try:
-                    self.dl_resource(f"{base_url}/{links[idx]}")
-                    idx = idx + 1
-                except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError) as e:
-                    ntry = ntry - 1
-                    warn(f"Got {e}, waiting {cooldown_seconds}s, remaining attempts:{ntry}")
-                    time.sleep(cooldown_seconds)
-        if resource_name and not resource_found:
-            print(f"Resource {resource_name} not found")
\ No newline at end of file
+                for page in range(1,101):
+                    url = f"{self.__base_url}/resources/authors/{creator}/?page={page}"
+
+                    # Past the last page, the hub redirects with a 303
+                    try:
+                        listing = self.get_page(url, allow_redirects=False)
+                        if listing['status'] == 301:
+                            # Author renamed, the new listing still tells its last page with a 303
+                            listing = self.get_page(urljoin(url, listing['location']), allow_redirects=False)
+                    except:
+                        error(f"Couldn't fetch page {page} for resource of member {creator}")
+                        failed = True
+                        break
+                    if listing['status'] == 303:
+                        break
+                    info(f"Fetching resources from {url}")
+
+                    bs = BeautifulSoup(listing['text'], "html.parser")
+                    regexp = re.compile(r"/resources/[^/]*/$")
+                    links = [ f.get('href') for f in bs.find_all('a', href=True) ]
+                    links = sorted(set([ f[1:] for  f in links if re.match(regexp, f)]))
+                    if resource_name:
+                        reduced_list = [ l for l in links if resource_name.lower() in l.lower() ]
+                        links = reduced_list
+                        if links:
+                            resource_found = True
+                    for link in links:
+                        if link not in submitted:
+                            submitted.add(link)
+                            futures.append(pool.submit(self.retry_host, self.plan_resource, f"{self.__base_url}/{link}", cooldown_seconds))
+                files = [ file for future in futures for file in future.result() ]
+
+                plan = self.plan(files)
+                todo = [ url for url, _, download, _ in plan if download ]
+                print(f"Plan for {creator}: {len(todo)} files to download, {len(plan) - len(todo)} skipped")
+                for _, name, download, reason in plan:
+                    print(f" > {'Download' if download else 'Skip'} {name} ({reason})")
+                if self.__dryrun:
+                    return downloaded
+
+                futures = [ pool.submit(self.retry_host, self.dl_file, url, cooldown_seconds) for url in todo ]
+                for future in futures:
+                    downloaded.extend(future.result())
+            except KeyboardInterrupt:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            finally:
+                self.__store_files()
+        if resource_name and not resource_found and not failed:
+            print(f"Resource {resource_name} not found")
+        return downloaded
@@ -0,0 +1,310 @@
+'''Upload of vars to Internet Archive'''
+import hashlib
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from zipfile import ZipFile
+
+from vamtb.db import Dbs
+from vamtb.file import FileName
+from vamtb.vamex import *
+from vamtb.utils import *
+from vamtb.log import *
+
+# internetarchive is only imported when uploading
+
+def md5f(fname, chunk_size = 1024*1024) -> str:
+    """ md5 of a file, read by chunks """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def upload_item(session, job) -> dict:
+    """
+    Upload files of a var to its item, runs in a worker and doesn't touch the database.
+    Returns the job, its status (uploaded, exists, skipped, failed or error) and the md5 computed as (crc, size, md5)
+    """
+    res = { 'job': job, 'status': "failed", 'md5s': [], 'error': None }
+    try:
+        send_item(session, res)
+    except Exception as e:
+        # Job of the result tells whether overwriting the item was already confirmed
+        res['status'] = "error"
+        res['error'] = e
+    return res
+
+def send_item(session, res):
+    """ Upload job of res, setting its status """
+    job = res['job']
+    item = session.get_item(job['identifier'])
+
+    # Meta only: no overwrite confirmation
+    if not job['meta_only'] and job['confirm'] and (item.exists or not item.identifier_available()):
+        res['status'] = "exists"
+        return
+    # Retries of this job won't ask again
+    job = res['job'] = dict(job, confirm=False)
+
+    if job['meta_only']:
+        if not item.exists:
+            warn("Item does not exists on IA, can't update metadata")
+            return
+        debug(f"Modifying metadata for {job['identifier']}")
+        if job['dry_run']:
+            res['status'] = "uploaded"
+            return
+        # Clear subject
+        resp = item.modify_metadata(metadata = { "subject": "REMOVE_TAG" })
+        if resp:
+            info("Subject and topics cleared")
+        else:
+            warn(f"Subject was not changed: {resp.content}")
+        subjects = job['metadata']['subject']
+        resp = item.modify_metadata(metadata = { "subject": subjects }, append=True)
+        if resp:
+            info(f"Subject and topics set to {subjects}")
+        else:
+            error(f"Subject was not set: {resp.content}")
+        if resp.status_code == 200:
+            res['status'] = "uploaded"
+        return
+
+    uploads = job['scene_files'] + job['files']
+    if job['dry_run']:
+        print(f"Would upload:\n{CR.join([ key for key, _, _ in uploads ])}")
+        res['status'] = "skipped"
+        return
+
+    with ZipFile(job['path']) as z:
+        for i, (key, member, md5) in enumerate(uploads):
+            if member is None:
+                # The var itself
+                if not md5:
+                    md5 = md5f(job['path'])
+                    if job['crc']:
+                        res['md5s'].append((job['crc'], job['size'], md5))
+                body = open(job['path'], 'rb')
+            else:
+                # Only this member is read from the zip
+                zinfo = z.getinfo(member)
+                content = z.read(zinfo)
+                if not md5:
+                    md5 = hashlib.md5(content).hexdigest()
+                    res['md5s'].append(("%08X" % zinfo.CRC, zinfo.file_size, md5))
+                body = io.BytesIO(content)
+            with body:
+                # Same check as internetarchive does with checksum=True
+                ia_file = item.get_file(key)
+                if (not item.tasks) and ia_file and ia_file.md5 == md5:
+                    info(f"{key} already in {job['identifier']}, skipping")
+                    continue
+                # Content-MD5 is checked by IA and avoids hashing again
+                resp = item.upload_file(body,
+                    key = key,
+                    metadata = job['metadata'],
+                    headers = { 'Content-MD5': md5 },
+                    queue_derive = i == len(uploads) - 1,
+                    validate_identifier = True,
+                    verbose = job['verbose'])
+                debug(resp)
+                if resp.status_code not in (200, None):
+                    error(f"Upload of {key} to {job['identifier']} returned {resp.status_code}")
+                    return
+    res['status'] = "uploaded"
+
+class IaMgr:
+    """
+    Upload vars to Internet Archive.
+    Vars are checked against the database in the main thread and uploaded by a pool of workers.
+    Uploaded vars and md5 of files are stored in the database by batches.
+    """
+
+    def __init__(self, jobs = 1, confirm = True, meta_only = False, dry_run = False, full_thumbs = False, only_cc = False, iaprefix = None, retries = 2, session = None):
+        """
+        retries: number of times a var is uploaded again when its upload raised an exception
+        session: internetarchive session, or any object with get_item(identifier)
+        """
+        self.__jobs = jobs
+        self.__confirm = confirm
+        self.__meta_only = meta_only
+        self.__dry_run = dry_run
+        self.__full_thumbs = full_thumbs
+        self.__only_cc = only_cc
+        self.__iaprefix = iaprefix
+        self.__retries = retries
+        self.__session = session
+        # Vars to set as uploaded and md5 to store
+        self.__uploaded = []
+        self.__md5s = []
+        # Uploads of each var which raised an error
+        self.__tries = {}
+
+    def prepare(self, var):
+        """
+        Job to upload var, None if var is not to be uploaded
+        """
+        info(f"Uploading {var.var} [size {toh(var.size)}] to IA")
+        if var.is_uploaded_on_ia:
+            info(f"{var.var} already on IA, not uploading")
+            return None
+
+        license_url = get_license_url(var.license)
+        if not license_url and self.__only_cc:
+            info('License is not CC')
+            return None
+        print(f"Uploading {var}, {int(var.size/1000)/1000}MB")
+
+        types = var.get_resources_type()
+        identifier = ia_identifier(var.varq, self.__iaprefix or IA_IDENTIFIER_PREFIX)
+
+        if not var.exists():
+            critical(f"Var {var.var} is not in the database. Can't upload to IA.")
+            return None
+
+        if not self.__meta_only and var.latest() != var.var:
+            info(f"Not uploading {var.var}, there is a higher version {var.latest()}")
+            self.__uploaded.append(var.var)
+            return None
+
+        if not license_url:
+            warn(f"License is {var.license}, no URL.")
+
+        thumbs = var.get_thumbs()
+        if not thumbs:
+            warn("No thumbs, not uploading.")
+            # Comment this for uploading images not linked to jsons for example
+            return None
+
+        debug(f"var {var.var} contains: {types}")
+        subjects = ['scene'] if "scene" in types else types
+        subjects.extend(IA_BASETAGS)
+
+        md = {
+            'title': var.var,
+            'mediatype' : IA_MEDIATYPE,
+            'collection': IA_COLL,
+            'date': time.strftime("%Y-%m-%d", time.gmtime(var.mtime)),
+            'description': f"<div><i>{var.varq}</i></div><br />",
+            'subject': subjects,
+            'creator': var.creator,
+            'licenseurl': license_url
+        }
+
+        # Files are (key on IA, member of the zip or None for the var, md5 if known)
+        with var.zip() as z:
+            zinfos = { zinfo.filename: zinfo for zinfo in z.infolist() }
+        def member(name, key):
+            zinfo = zinfos[name]
+            return (key, name, Dbs.get_md5("%08X" % zinfo.CRC, zinfo.file_size))
+        scene_thumbs = var.get_scene_thumbs()
+        scene_files = [ member(e, "00-" + Path(e).name) for e in scene_thumbs ]
+        if self.__full_thumbs or not scene_thumbs:
+            files = [ member(e, Path(e).name) for e in thumbs if e not in scene_thumbs ]
+        else:
+            files = []
+        # md5 of the var is only valid while the var on disk is the one in the database
+        crc = var.get_cksum if FileName(var.path).mtime == var.get_modtime else None
+        files.append((Path(var.path).name, None, Dbs.get_md5(crc, var.size) if crc else None))
+
+        return {
+            'var': var.var,
+            'file': var.file,
+            'path': str(var.path),
+            'crc': crc,
+            'size': var.size,
+            'identifier': identifier,
+            'metadata': md,
+            'scene_files': scene_files,
+            'files': files,
+            'meta_only': self.__meta_only,
+            'confirm': self.__confirm,
+            'dry_run': self.__dry_run,
+            # Progress bars of concurrent uploads would mix
+            'verbose': self.__jobs == 1,
+        }
+
+    def upload(self, vars) -> int:
+        """
+        Upload vars, returns the number of vars uploaded.
+        vars can be a generator, each var is prepared before the next one is opened.
+        Results are handled as they come, while next vars are prepared.
+        """
+        if self.__session is None:
+            from internetarchive import get_session
+            self.__session = get_session()
+        n_up = 0
+        with ThreadPoolExecutor(max_workers=self.__jobs, thread_name_prefix="ia") as pool:
+            pending = set()
+            def submit(job):
+                pending.add(pool.submit(upload_item, self.__session, job))
+            def collect(timeout):
+                """ Handle uploads finished within timeout, None waits for one """
+                nonlocal n_up
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    res = future.result()
+                    job = self.result(res)
+                    if job:
+                        submit(job)
+                    elif res['status'] == "uploaded":
+                        n_up += 1
+                if len(self.__uploaded) + len(self.__md5s) >= C_COMMIT_INTERVAL:
+                    self.store()
+            try:
+                for var in vars:
+                    try:
+                        job = self.prepare(var)
+                    except Exception as e:
+                        error(f"Var {var.var} could not be uploaded to Internet Archive., error is:\n{e}")
+                        continue
+                    if job:
+                        submit(job)
+                    # No more than two jobs waiting per worker
+                    collect(None if len(pending) >= 2 * self.__jobs else 0)
+                while pending:
+                    collect(None)
+            except KeyboardInterrupt:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            finally:
+                self.store()
+        return n_up
+
+    def result(self, res):
+        """
+        Record result of a worker, returns the job to submit again once confirmed or after an error
+        """
+        job = res['job']
+        self.__md5s.extend(res['md5s'])
+        if res['status'] == "error":
+            self.__tries[job['var']] = self.__tries.get(job['var'], 0) + 1
+            if self.__tries[job['var']] <= self.__retries:
+                warn(f"Upload of {job['var']} failed, retrying: {res['error']}")
+                return job
+            error(f"Var {job['var']} could not be uploaded to Internet Archive., error is:\n{res['error']}")
+            return None
+        if res['status'] == "uploaded":
+            if not job['meta_only']:
+                print(f"Var file url is https://archive.org/download/{ia_identifier(job['var'])}/{job['file']}")
+                self.__uploaded.append(job['var'])
+            info(f"Var {job['var']} uploaded successfully to Internet Archive.")
+            return None
+        if res['status'] == "exists":
+            self.__uploaded.append(job['var'])
+            if input(f"Item {job['var']} exists, update if different Y [N] ? ").upper() == "Y":
+                return dict(job, confirm=False)
+        info(f"Var {job['var']} was not uploaded to Internet Archive.")
+        return None
+
+    def store(self):
+        """ Store uploaded vars and md5 gathered so far """
+        if self.__uploaded:
+            Dbs.set_uploaded(self.__uploaded, "IA")
+            self.__uploaded = []
+        if self.__md5s:
+            Dbs.store_md5s(self.__md5s)
+            self.__md5s = []
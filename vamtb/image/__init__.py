@@ -0,0 +1,320 @@
+'''Image optimization of vars'''
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+from multiprocessing import Pool
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+import PIL
+from PIL import Image, ImageFile
+
+from vamtb.var import Var
+from vamtb.vamex import *
+from vamtb.utils import *
+from vamtb.log import *
+
+# Only images bigger than this are optimized
+C_IMAGE_MINSIZE = 1024*1024*5
+# Members never holding texture references
+C_NOJSON_EXT = (".vmi", ".vam", ".vab", ".assetbundle", ".scene", ".tif", ".jpg", ".png", ".dll")
+
+class ImageCache:
+    """
+    Results of image optimization, addressed by sha1 of the source image, optimization level and Pillow version.
+    An entry is either the optimized image or the reason why the image is kept as is.
+    Least recently used entries are evicted when the cache is bigger than maxsize MB.
+    """
+
+    def __init__(self, dir = C_IMGCACHE, maxsize = C_IMGCACHE_SIZE):
+        self.__dir = dir
+        self.__maxsize = maxsize * 1024 * 1024
+
+    @property
+    def dir(self):
+        return self.__dir
+
+    @staticmethod
+    def key(content, optlevel) -> str:
+        return f"{hashlib.sha1(content).hexdigest()}-{optlevel}-{PIL.__version__}"
+
+    def __path(self, key, kind) -> Path:
+        return Path(self.__dir, key[0:2], f"{key}.{kind}")
+
+    def get(self, key):
+        """
+        Returns (optimized image, None) or (None, reason) or None if not cached
+        """
+        for kind in ("img", "skip"):
+            path = self.__path(key, kind)
+            try:
+                with open(path, "rb") as f:
+                    content = f.read()
+            except FileNotFoundError:
+                continue
+            # Used now
+            os.utime(path)
+            return (content, None) if kind == "img" else (None, content.decode('utf-8'))
+        return None
+
+    def put(self, key, data = None, msg = None):
+        path = self.__path(key, "img" if data else "skip")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmpfd, tmpname = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(tmpfd, "wb") as f:
+            f.write(data if data else msg.encode('utf-8'))
+        os.replace(tmpname, path)
+
+    def evict(self):
+        if not os.path.exists(self.__dir):
+            return
+        entries = []
+        for root, _, files in os.walk(self.__dir):
+            for file in files:
+                st = os.stat(os.path.join(root, file))
+                entries.append((st.st_mtime, st.st_size, os.path.join(root, file)))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.__maxsize:
+                break
+            debug(f"Evicting {path} from image cache")
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def opt_image(job):
+    """
+    Worker side of imageopt: encode one image member of a var
+        1 (1-bit pixels, black and white, stored with one pixel per byte)
+        L (8-bit pixels, black and white)
+        P (8-bit pixels, mapped to any other mode using a color palette)
+        RGB (3x8-bit pixels, true color)
+        RGBA (4x8-bit pixels, true color with transparency mask)
+    Returns dict with new member name and content, content is None when image is left untouched (msg tells why)
+    """
+    varpath, member, optlevel, cachedir = job
+    res = { 'varpath': varpath, 'member': member, 'optlevel': optlevel, 'newmember': member, 'data': None, 'osize': 0, 'nsize': 0, 'msg': None }
+    ImageFile.MAXBLOCK = 2**20
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    try:
+        with ZipFile(varpath) as z:
+            content = z.read(member)
+    except (OSError, BadZipFile) as e:
+        res['msg'] = f"Image {member} could not be read: {e}"
+        return res
+    res['osize'] = len(content)
+    if optlevel:
+        res['newmember'] = Path(member).with_suffix(".jpg").as_posix()
+
+    cache = ImageCache(cachedir) if cachedir else None
+    if cache:
+        key = ImageCache.key(content, optlevel)
+        cached = cache.get(key)
+        if cached:
+            res['data'], res['msg'] = cached
+            if res['data']:
+                res['nsize'] = len(res['data'])
+            else:
+                res['newmember'] = member
+            return res
+
+    try:
+        res['data'], res['msg'] = encode_image(content, member, res['newmember'], optlevel)
+    except Exception as e:
+        # Corrupt or unsupported image, the var keeps it
+        res['newmember'] = member
+        res['msg'] = f"Image {member} could not be optimized: {e}"
+        return res
+    if res['data']:
+        res['nsize'] = len(res['data'])
+    else:
+        res['newmember'] = member
+    if cache:
+        cache.put(key, res['data'], res['msg'])
+    return res
+
+def encode_image(content, member, newmember, optlevel):
+    """
+    Returns (optimized image, None) or (None, reason to keep image)
+    """
+    picture = Image.open(io.BytesIO(content))
+    if optlevel:
+        if picture.mode in ("RGBA", "P", "I"):
+            # Heuristics on Normal / Decal having transparency is flawed as creator don't use them properly
+            # Never convert I to RGB
+            return None, f"Image {member} is of mode {picture.mode}, not converted"
+        jpeg_qual = 90 if optlevel == 1 else 75
+        format = "JPEG"
+    else:
+        jpeg_qual = "keep"
+        format = picture.format
+
+    out = io.BytesIO()
+    picture.save(out, format = format, optimize = True, quality = jpeg_qual, compress_level=9, progressive=False)
+    if newmember == member and out.tell() >= len(content):
+        return None, f"Image {member} is not smaller once optimized, kept"
+    return out.getvalue(), None
+
+class ImageMgr:
+    """
+    Optimize images of vars: candidates of all vars are encoded by a pool of workers,
+    then each var gets its references rewritten and is written in one pass
+    """
+
+    def __init__(self, optlevel = 0, jobs = 1, cache = None):
+        self.__optlevel = optlevel
+        self.__jobs = jobs
+        self.__cache = cache
+
+    def json_members(self, var):
+        """ Yield (member, content) of json files of var which can reference images """
+        for file in var.files():
+            if file.path.suffix in C_NOJSON_EXT:
+                continue
+            try:
+                content = file.read().decode('utf-8')
+                _ = json.loads(content)
+            except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+                continue
+            yield var.ziprel(file.path), content
+
+    def candidates(self, var) -> list:
+        """
+        Images referenced by json files of var which are worth optimizing
+        optlevel: 0 => lossless
+        optlevel: 1 => convert to 90% Jpg
+        optlevel: 2 => convert to 75% Jpg
+        """
+        if self.__optlevel:
+            pattern = re.compile(r'(".+") : (?:"SELF:/(.+(?:jpg|png)))', re.IGNORECASE)
+        else:
+            pattern = re.compile(r'(".+") : (?:"SELF:/(.+(?:png)))', re.IGNORECASE)
+        with var.zip() as z:
+            sizes = { zinfo.filename: zinfo.file_size for zinfo in z.infolist() }
+        jobs = {}
+        for member, content in self.json_members(var):
+            debug(f"> Searching for images in {green(member)}")
+            for m in re.finditer(pattern, content):
+                # Don't optimize images already seen
+                if m.group(2) in jobs:
+                    continue
+                debug(f">> {m.group(1)} image {m.group(2)} ")
+                if m.group(2) not in sizes:
+                    error(f"Var references inexisting file {m.group(2)} ")
+                    jobs[m.group(2)] = None
+                    continue
+                if sizes[m.group(2)] <= C_IMAGE_MINSIZE:
+                    jobs[m.group(2)] = None
+                    continue
+                # Logic is flawed as creator don't use them properly it seems.
+                # Alpha is sometimes used on Spec / GLoss rather than Decal
+                # We still avoid Normals
+                l_optlevel = 0 if "Normal" in m.group(1) else self.__optlevel
+                debug(f">> size {toh(sizes[m.group(2)])}, loss_level={l_optlevel}")
+                jobs[m.group(2)] = (str(var.path), m.group(2), l_optlevel, self.__cache.dir if self.__cache else None)
+        return [ job for job in jobs.values() if job ]
+
+    def optimize(self, vars) -> int:
+        """
+        Optimize images of all vars, returns number of new vars
+        """
+        vars = { str(var.path): var for var in vars }
+        jobs = []
+        pending = {}
+        for varpath, var in vars.items():
+            var_jobs = self.candidates(var)
+            if var_jobs:
+                pending[varpath] = len(var_jobs)
+                jobs.extend(var_jobs)
+        info(f"{len(jobs)} images to optimize in {len(pending)} vars with {self.__jobs} workers")
+
+        results = { varpath: [] for varpath in pending }
+        nvars = 0
+        pool = None
+        if self.__jobs > 1 and len(jobs) > 1:
+            pool = Pool(min(self.__jobs, len(jobs)))
+            iterator = pool.imap_unordered(opt_image, jobs)
+        else:
+            iterator = map(opt_image, jobs)
+        try:
+            for res in iterator:
+                if res['msg']:
+                    info(res['msg'])
+                else:
+                    persize = int(100*(1-res['nsize']/res['osize']))
+                    info(f"Level {res['optlevel']} - {red(str(persize)+'% less')}\n{green(res['member']+'->'+res['newmember'])}")
+                results[res['varpath']].append(res)
+                pending[res['varpath']] -= 1
+                if not pending[res['varpath']]:
+                    # All images of var are done, write it now
+                    if self.write_var(vars[res['varpath']], results.pop(res['varpath'])):
+                        nvars += 1
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            if self.__cache:
+                self.__cache.evict()
+        return nvars
+
+    def write_var(self, var, results) -> bool:
+        """
+        Create optimized var from results of workers
+        """
+        results = [ res for res in results if res['data'] ]
+        if not results:
+            info(f"Nothing optimized in {var.var}")
+            return False
+
+        replace = {}
+        delete = []
+        renamed = {}
+        for res in results:
+            replace[res['newmember']] = res['data']
+            if res['newmember'] != res['member']:
+                delete.append(res['member'])
+                renamed[res['member']] = res['newmember']
+
+        if renamed:
+            print(green("Some file types got changed, updating var..."))
+            # An image might be referenced in multiple places, rewrite all json in one pass
+            for member, content in self.json_members(var):
+                new_content = content
+                for src, dst in renamed.items():
+                    new_content = new_content.replace(src, dst)
+                if new_content != content:
+                    debug(f"Replaced images in {member}")
+                    replace[member] = new_content.encode('utf-8')
+
+        sopt_level={0: "tc_lossless", 1: "tc_nearlossless", 2: "tc_good"}
+        nresource = f"{var.resource}_{sopt_level[self.__optlevel]}"
+        nvar = f"{var.creator}.{nresource}.{var.version}"
+
+        # Create new var
+        new_var = Var(nvar, dir = var.addondir, use_db=True, check_exists=False, check_file_exists=False)
+        new_var._path = Path(var.addondir, f"{nvar}.var")
+
+        ometa = var.meta()
+        ometa['packageName'] = nresource
+        replace['meta.json'] = prettyjson(ometa).encode('utf-8')
+
+        zip_rewrite(var.path, new_var.path, replace=replace, delete=delete, comment=f"Repacked on {datetime.now().strftime('%Y%m%dT%H%M%S')}".encode('ascii'))
+
+        #Check it
+        res = ZipFile(new_var.path).testzip()
+        if res != None:
+            critical(f"Warning, reconstructed zip {new_var.path} has CRC problem on file {res}.")
+
+        warn(f"Modified {new_var.path}")
+        new_var.store_update(confirm=False)
+        info(f"Updated DB for {new_var.var}")
+
+        osize = var.size
+        nsize = new_var.size
+        persize = int(100*(1-nsize/osize))
+        warn(f"{toh(osize)}->{toh(nsize)}: {persize}% less")
+        return True
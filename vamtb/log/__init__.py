@@ -1,6 +1,7 @@
 import colorama
 import logging
 import sys
+from multiprocessing import parent_process
 
 class __Color:
     
@@ -86,7 +87,8 @@ class Log():
         logger = logging.getLogger("vamtb")
         logger.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        self.__fh = logging.FileHandler("log-vamtb.txt", mode="w")
+        # Worker processes (dbscan -w) must not truncate the log of their parent
+        self.__fh = logging.FileHandler("log-vamtb.txt", mode="w" if parent_process() is None else "a")
         self.__fh.setFormatter(formatter)
         self.__fh.setLevel(logging.DEBUG)
         logger.addHandler(self.__fh)
@@ -2,7 +2,6 @@ from vamtb import vamex
 from zipfile import ZipFile
 import os
 import shutil
-from jinja2 import Environment, FileSystemLoader
 from pathlib import Path
 from vamtb.log import *
 from vamtb.utils import *
@@ -117,6 +116,7 @@ def prep_tree(file, dir, creator, do_move = False):
 def gen_meta(**kwargs):
     global TPL_BASE
 
+    from jinja2 import Environment, FileSystemLoader
     file_loader = FileSystemLoader(TPL_BASE)
     env = Environment(loader=file_loader)
     template = env.get_template('meta.json.j2')
@@ -0,0 +1,183 @@
+'''Parallel var scanning'''
+import os
+import re
+from multiprocessing import Pool
+from pathlib import Path
+from tqdm import tqdm
+
+from vamtb.db import Dbs
+from vamtb.varfile import VarFile
+from vamtb.var import Var
+from vamtb.file import FileName
+from vamtb.vamex import *
+from vamtb.utils import *
+from vamtb.log import *
+
+def scan_var(job):
+    """
+    Worker side of dbscan: extract, hash and parse dependencies of one var.
+    Never touches the database, result is sent back to the writer.
+    """
+    varfile, dir, with_crc = job
+    res = { 'varfile': varfile, 'var': Path(varfile).stem, 'fsize': 0, 'crc': None, 'rows': None, 'error': None }
+    try:
+        with Var(varfile, dir, check_exists=False) as var:
+            res['var'] = var.var
+            res['fsize'] = var.fsize
+            try:
+                if with_crc:
+                    res['crc'] = var.crc
+                var.check()
+                res['rows'] = var._var_rows()
+            except VarMalformed as e:
+                res['error'] = f"Var {var.var} malformed: {e.args[0]}"
+            except NoMetaJson:
+                res['error'] = f"Var {var.var} malformed: no meta found"
+            except VarMetaJson as e:
+                res['error'] = f"Var {var.var} has something wrong in meta: {e.args[0]}"
+    except Exception as e:
+        # Corrupt zip, unreadable file...: only this var fails
+        res['error'] = f"Var {res['var']} could not be scanned: {type(e).__name__}: {e}"
+    return res
+
+class ScanMgr:
+
+    def __init__(self, dir, jobs = 1, confirm = True, progress = False):
+        self.__dir = dir
+        self.__jobs = jobs
+        self.__confirm = confirm
+        self.__progress = progress
+
+    def msg(self, message):
+        if self.__progress:
+            tqdm.write(red(message))
+        else:
+            error(message)
+
+    def todo(self, vars_list):
+        """
+        Select vars which need a scan, the rest is already in DB with same modtime
+        Returns list of jobs for scan_var
+        """
+        jobs = []
+        for varfile in vars_list:
+            var = VarFile(varfile, use_db=True)
+            with_crc = False
+            if var.exists():
+                debug(f"{var.var} already in database")
+                if FileName(varfile).mtime == var.get_modtime:
+                    info("Same modtime")
+                    continue
+                info("Database is not inline.")
+                with_crc = self.__confirm
+            jobs.append((str(varfile), self.__dir, with_crc))
+        return jobs
+
+    def entries(self, dir):
+        """
+        Files in dir and its subdirectories, vars sorted by creator are not considered removed
+        """
+        with os.scandir(dir) as it:
+            for entry in it:
+                if entry.is_dir():
+                    yield from self.entries(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+    def changed(self, pattern):
+        """
+        Compare (size, modtime) of vars on disk with VARS in one listing and one query
+        Returns vars on disk which are new or changed and vars in DB which were removed from disk
+        """
+        repat = re.compile(fr"{pattern}", flags=re.IGNORECASE)
+        dbsig = { varname: (size, mtime) for varname, size, mtime in Dbs.fetchall("SELECT VARNAME, SIZE, MODIFICATION_TIME FROM VARS", None) }
+        todo = []
+        ondisk = set()
+        for entry in self.entries(self.__dir):
+            if not repat.match(entry.name):
+                continue
+            varname = Path(entry.name).with_suffix("").name
+            ondisk.add(varname)
+            st = entry.stat()
+            if dbsig.get(varname) == (st.st_size, st.st_mtime):
+                continue
+            todo.append(Path(entry.path))
+        removed = sorted([ varname for varname in dbsig if varname not in ondisk and repat.match(f"{varname}.var") ], key=str.casefold)
+        info(f"{len(todo)} new or changed vars, {len(removed)} removed vars, {len(ondisk) - len(todo)} unchanged vars")
+        return todo, removed
+
+    def remove(self, removed) -> int:
+        """
+        Remove from DB vars which are not on disk anymore
+        """
+        nremoved = 0
+        for varname in removed:
+            print(f"Var {red(varname)} is in DB but not on disk  ")
+            if not self.__confirm or input("Delete from DB: Y [N] ?").upper() == "Y":
+                var = VarFile(varname, use_db=True)
+                var.db_delete()
+                var.db_commit()
+                info(f"Removed {varname} from DB")
+                nremoved += 1
+        return nremoved
+
+    def store(self, res) -> bool:
+        """
+        Writer side of dbscan: insert worker result in DB
+        """
+        var = VarFile(res['var'], use_db=True)
+        if var.exists():
+            if self.__confirm:
+                if res['crc'] == var.get_cksum:
+                    # Checksums are same, only modtime differ, update db without asking
+                    info("Same checksum")
+                else:
+                    choice = input(blue(f"Remove older DB for {res['varfile']} [Y]N  ?"))
+                    if choice and choice != "Y":
+                        return False
+        try:
+            with var.db_transaction():
+                if var.exists():
+                    var.db_delete()
+                var._store_rows(res['rows'])
+        except Exception as e:
+            # Rolled back alone, other vars go on
+            self.msg(f"Var {res['var']} could not be stored: {type(e).__name__}: {e}")
+            return False
+        return True
+
+    def scan(self, vars_list) -> int:
+        """
+        Scan vars with a pool of worker processes, this process being the only DB writer
+        """
+        stored = 0
+        jobs = self.todo(vars_list)
+        info(f"{len(jobs)} vars to scan out of {len(vars_list)} with {self.__jobs} workers")
+        pool = None
+        if self.__jobs > 1 and len(jobs) > 1:
+            pool = Pool(min(self.__jobs, len(jobs)))
+            results = pool.imap_unordered(scan_var, jobs)
+        else:
+            results = map(scan_var, jobs)
+        if self.__progress:
+            iterator = tqdm(results, total=len(vars_list), initial=len(vars_list) - len(jobs), desc="Writing database…", ascii=True, maxinterval=3, ncols=75, unit='var',
+                            bar_format="{percentage:3.0f}%| {n_fmt}/{total_fmt} | {postfix[0][fn]:<90.90} [{postfix[0][fn2]:>10.10} ] | [{elapsed}<{remaining}, {rate_fmt}]",
+                            postfix=[{"fn": "str", "fn2": "str"}])
+        else:
+            iterator = results
+        try:
+            for res in iterator:
+                info(f"Scanned {res['var']}")
+                if self.__progress:
+                    iterator.postfix[0]["fn"] = f"{res['var']}"
+                    iterator.postfix[0]["fn2"] = f"{int(res['fsize']/1024/1024*10)/10}MB"
+                if res['error']:
+                    self.msg(res['error'])
+                elif self.store(res):
+                    stored += 1
+        finally:
+            Dbs.commit()
+            if pool:
+                pool.terminate()
+                pool.join()
+        return stored
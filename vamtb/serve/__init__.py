@@ -0,0 +1,178 @@
+'''Local query server keeping database and dependency graph in memory'''
+import json
+import os
+import signal
+import sys
+
+from vamtb.db import Dbs
+from vamtb.depgraph import DepGraph
+from vamtb.vamex import *
+from vamtb.utils import *
+from vamtb.log import *
+
+# http.server and urllib are only imported when serving or when a server is running
+
+# DepGraph methods answered by the server
+C_SERVE_DEPGRAPH = ("resolve", "exists", "size", "license", "deps", "rdeps", "rdeps_many", "walk", "cycles", "closure", "treedown")
+# Exceptions forwarded to the client
+C_SERVE_EXCEPTIONS = { e.__name__: e for e in (VarNotFound, VarNameNotCorrect, VarExtNotCorrect) }
+
+class QueryServer:
+    """
+    Answers queries of vamtb commands on 127.0.0.1, as json.
+    The dependency graph is rebuilt when another process modified the database.
+    Listening port and pid are written in C_SERVE_STATE while serving.
+    """
+
+    def __init__(self, port = 0):
+        self.__port = port
+        self.__depgraph = None
+        self.__data_version = None
+
+    def depgraph(self) -> DepGraph:
+        data_version = Dbs.getConn().execute("PRAGMA data_version").fetchone()[0]
+        if self.__depgraph is None or data_version != self.__data_version:
+            info("Loading dependency graph")
+            self.__depgraph = DepGraph()
+            self.__data_version = data_version
+        return self.__depgraph
+
+    def latest(self, name, dir):
+        from vamtb.var import Var
+        with Var(name, dir, use_db=True) as var:
+            return str(var.path)
+
+    def call(self, method, args):
+        """ Run method, result must be json serializable """
+        if method == "ping":
+            return { 'pid': os.getpid() }
+        if method == "latest":
+            return self.latest(*args)
+        if method.startswith("depgraph."):
+            method = method[len("depgraph."):]
+            if method in C_SERVE_DEPGRAPH:
+                res = getattr(self.depgraph(), method)(*args)
+                # walk is a generator
+                return list(res) if method == "walk" else res
+        raise ValueError(f"Unknown method {method}")
+
+    def serve(self):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                    debug(f"Query {query}")
+                    answer = { 'result': server.call(query['method'], query.get('args', [])) }
+                except (Exception, OneParamException) as e:
+                    # Var exceptions derive from BaseException, they are forwarded too
+                    answer = { 'error': type(e).__name__, 'message': str(e.args[0]) if e.args else "" }
+                content = json.dumps(answer).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                debug(format % args)
+
+        # Single threaded: the sqlite connection stays in this thread
+        httpd = HTTPServer(("127.0.0.1", self.__port), Handler)
+        port = httpd.server_address[1]
+        self.depgraph()
+        with open(C_SERVE_STATE, "w") as f:
+            json.dump({ 'pid': os.getpid(), 'port': port }, f)
+        print(green(f"Serving on 127.0.0.1:{port}, Ctrl-C to stop"))
+        # Killed server also removes its state file
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            try:
+                os.unlink(C_SERVE_STATE)
+            except FileNotFoundError:
+                pass
+
+class QueryClient:
+    """
+    Forwards queries to a running QueryServer
+    """
+
+    def __init__(self, port):
+        self.__url = f"http://127.0.0.1:{port}/"
+
+    @staticmethod
+    def running():
+        """ Client of the running server or None """
+        try:
+            with open(C_SERVE_STATE, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        import http.client
+        try:
+            client = QueryClient(state['port'])
+            # Port may have been reused by another service
+            if client.call("ping", timeout=1)['pid'] != state['pid']:
+                raise ValueError("Not our server")
+        except (OSError, ValueError, TypeError, KeyError, ServerError, http.client.HTTPException):
+            debug(f"Server in {C_SERVE_STATE} is not running")
+            return None
+        debug(f"Forwarding queries to server on port {state['port']}")
+        return client
+
+    def call(self, method, *args, timeout=None):
+        import urllib.request
+        req = urllib.request.Request(self.__url, data=json.dumps({ 'method': method, 'args': args }).encode('utf-8'),
+                                     headers={ "Content-Type": "application/json" })
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            answer = json.loads(resp.read())
+        if 'error' in answer:
+            if answer['error'] in C_SERVE_EXCEPTIONS:
+                raise C_SERVE_EXCEPTIONS[answer['error']](answer['message'])
+            raise ServerError(f"{answer['error']}: {answer['message']}")
+        return answer['result']
+
+    def latest(self, name, dir):
+        return self.call("latest", name, os.path.abspath(dir))
+
+class RemoteDepGraph:
+    """
+    DepGraph answered by the server
+    """
+
+    def __init__(self, client):
+        self.__client = client
+
+    def __getattr__(self, method):
+        if method not in C_SERVE_DEPGRAPH:
+            raise AttributeError(method)
+        def call(*args):
+            res = self.__client.call(f"depgraph.{method}", *args)
+            if method == "walk":
+                return [ tuple(e) for e in res ]
+            return res
+        return call
+
+def open_depgraph():
+    """
+    Dependency graph of the running server, loaded from database otherwise
+    """
+    client = QueryClient.running()
+    return RemoteDepGraph(client) if client else DepGraph()
+
+def reverse_deps(names):
+    """
+    Yields (name, rdeps) of each var, answered by the running server or from the database
+    """
+    client = QueryClient.running()
+    if client:
+        yield from zip(names, RemoteDepGraph(client).rdeps_many(names))
+    else:
+        yield from DepGraph.rdeps_db(names)
@@ -3,6 +3,8 @@ import re
 import os
 import zipfile
 import binascii
+import copy
+import struct
 import sys
 import errno
 import ctypes
@@ -22,6 +24,10 @@ file_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 # Constants
 C_YAML = os.path.join(exec_dir, "vamtb.yml")
 C_DB = os.path.join(exec_dir, "vars.db")
+C_DIRINDEX = os.path.join(exec_dir, "dirindex.json")
+C_IMGCACHE = os.path.join(exec_dir, "imgcache")
+C_HUBCACHE = os.path.join(exec_dir, "hubcache")
+C_SERVE_STATE = os.path.join(exec_dir, "serve.json")
 C_DDIR = os.path.join(exec_dir, "graph")
 C_TMPDIR = os.path.join(exec_dir, "tmp")
 #C_LOG = exec_dir + "/" + "log-vamtb.txt"  # circular dep (util relies on log which can't rely on util)
@@ -160,6 +166,24 @@ creator2hub = {
     "AcidBubbles": "Acid Bubbles"
 }
 
+# Members which are json and get normalized before computing their checksum
+C_JSON_EXT = (".json", ".vmi", ".vaj", ".vap", ".vam")
+
+# Vars written by dbscan between two commits
+C_COMMIT_INTERVAL = 200
+
+# Parameters of one query, older sqlite are limited to 999
+C_DB_CHUNK = 500
+
+# Requests per second to the hub
+C_HUB_RATE = 2
+
+# Seconds during which cached hub pages are used without asking the hub
+C_HUBCACHE_TTL = 3600
+
+# Size of optimized images cache in MB
+C_IMGCACHE_SIZE = 2048
+
 C_NEXT_CREATOR = 127
 C_DOT = "c:\\Graphviz\\bin\\dot.exe"
 C_MAX_FILES = 50
@@ -237,6 +261,14 @@ def crc32c(content):
     buf = (binascii.crc32(content) & 0xFFFFFFFF)
     return "%08X" % buf
 
+def crc32f(fname, chunk_size=1024*1024):
+    """crc32c of a file content, read by chunks"""
+    buf = 0
+    with open(fname, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            buf = binascii.crc32(chunk, buf)
+    return "%08X" % (buf & 0xFFFFFFFF)
+
 def zipdir(path, zipname):
     debug("Repacking var...")
     with zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED) as zipf:
@@ -248,6 +280,80 @@ def zipdir(path, zipname):
                         os.path.relpath(os.path.join(root, file), 
                                         os.path.join(path, '.')))
 
+# zipfile internals used to copy members verbatim, they may change between python versions
+C_ZIP_INTERNALS = ("_strip_extra", "_FH_FILENAME_LENGTH", "_FH_EXTRA_FIELD_LENGTH", "structFileHeader", "sizeFileHeader")
+C_ZIPFILE_INTERNALS = ("_lock", "start_dir", "_didModify", "fp", "filelist", "NameToInfo")
+
+def zip_can_copy_raw(zout) -> bool:
+    return all(hasattr(zipfile, e) for e in C_ZIP_INTERNALS) and all(hasattr(zout, e) for e in C_ZIPFILE_INTERNALS)
+
+def zip_copy_member(zin, zout, zinfo, chunk_size=1024*1024):
+    """
+    Copy member zinfo of zin to zout without decompressing it
+    Falls back to decompressing and compressing it again when zipfile internals are not there
+    """
+    if not zip_can_copy_raw(zout):
+        debug(f"Recompressing {zinfo.filename}, zipfile can't copy it verbatim")
+        zout.writestr(copy.copy(zinfo), zin.read(zinfo))
+        return
+    zinfo = copy.copy(zinfo)
+    src_offset = zinfo.header_offset
+    # Encrypted data is checked against the modification time when there is a data descriptor: it stays
+    descriptor = zinfo.flag_bits & 0x01 and zinfo.flag_bits & 0x08
+    # Otherwise sizes are known: no data descriptor after data, and zip64 record is rebuilt by FileHeader
+    if not descriptor:
+        zinfo.flag_bits &= ~0x08
+    zinfo.extra = zipfile._strip_extra(zinfo.extra, (1, ))
+    zin.fp.seek(src_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+    zin.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    with zout._lock:
+        zout.fp.seek(zout.start_dir)
+        zinfo.header_offset = zout.fp.tell()
+        zout.fp.write(zinfo.FileHeader())
+        remain = zinfo.compress_size
+        while remain > 0:
+            data = zin.fp.read(min(chunk_size, remain))
+            if not data:
+                raise zipfile.BadZipFile(f"Truncated member {zinfo.filename}")
+            zout.fp.write(data)
+            remain -= len(data)
+        if descriptor:
+            zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+            zout.fp.write(struct.pack("<4sLQQ" if zip64 else "<4sLLL", b"PK\x07\x08", zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        zout.filelist.append(zinfo)
+        zout.NameToInfo[zinfo.filename] = zinfo
+        zout.start_dir = zout.fp.tell()
+        zout._didModify = True
+
+def zip_rewrite(src, dst, replace = None, delete = (), comment = None):
+    """
+    Write zip dst from zip src
+    Members in replace (name: bytes) are compressed again, new names are added at the end, members in delete are dropped (even if in replace)
+    All other members are copied verbatim, without decompressing/compressing them
+    Directory entries left empty are dropped
+    """
+    delete = set(delete)
+    # A member both replaced and deleted is deleted
+    replace = { name: data for name, data in (replace or {}).items() if name not in delete }
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED) as zout:
+        zout.comment = zin.comment if comment is None else comment
+        kept = [ zinfo for zinfo in zin.infolist() if zinfo.filename not in delete ]
+        names = [ zinfo.filename for zinfo in kept if not zinfo.is_dir() ] + list(replace)
+        for zinfo in kept:
+            if zinfo.is_dir():
+                if not any(name.startswith(zinfo.filename) for name in names):
+                    debug(f"Dropping empty directory {zinfo.filename}")
+                    continue
+                zip_copy_member(zin, zout, zinfo)
+            elif zinfo.filename in replace:
+                zout.writestr(zinfo.filename, replace.pop(zinfo.filename))
+            else:
+                # Encrypted members too, they are never decrypted
+                zip_copy_member(zin, zout, zinfo)
+        for name, data in replace.items():
+            zout.writestr(name, data)
+
 def toh(val: int) ->str:
     if val > 1024 * 1024 * 1024:
         return f"{round(val/(1024*1024*1024), 3)}GB"
@@ -395,27 +501,51 @@ def replace_json(fname, key, newvalue):
     with open(fname, 'w') as file:
         json.dump(json_data, file, indent=2)
 
-def dep_fromjson(json_file, json_content = None, Full=False):
-
-    def _decode_dict(a_dict):
-        for id, ref in a_dict.items():  # pylint: disable=unused-variable
-#            if id in ['id', 'uid', "url"]:
-            if type(ref) == str:
-                if ref.startswith("SELF:"):
-                    deps['self'].append(ref)
-                elif ":" in ref[1:]:
-                    name = ref.split(':')[0]
-                    ndot = len(name.split('.'))
-                    if ndot == 3:
-                        deps['var'].append(ref)
-                elif any(ref.endswith(s) for s in ['.vmi', ".vam", ".vap", ".json"]):
-                    deps['embed'].append(ref)
+# A json string literal, and its value when it is an object key with a string value
+C_JSON_STRPAIR = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"(?:\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)")?', re.DOTALL)
+C_EMBED_EXT = ('.vmi', ".vam", ".vap", ".json")
+
+def json_unescape(s):
+    return json.loads(f'"{s}"') if '\\' in s else s
+
+def json_refpairs(text):
+    """
+    Yield (key, value) of object members, at any depth, whose string value may be a reference:
+    a var or SELF link (holding ":/") or an embedded file.
+    Objects are never built: quotes only appear in string literals so matching literals
+    from the start of a valid json never gets out of sync.
+    """
+    # var and SELF links hold ":/", which json may write ":\/"
+    if ":/" not in text and ":\\/" not in text and not any(s in text for s in C_EMBED_EXT):
+        return
+    for m in C_JSON_STRPAIR.finditer(text):
+        value = m.group(2)
+        if value is None:
+            continue
+        if '\\' in value:
+            value = json_unescape(value)
+        if ":/" in value or value.endswith(C_EMBED_EXT):
+            yield json_unescape(m.group(1)), value
 
+def dep_fromjson(json_file, json_content = None, Full=False):
     deps = { 'embed': [], 'var': [] , 'self': [] }
     if json_file:
         with open(json_file, "r", encoding='utf-8') as fn:
-            json.load(fn, object_hook=_decode_dict)
-    elif json_content:
-        json.loads(json_content, object_hook=_decode_dict)
+            json_content = fn.read()
+    if not json_content:
+        return deps
+
+    for id, ref in json_refpairs(json_content):  # pylint: disable=unused-variable
+#        if id in ['id', 'uid', "url"]:
+        # Same rules as FileName.jsonDeps: links hold ":/"
+        if ref.startswith("SELF:/"):
+            deps['self'].append(ref)
+        elif ":/" in ref[1:]:
+            name = ref.split(':')[0]
+            ndot = len(name.split('.'))
+            if ndot == 3:
+                deps['var'].append(ref)
+        elif any(ref.endswith(s) for s in C_EMBED_EXT):
+            deps['embed'].append(ref)
 
     return deps
\ No newline at end of file
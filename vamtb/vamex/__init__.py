@@ -120,5 +120,13 @@ class HubResponse(Exception):
     def __init__(self):
         super().__init__("HubResponse")
 
+class ServerError(Exception):
+    """Exception raised when vamtb server fails to answer a query.
+
+    """
+
+    def __init__(self, message):
+        super().__init__(message, "ServerError")
+
 
 VarFileNameIncorrect = (VarExtNotCorrect, VarNameNotCorrect, VarVersionNotCorrect)
@@ -1,9 +1,9 @@
+import csv
 import os
 import sys
 import zlib
 import click
 import shutil
-from tqdm import tqdm
 from pathlib import Path
 from collections import defaultdict
 #import PySimpleGUI as sg
@@ -12,14 +12,14 @@ from vamtb.graph import Graph
 from vamtb.var import Var
 from vamtb.file import FileName
 from vamtb.vamex import *
-from vamtb.meta import prep_tree, make_var
 from vamtb.log import *
 from vamtb.utils import *
 from vamtb.varfile import VarFile
 from vamtb.db import Dbs
-from vamtb.profile import ProfileMgr
 from vamtb.config import ConfigMgr
-from vamtb.hub import HubMgr
+from vamtb.serve import QueryServer, QueryClient, open_depgraph, reverse_deps
+from vamtb.dup import DupMgr
+# Packages pulling heavy dependencies (hub, image, meta, profile, scan) are imported by the commands using them
 
 @click.group()
 @click.option('-a', '--force/--no-force', default=False,        help="Do not ask for confirmation.")
@@ -34,15 +34,18 @@ from vamtb.hub import HubMgr
 @click.option('ofile','-k',                                     help=f'Other file.')
 @click.option('-m', '--move/--no-move', default=False,          help="When checking dependencies move vars with missing dep in 00Dep.")
 @click.option('-n', '--dryrun/--no-dryrun', default=False,      help="Dry run on what would be uploaded.")
+@click.option('output', '-o', default="text", type=click.Choice(["text", "json", "csv"]), help="Output format of exists.")
 @click.option('-p', '--progress/--no-progress', default=False,  help="Add progress bar.")
 @click.option('-q', '--remove/--no-remove', default=False,      help="Remove var from DB.")
 @click.option('-r', '--ref/--no-ref', default=False,            help="Only select non reference vars for dupinfo.")
 @click.option('-s', '--full/--no-full', default=False,          help="For scenes, upload not only scene jpg but all jpg to IA.")
+@click.option('-u', '--incremental/--no-incremental', default=False, help="Only scan new or changed vars.")
 @click.option('-v', '--verbose', count=True,                    help="Verbose (twice for debug).")
+@click.option('-w', '--jobs', default=1,                        help="Number of worker processes.")
 @click.option('dup', '-x',                                      help='Only dedup this file.')
 @click.option('-z', '--setref/--no-setref', default=False,      help="Set var as reference.")
 @click.pass_context
-def cli(ctx, verbose, inp, optimize, move, ref, usedb, dir, file, dup, ofile, remove, setref, force, meta, progress, dryrun, full, cc, iaprefix):
+def cli(ctx, verbose, inp, optimize, move, ref, usedb, dir, file, dup, ofile, remove, setref, force, meta, progress, dryrun, full, cc, iaprefix, jobs, incremental, output):
     # pylint: disable=anomalous-backslash-in-string
     """
     For specific command help use vamtb <command> --help
@@ -51,6 +54,7 @@ def cli(ctx, verbose, inp, optimize, move, ref, usedb, dir, file, dup, ofile, re
     """
 
     log_setlevel(verbose)
+    Dbs.set_timing(verbose >= 2)
     info("Welcome to vamtb")
 
     ctx.ensure_object(dict)
@@ -73,10 +77,11 @@ def cli(ctx, verbose, inp, optimize, move, ref, usedb, dir, file, dup, ofile, re
     ctx.obj['inp']         = inp
     ctx.obj['dir']         = dir
     ctx.obj['ofile']       = ofile
+    ctx.obj['jobs']        = jobs
+    ctx.obj['incremental'] = incremental
+    ctx.obj['output']      = output
     conf = {}
 
-    sys.setrecursionlimit(100)  # Vars with a dependency depth of 100 are skipped
-
 def setdir(ctx):
     # Don't make any checks if user provided a dir
     if not ctx.obj['dir']:
@@ -140,6 +145,8 @@ def printrealdep(ctx):
     for varfile in search_files_indir(dir, pattern):
         with Var(varfile, dir) as var:
             deps = list(set(var.dep_fromfiles()))
+            # References of members parsed on the way are cached
+            Dbs.commit()
             depvarfiles = sorted(deps, key=str.casefold)
             print(f">Printing real dependencies for {green(var.var):<50} : {len(depvarfiles) if len(depvarfiles) else 'No'} dependencies")
             for depvarfile in depvarfiles:
@@ -242,9 +249,12 @@ def checkvar(ctx):
 
     file, dir, pattern = get_filepattern(ctx)
     vars_list = search_files_indir(dir, pattern)
+    depgraph = open_depgraph()
+    loops = { var: cycle for cycle in depgraph.cycles() for var in cycle }
     if ctx.obj['progress'] == False or ctx.obj['debug_level']:
         iterator = vars_list
     else:
+        from tqdm import tqdm
         iterator = tqdm(vars_list, desc="Checking vars…", ascii=True, maxinterval=3, ncols=75, unit='var')
     for file in iterator:
         try:
@@ -252,7 +262,9 @@ def checkvar(ctx):
                 info(f">Checking {green(var.var):<50}")
                 try:
                     _ = var.meta()
-                    rec_dep_db(var.var, dir, [ var.var ])
+                    rec_dep_db(depgraph, var.var, loops=False)
+                    if var.var in loops:
+                        error(f"Dependency loop detected on {var.var}:{','.join(loops[var.var])}")
                 except NoMetaJson:
                     error(f"Var {var.var} does not contain a correct meta json file")
                 else:
@@ -309,7 +321,6 @@ def checkdep(ctx):
 
     You can redo the same dependency check later by moving back the directory and correct vars will be moved out of this directory if they are now valid.
     """
-    # FIXME DOC even with database mode, the file system is still used (grepping in files..)
     move = ctx.obj['move']
     usedb = ctx.obj['usedb']
 
@@ -319,14 +330,15 @@ def checkdep(ctx):
         full_bad_dir = Path(dir) / C_BAD_DIR
         full_bad_dir.mkdir(parents=True, exist_ok=True)
     stop = True if move else False
+    depgraph = open_depgraph() if usedb else None
 
     for mfile in sorted(search_files_indir(dir, pattern)):
         try:
-            with Var(mfile, dir, use_db=not usedb) as var:
+            with Var(mfile, dir, use_db=usedb) as var:
                 print(f">Checking dependencies of {green(var.var):<50}")
                 try:
-                    if not usedb:
-                        _ = var.rec_dep(stop=stop)
+                    if usedb:
+                        check_dep_db(depgraph, var.var, stop=stop)
                     else:
                         _ = var.depend(recurse=True, stop=stop)
                 except (VarNotFound, zlib.error) as e:
@@ -349,6 +361,9 @@ def checkdep(ctx):
                             assert(False)
                         else:
                             print(f"Moved {var} to {full_bad_dir}")
+                finally:
+                    # References of members parsed on the way are cached
+                    Dbs.commit()
         except (VarExtNotCorrect, VarMetaJson, VarNameNotCorrect, VarVersionNotCorrect):
             # info(f"Wrong file {mfile}")
             pass
@@ -362,56 +377,31 @@ def dbscan(ctx):
     Scan vars and store props in db.
 
 
-    vamtb [-vv] [-a] [-p] [-f <file pattern> ] dbscan
+    vamtb [-vv] [-a] [-p] [-u] [-w <jobs>] [-f <file pattern> ] dbscan
 
     -p: Display progress bar (only when not using -v)
 
     -a: Do not confirm, always answer yes (will overwrite DB with new content)
+
+    -u: Incremental, only scan vars whose size or modification time differ from DB and remove vars not on disk anymore (subdirectories included)
+
+    Vars are committed to DB by batches of commit_interval (vamtb.yml, defaults to 200), a var failing is rolled back alone.
+
+    -w: Number of worker processes extracting and hashing vars (defaults to 1)
     """
+    from vamtb.scan import ScanMgr
 
-    stored = 0
     quiet = False if ctx.obj['debug_level'] else True
     setdir(ctx)
     file, dir, pattern = get_filepattern(ctx)
-    vars_list = search_files_indir(dir, pattern)
-    if not quiet or ctx.obj['progress'] == False:
-        iterator = vars_list
+    Dbs.set_commit_interval(int(ConfigMgr().get("commit_interval") or C_COMMIT_INTERVAL))
+    scanner = ScanMgr(dir, jobs=ctx.obj['jobs'], confirm=False if ctx.obj['force'] else True, progress=quiet and ctx.obj['progress'])
+    if ctx.obj['incremental']:
+        vars_list, removed = scanner.changed(pattern)
+        scanner.remove(removed)
     else:
-        iterator = tqdm(vars_list, desc="Writing database…", ascii=True, maxinterval=3, ncols=75, unit='var', 
-                        bar_format="{percentage:3.0f}%| {n_fmt}/{total_fmt} | {postfix[0][fn]:<90.90} [{postfix[0][fn2]:>10.10} ] | [{elapsed}<{remaining}, {rate_fmt}]", 
-                        postfix=[{"fn": "str", "fn2": "str"}])
-        
-    for varfile in iterator:
-        with Var(varfile, dir, use_db=True, check_exists=False) as var:
-            info(f"Scanning {var}")
-            try:
-                if quiet and ctx.obj['progress']:
-                    size_msg = f"{int(var.fsize/1024/1024*10)/10}MB"
-                    #Too slow
-#                    if var.exists():
-#                        nfiles = var.get_numfiles()
-#                    else:
-#                        nfiles = len([f for f in var.files()])
-                    iterator.postfix[0]["fn"] = f"{var.var}"
-#                    iterator.postfix[0]["fn2"] = f"{size_msg}, {nfiles} files"
-                    iterator.postfix[0]["fn2"] = f"{size_msg}"
-                if var.store_update(confirm=False if ctx.obj['force'] else True):
-                    stored += 1
-            except VarMalformed as e:
-                if ctx.obj['progress']:
-                    tqdm.write(red(f"Var {var.var} malformed: {e.args[0]}"))
-                else:
-                    error(f"Var {var.var} malformed: {e.args[0]}")
-            except NoMetaJson:
-                if ctx.obj['progress']:
-                    tqdm.write(red(f"Var {var.var} malformed: no meta found"))
-                else:
-                    error(f"Var {var.var} malformed: no meta found")
-            except VarMetaJson as e:
-                if ctx.obj['progress']:
-                    tqdm.write(red(f"Var {var.var} has something wrong in meta: {e.args[0]}"))
-                else:
-                    error(f"Var {var.var} has something wrong in meta: {e.args[0]}")
+        vars_list = search_files_indir(dir, pattern)
+    stored = scanner.scan(vars_list)
 
     info(f"{stored} var files stored")
 
@@ -466,10 +456,11 @@ def graph(ctx):
 
     setdir(ctx)
     file, dir, pattern = get_filepattern(ctx)
+    depgraph = open_depgraph()
     for varfile in search_files_indir(dir, pattern):
         with Var(varfile, dir, use_db=True) as var:
             info(f"Calculating dependency graph for {var.var}")
-            Graph.dotty(var, ext="png" if ctx.obj['force'] else "pdf")
+            Graph.dotty(var, ext="png" if ctx.obj['force'] else "pdf", depgraph=depgraph)
 
 @cli.command('reref')
 @click.pass_context
@@ -520,30 +511,33 @@ def imageopt(ctx):
     Optimize images in vars.
 
 
-    vamtb [-jj] [-f <file pattern> ] imageopt
+    vamtb [-jj] [-w <jobs>] [-f <file pattern> ] imageopt
 
     Without option: no loss of quality, just optimize png
 
     -j:             same but convert png to jpg of qual 90%
 
     -jj:            same but convert png to jpg of qual 75%
+
+    -w:             number of processes encoding images, all vars matching the pattern are processed together
+
+    Results are cached by image content in imgcache, limited to imgcache_size MB (vamtb.yml, defaults to 2048).
     """
-    oldsz = 0
+    from vamtb.image import ImageMgr, ImageCache
     opt_level = ctx.obj['optimize']
     setdir(ctx)
     file, dir, pattern = get_filepattern(ctx)
+    vars = []
     for varfile in search_files_indir(dir, pattern):
-        with Var(varfile, dir, use_db=True) as var:
-            msg = f"Image optimisation on {varfile.name:<100} size:"
-            if not var.exists():
-                print(red(f"{msg} UNKNOWN"))
-                continue
-            oldsz = var.size
-            print(green(f"{msg} {toh(var.size)}"))
-            if var.exists():
-                res = var.var_opt_images(opt_level)
-            else:
-                warn(f"{var.var} exists as {var.path} but is not in the DB, skipping..")
+        var = Var(varfile, dir, use_db=True)
+        msg = f"Image optimisation on {varfile.name:<100} size:"
+        if not var.exists():
+            print(red(f"{msg} UNKNOWN"))
+            continue
+        print(green(f"{msg} {toh(var.size)}"))
+        vars.append(var)
+    cache = ImageCache(maxsize=int(ConfigMgr().get("imgcache_size") or C_IMGCACHE_SIZE))
+    ImageMgr(opt_level, jobs=ctx.obj['jobs'], cache=cache).optimize(vars)
 
 
 @cli.command('dupinfo')
@@ -567,16 +561,19 @@ def dupinfo(ctx):
     onlyref = ctx.obj['ref']
     setdir(ctx)
     file, dir, pattern = get_filepattern(ctx)
-    for varfile in search_files_indir(dir, pattern):
+    varfiles = search_files_indir(dir, pattern)
+    # Given vars only need their own duplicates
+    dupmgr = DupMgr(ctx.obj['cc'], [ Path(varfile).with_suffix("").name for varfile in varfiles ] if file else None)
+    for varfile in varfiles:
         with Var(varfile, dir, use_db=True) as var:
             if not file and onlyref:
                 if var.get_ref == "YES":
                     continue
-            dups = var.dupinfo(ctx.obj['cc'])
+            dups = dupmgr.dupinfo(var.var)
             ndup, sdup = dups['numdupfiles'], dups['dupsize']
             if not file and not ndup:
                 continue 
-            ntot = var.get_numfiles()
+            ntot = dupmgr.numfiles(var.var)
             msg= f"{var.var:<64} : Dups:{ndup:<5}/{ntot:<5} Dup Size:{toh(sdup):<10} (ref:{var.get_ref})"
             if not ndup:
                 msg = green(msg)
@@ -665,24 +662,48 @@ def hub_resources(ctx):
 
     vamtb [-vv] -g <creator.resource.version> hub_resources
 
-    vamtb [-vv] -f <creator_uid> [-i resource_name] hub_resources
+    vamtb [-vv] [-b] [-n] [-w <jobs>] -f <creator_uid> [-i resource_name] hub_resources
 
-    vamtb [-vv] -g <creator> [-i resource_name] hub_resources
+    vamtb [-vv] [-b] [-n] [-w <jobs>] -g <creator> [-i resource_name] hub_resources
 
     -f <creator uid> where creator uid is the creator identifier, example virtaartiemitchel.40335
 
     -g <creator> where creator is the creator name when there's only one existing example virtaartiemitchel
 
     -i <resource_name> will only download resources matching this for the mentionned creator otherwise will fetch all from creator
+
+    -w <jobs> resources downloaded at once, hub_rate in configuration limits requests per second to the hub
+
+    -b: store downloaded vars in database
+
+    -n: only print the plan
+
+    Files of resources are first compared with vars in database, in the var directory and in the current directory:
+    only missing files or newer versions are downloaded.
+
+    Hub pages are cached in hubcache for hubcache_ttl seconds (configuration), then revalidated.
         
     """
+    from vamtb.hub import HubMgr, PageCache, base_url
     creatoruid = ctx.obj['file']
     creator = ctx.obj['inp']
     resource_name = ctx.obj['iaprefix']
     list_file = ctx.obj['ofile']
     is_uid  = False # is parameter name.uid or name
 
-    hub = HubMgr()
+    setdir(ctx)
+    cache = PageCache(ttl=int(ConfigMgr().get("hubcache_ttl") or C_HUBCACHE_TTL))
+    hub = HubMgr(jobs=ctx.obj['jobs'], rate=float(ConfigMgr().get("hub_rate") or C_HUB_RATE), url=ConfigMgr().get("hub_url") or base_url,
+                 cache=cache, dir=ctx.obj['dir'], dryrun=ctx.obj['dryrun'])
+
+    def store(downloaded):
+        if not ctx.obj['usedb']:
+            return
+        for file_name, crc in downloaded:
+            with Var(file_name, use_db=True, check_exists=False) as var:
+                # Checksum was computed while downloading
+                var.crc = crc
+                var.store_update(confirm=False)
     if list_file:
         if creator or creatoruid:
             critical("-k cannot be used with -f/-g")
@@ -693,7 +714,7 @@ def hub_resources(ctx):
                     creator, resource, _ = var.split('.')
                 except ValueError:
                     creator, resource = var.split('.')
-                hub.get_resources_from_author(creator = creator, resource_name=resource)
+                store(hub.get_resources_from_author(creator = creator, resource_name=resource))
         return
   
     if creator:
@@ -710,7 +731,7 @@ def hub_resources(ctx):
                 # Use input creator
                 pass
     info(f"Fetching resources from creator uid {creatoruid}")
-    hub.get_resources_from_author(creator=creator, creatoruid=creatoruid, resource_name=resource_name)
+    store(hub.get_resources_from_author(creator=creator, creatoruid=creatoruid, resource_name=resource_name))
 
 @cli.command('orig')
 @click.pass_context
@@ -747,7 +768,7 @@ def ia(ctx):
     Upload var to Internet Archive item.
 
 
-    vamtb [-vv] [-f <file pattern>] [-a] [-e] [-n] [-i <prefix>] ia
+    vamtb [-vv] [-f <file pattern>] [-a] [-e] [-n] [-i <prefix>] [-w <jobs>] ia
 
     -a: Do not confirm, always answer yes (will overwrite IA with new content).
 
@@ -760,32 +781,28 @@ def ia(ctx):
     -c: Only upload CC* license content.
     
     -i: Change prefix used for the identifier on IA (use only when you are sure the default identifer is already used).
+
+    -w: Number of vars uploaded at the same time.
     """
+    from vamtb.ia import IaMgr
 
     setdir(ctx)
     file, dir, pattern = get_filepattern(ctx)
-    n_up = 0
-    for varfile in search_files_indir(dir, pattern):
-        with Var(varfile, dir, use_db=True) as var:
-            if not var.exists():
-                info("Skipping")
-                continue
-            try:
-                res = var.ia_upload(
-                    meta_only=ctx.obj['meta'], 
-                    confirm=not ctx.obj['force'], 
-                    verbose=True, 
-                    dry_run=ctx.obj['dryrun'], 
-                    full_thumbs=ctx.obj['full'], 
-                    only_cc=ctx.obj['cc'], 
-                    iaprefix=ctx.obj['iaprefix'])
-                if res :
-                    info(f"Var {var.var} uploaded successfully to Internet Archive.")
-                    n_up += 1
-                else:
-                    info(f"Var {var.var} was not uploaded to Internet Archive.")
-            except Exception as e:
-                error(f"Var {var.var} could not be uploaded to Internet Archive., error is:\n{e}")
+    def vars():
+        for varfile in search_files_indir(dir, pattern):
+            with Var(varfile, dir, use_db=True) as var:
+                if not var.exists():
+                    info("Skipping")
+                    continue
+                yield var
+    n_up = IaMgr(
+        jobs=ctx.obj['jobs'],
+        meta_only=ctx.obj['meta'],
+        confirm=not ctx.obj['force'],
+        dry_run=ctx.obj['dryrun'],
+        full_thumbs=ctx.obj['full'],
+        only_cc=ctx.obj['cc'],
+        iaprefix=ctx.obj['iaprefix']).upload(vars())
     print(green(f"{n_up} vars were uploaded"))
 
 @cli.command('anon')
@@ -832,24 +849,41 @@ def exists(ctx):
     Takes a text file with one var name per line.
 
 
-    vamtb [-vv] [n] [-f <text file>] exists
+    vamtb [-vv] [n] [-o json|csv] [-f <text file>] exists
     
     -n: only show non existent var
+
+    -o: print var, exists, path and indb of each var as json or csv
     """
     nonexist_only = ctx.obj['dryrun']
     varlist = ctx.obj['file']
+    output = ctx.obj['output']
 
     setdir(ctx)
     with open(varlist, "r") as tvar:
-        for lvar in tvar:
-            lvar = lvar.rstrip()
-            try:
-                with Var(lvar, dir=ctx.obj['dir'], use_db=True) as var:
-                    if nonexist_only == False:
-                        print(green(f"{lvar} exists"))
-            except VarNotFound:
-                pass
-                #print(red(f"{lvar} does not exists"))
+        names = [ lvar.rstrip() for lvar in tvar if lvar.strip() ]
+
+    rows = []
+    for res in Var.lookup(names, ctx.obj['dir']):
+        if res['error']:
+            error(f"Var filename incorrect:{res['error']}")
+            continue
+        if res['path'] and not res['indb']:
+            warn(f"{res['var']} at {res['path']} is not in DB, run dbscan.")
+        if nonexist_only and res['path']:
+            continue
+        if output == "text":
+            if res['path']:
+                print(green(f"{res['name']} exists"))
+        else:
+            rows.append({ 'var': res['name'], 'exists': res['path'] is not None, 'path': str(res['path']) if res['path'] else None, 'indb': res['indb'] })
+
+    if output == "json":
+        print(prettyjson(rows))
+    elif output == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=[ 'var', 'exists', 'path', 'indb' ])
+        writer.writeheader()
+        writer.writerows(rows)
 
 @cli.command('multiup')
 @click.pass_context
@@ -912,6 +946,7 @@ def varlink(ctx):
         _ = input(f"Your current directory is not named AddonPackages. Are you sure you want to proceed? Else hit Ctrl-C now")
 
     found = False
+    depgraph = open_depgraph()
 
     for varfile in search_files_indir2(dir, pattern):
         found = True
@@ -922,7 +957,13 @@ def varlink(ctx):
             print(f"Linking {green(var.var)} {'' if ctx.obj['move'] else 'and dependencies'}")
             linkfile(var)
             if not ctx.obj['move']:
-                var.rec_dep(stop=False, dir=dir, func = linkfile)
+                for dep in depgraph.closure(var.var):
+                    try:
+                        linkfile(Var(dep, dir))
+                    except VarNotFound:
+                        error(f"Var {dep} not found")
+                    except (VarExtNotCorrect, VarNameNotCorrect, VarVersionNotCorrect):
+                        error(f"We skipped a broken dependency {dep}")
     if found:
         return
 
@@ -1009,6 +1050,10 @@ def latest(ctx):
         creator, asset = ctx.obj['file'].split('.', 2)
 
     ln = f"{creator}.{asset}.latest"
+    client = QueryClient.running()
+    if client:
+        print(client.latest(ln, dir))
+        return
     with Var(ln, dir, use_db=True) as latest:
         print(f"{latest.path}")
 
@@ -1043,6 +1088,7 @@ def profile(ctx):
       Use vamtb link command to add more
 
     """
+    from vamtb.profile import ProfileMgr
 
     setdir(ctx)
     confmgr = ConfigMgr()
@@ -1106,6 +1152,7 @@ def pluginpreset(ctx):
     Note that newer plugins might get things wrong with older plugin settings
 
     """
+    from vamtb.profile import ProfileMgr
     dirs = []
     modify = False if ctx.obj['progress'] else True
     rpath = Path("Custom/PluginPresets/Plugins_UserDefaults.vap")
@@ -1199,6 +1246,7 @@ def repack(ctx):
 
     -f <creatorname>: Set creatorname
     """
+    from vamtb.meta import prep_tree, make_var
     global C_TMPDIR
     custom = C_TMPDIR
     move = ctx.obj['move']
@@ -1350,14 +1398,15 @@ def rdep(ctx):
 
     vamtb [-vv] [-f file] rdep
 
+    A reference to a.b.latest or a.b.minN counts as a dependency on the var it resolves to.
+
     """
     setdir(ctx)
     file, dir, pattern = get_filepattern(ctx)
+    varnames = [ VarFile(varfile, use_db=True).var for varfile in search_files_indir2(dir, pattern) ]
 
-    for varfile in search_files_indir2(dir, pattern):
-        with Var(varfile, dir, use_db=True, check_exists=False, check_file_exists=False, check_naming=True) as var:
-            rvars = var.get_rdep()
-            print (green(f"Reverse depends {var.var}: ") + ','.join(rvars))
+    for varname, rvars in reverse_deps(varnames):
+        print (green(f"Reverse depends {varname}: ") + ','.join(rvars))
 
 @cli.command('nordep')
 @click.pass_context
@@ -1375,39 +1424,51 @@ def nordep(ctx):
 
     setdir(ctx)
     file, dir, pattern = get_filepattern(ctx)
-
-    for varfile in search_files_indir2(dir, pattern):
-        with Var(varfile, dir, use_db=True, check_exists=False, check_file_exists=False, check_naming=True) as var:
-            rvars = var.get_rdep()
-            if not rvars:
-                msg = f"No var depends on {var.var}"
-                if var.db_files(pattern='/scene/') or var.db_files(pattern='/Clothing/') or var.db_files('/Assets/'):
-                    msg = green(msg)
-                else:
-                    msg = red(msg)
-                print (msg)
-            else:
-                info(f"{var.var} : {len(rvars)} vars depending on it:{rvars}")
-
-
-def rec_dep_db(varfile, dir, dep_chain, recurse=True, depth=0):
-    with Var(varfile, dir, use_db=True, check_exists=False, check_file_exists=False, check_naming=True) as var:
-        rvars = []
-        if var.exists():
-            rvars = var.get_dep()
+    varnames = [ VarFile(varfile, use_db=True).var for varfile in search_files_indir2(dir, pattern) ]
+
+    def print_nordeps(nordeps):
+        content = Dbs.get_vars_with_files(nordeps, ('/scene/', '/Clothing/', '/Assets/'))
+        for varname in nordeps:
+            msg = f"No var depends on {varname}"
+            print(green(msg) if varname in content else red(msg))
+
+    # Vars are classified by chunk as results come
+    nordeps = []
+    for varname, rvars in reverse_deps(varnames):
+        if rvars:
+            info(f"{varname} : {len(rvars)} vars depending on it:{rvars}")
+        else:
+            nordeps.append(varname)
+            if len(nordeps) == C_DB_CHUNK:
+                print_nordeps(nordeps)
+                nordeps = []
+    print_nordeps(nordeps)
+
+
+def rec_dep_db(depgraph, varname, recurse=True, loops=True):
+    for depth, ref, var, loop in depgraph.walk(varname, None if recurse else 0):
+        if loop:
+            if loops:
+                error(f"Dependency loop detected on {varname}:{','.join(loop)}")
+            continue
+        if var:
+            rvars = depgraph.deps(var)
             status = ",".join(rvars) if rvars else "None"
             status = green(status)
         else:
             status = "Unknown"
             status = red(status)
-        print(f"{' ' * depth}> Dependencies of {var.var}: {status}")
-        if recurse:
-            for r in rvars:
-                try:
-                    rec_dep_db(r, dir, dep_chain + [r], depth+1)
-                except RecursionError:
-                    error(f"Dependency loop detected on {varfile}:{','.join(dep_chain)}")
-                    return
+        print(f"{' ' * depth}> Dependencies of {ref}: {status}")
+
+def check_dep_db(depgraph, varname, stop=True):
+    for depth, ref, var, loop in depgraph.walk(varname):
+        msg = ">" * (depth+1) + f" {ref}"
+        if var:
+            info(f"{msg:<130}" + ":     Found")
+        else:
+            warn(f"{msg:<130}" + ": Not Found")
+            if stop:
+                raise VarNotFound(ref)
 
 
 @cli.command('dep')
@@ -1429,9 +1490,46 @@ def dep(ctx):
 
     setdir(ctx)
     file, dir, pattern = get_filepattern(ctx)
+    depgraph = open_depgraph()
 
     for varfile in search_files_indir2(dir, pattern):
-        rec_dep_db(varfile, dir, [ varfile ], False if ctx.obj['ref'] else True)
+        with Var(varfile, dir, use_db=True, check_exists=False, check_file_exists=False, check_naming=True) as var:
+            rec_dep_db(depgraph, var.var, False if ctx.obj['ref'] else True)
+
+@cli.command('cycles')
+@click.pass_context
+@catch_exception
+def cycles(ctx):
+    """
+    Print all dependency loops of the database.
+
+
+    vamtb [-vv] cycles
+
+    Vars are in the same loop when each one depends, directly or not, on all the others.
+
+    """
+    depgraph = open_depgraph()
+    loops = depgraph.cycles()
+    for cycle in loops:
+        print(f"Dependency loop between {red(','.join(cycle))}")
+    print(f"{len(loops)} dependency loops")
+
+@cli.command('serve')
+@click.pass_context
+@catch_exception
+def serve(ctx):
+    """
+    Serve queries from the database on localhost until interrupted.
+
+
+    vamtb [-vv] serve
+
+    While running, dep, rdep, nordep, cycles, checkvar, checkdep -b, graph, varlink and latest forward their queries to it,
+    saving the load of the database at each call. The dependency graph is reloaded when the database is modified.
+    Port is serve_port in vamtb.yml, any free port if unset.
+    """
+    QueryServer(port=int(ConfigMgr().get("serve_port") or 0)).serve()
 
 @cli.command('parsevamlog')
 @click.pass_context
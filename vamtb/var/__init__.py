@@ -1,18 +1,15 @@
 '''Var file naming'''
+import io
 import json
 import os
-import re
 import shutil
 import tempfile
 import json
-import time
-import requests
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from zipfile import ZipFile
-from internetarchive import get_item
-from PIL import Image, ImageFile
 
-from vamtb.file import FileName
+from vamtb.db import Dbs
+from vamtb.file import FileName, ZipFileName, DirIndex
 from vamtb.varfile import VarFile
 
 from vamtb.vamex import *
@@ -48,6 +45,9 @@ class Var(VarFile):
         # Password for extracting zip (only for renamevar)
         self.__password = None
 
+        # Checksum if known before reading the var
+        self.__crc = None
+
         # Verify and resolve var on disk
         if check_file_exists:
             self._path = Path(self.__resolvevar(multiFileName, localdir=localdir))
@@ -83,7 +83,13 @@ class Var(VarFile):
 
     @property
     def crc(self):
-        return FileName(self.path).crc
+        # A var is a zip, never json: no need to load it in memory for normalization
+        return self.__crc or crc32f(self.path)
+
+    @crc.setter
+    def crc(self, crc):
+        """ Checksum already known, computed while the var was written """
+        self.__crc = crc
 
     @property
     def mtime(self):
@@ -122,9 +128,7 @@ class Var(VarFile):
             except KeyError:
                 error(f"{self.var} had reference issues but no issue given, its likely that var was modified manually!")
 
-        if self.tmpDir.exists() and not (
-            Path(self.tmpDir / "Custom").exists() or 
-            Path(self.tmpDir / "Saves").exists()):
+        if not any(name.startswith(("Custom/", "Saves/")) for name in self.namelist()):
             raise VarMalformed("Contains neither Custom nor Saves dir")
 
     def store_var(self)->None:
@@ -132,12 +136,16 @@ class Var(VarFile):
         super()._store_var()
 
     def store_update(self, confirm = True) -> bool:
+        with self.db_transaction():
+            return self.__store_update(confirm)
+
+    def __store_update(self, confirm) -> bool:
         if self.exists():
             debug(f"{self.var} already in database")
             if FileName(self.path).mtime == self.get_modtime:
                 info("Same modtime")
                 return False
-            info(f"Database is not inline.")
+            info("Database is not inline.")
             if confirm == False:
                 res = "Y"
             else:
@@ -149,11 +157,10 @@ class Var(VarFile):
                     res = input(blue(f"Remove older DB for {self.path} [Y]N  ?"))
             if not res or res == "Y":
                 self.db_delete() 
-                self.db_commit()
             else:
-                self.db_commit(rollback = True)
                 return False
-        self.store_var()
+        self.check()
+        self._store_rows(self._var_rows())
         return True
 
     def zipcheck(self):
@@ -167,9 +174,6 @@ class Var(VarFile):
         except Exception as e:
             raise VarMalformed(f"Zip is corrupted {e}")
 
-    def search(self, pattern)-> Path:
-        return search_files_indir2(self.__AddonDir, pattern)
-
     def __resolvevar(self, multiname, localdir=True):
         """This will return the real var as an existing Path
         By default, it will also search in local directory unless localdir is False        
@@ -181,30 +185,76 @@ class Var(VarFile):
             if Path(p).exists() and Path(p).is_file():
                 return Path(p)
 
-        # Not a full path var, search var on disk
+        # Not a full path var, search var in directory index
         if self.version == "latest" or self.minversion:
-            pattern = re.escape(self.creator) + "\." + re.escape(self.resource) + "\..*\.var"
+            version = None
         elif self.iversion == -1:
             raise VarNotFound(multiname)
         else:
-            pattern = self.file
+            version = int(self.iversion)
 
-        vars = self.search(pattern = pattern)
-        if not vars:
+        index = DirIndex.get(self.__AddonDir or os.getcwd())
+        path = index.find(self.creator, self.resource, version=version, minversion=self.minversion)
+        if not path:
+            warn(f"No files found matching {self.var} in {self.__AddonDir}")
             raise VarNotFound(self.var)
+        return path
 
-        if self.version == "latest":
-            rsortedvars = list(reversed(sorted(vars, key=lambda x: int(x.name.split('.')[2]))))
-            return rsortedvars[0]
-        elif self.minversion :
-            vars = [ e for e in vars if int(e.name.split('.')[2]) >= self.minversion ]
-            sortedvars = list(sorted(vars, key=lambda x: int(x.name.split('.')[2])))
-            if not sortedvars:
-                raise VarNotFound(self.var)
-            return sortedvars[0]
-        else:
-            assert(len(vars) == 1)
-            return vars[0]
+    @staticmethod
+    def lookup(names, dir, localdir=True):
+        """
+        Resolve many var names like Var(name, dir, use_db=True) does, with one listing of dir and of the local directory
+        and one query per chunk of exact names.
+        Yields dict with name, var, path or None if not on disk, indb, and error for incorrect names.
+        """
+        def files(d):
+            with os.scandir(d) as it:
+                return { entry.name for entry in it if entry.is_file() }
+
+        index = DirIndex.get(dir)
+        dirfiles = files(dir)
+        localfiles = files(os.getcwd()) if localdir else set()
+
+        vfiles = {}
+        for name in names:
+            try:
+                vfiles[name] = VarFile(name, use_db=True)
+            except VarFileNameIncorrect as e:
+                vfiles[name] = e
+
+        exact = [ vf.var for vf in vfiles.values() if isinstance(vf, VarFile) and vf.iversion != -1 and not vf.var.endswith(".latest") ]
+        indb = set()
+        for i in range(0, len(exact), C_DB_CHUNK):
+            chunk = exact[i:i + C_DB_CHUNK]
+            sql = f"SELECT VARNAME FROM VARS WHERE VARNAME IN ({','.join('?' * len(chunk))})"
+            indb.update(e[0] for e in Dbs.fetchall(sql, chunk))
+
+        for name in names:
+            vf = vfiles[name]
+            if not isinstance(vf, VarFile):
+                yield { 'name': name, 'var': None, 'path': None, 'indb': False, 'error': vf }
+                continue
+            path = None
+            # Same order as __resolvevar: full names in dir, then in local directory, then var in dir index
+            if os.sep in name or (os.altsep and os.altsep in name):
+                candidates = [ Path(dir, name), Path(dir, f"{name}.var") ] + ([ Path(name), Path(f"{name}.var") ] if localdir else [])
+                path = next((p for p in candidates if p.is_file()), None)
+            elif name in dirfiles or f"{name}.var" in dirfiles:
+                path = Path(dir, name if name in dirfiles else f"{name}.var")
+            elif name in localfiles or f"{name}.var" in localfiles:
+                path = Path(name if name in localfiles else f"{name}.var")
+            if not path and (vf.version == "latest" or vf.minversion or vf.iversion != -1):
+                version = None if vf.version == "latest" or vf.minversion else int(vf.iversion)
+                path = index.find(vf.creator, vf.resource, version=version, minversion=vf.minversion)
+                if not path:
+                    warn(f"No files found matching {vf.var} in {dir}")
+            if vf.var.endswith(".latest"):
+                exists = vf.latest() is not None
+            elif vf.minversion:
+                exists = vf.min() is not None
+            else:
+                exists = vf.var in indb
+            yield { 'name': name, 'var': vf.var, 'path': path, 'indb': exists, 'error': None }
 
     def __repr__(self) -> str:
         return f"{self.var} [path : {self.path}]"
@@ -240,6 +290,27 @@ class Var(VarFile):
     def tmpDir(self):
         return self.__tmpDir
 
+    def zip(self) -> ZipFile:
+        """Open var for reading members without extracting"""
+        zipf = ZipFile(self.path)
+        if self.__password:
+            zipf.setpassword(self.__password.encode('utf-8'))
+        return zipf
+
+    def namelist(self):
+        with self.zip() as z:
+            return z.namelist()
+
+    def read_file(self, fname) -> bytes:
+        """Read one member, from the extracted directory if any or straight from the zip"""
+        if self.__tmpDir:
+            return FileName(self.__tmpDir / fname).read()
+        try:
+            with self.zip() as z:
+                return z.read(fname)
+        except KeyError:
+            raise FileNotFoundError(fname)
+
     def set_password(self, password):
         self.__password = password
 
@@ -253,82 +324,116 @@ class Var(VarFile):
 
         return inner
 
-    @unzip
     def load_json_file(self, filename) -> dict:
-        return FileName(self.__tmpDir / filename).json
+        return json.loads(self.read_file(filename))
 
-    @unzip
     def open_file(self, fname):
-        fn = FileName(self.__tmpDir / fname)
-        return fn.open()
+        return io.StringIO(self.read_file(fname).decode('utf-8'))
 
-    @unzip
     def dep_frommeta(self):
         if not( self.meta() and "dependencies" in self.meta() and self.meta()['dependencies']):
             return []
 
         return self.meta()['dependencies']
     
-    @unzip
-    def dep_fromfiles(self, with_file = False):
+    def dep_fromfiles(self, with_file = False, files = None):
+        """
+        References to other vars found in json files
+        Zip members are looked up in the member cache before being parsed,
+        unless files are given with their references already extracted
+        """
         all_deps = []
-        for file in self.files():
-            try:
-                deps = file.jsonDeps
-            except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+        use_cache = files is None
+        cached = {}
+        if use_cache:
+            # Zip stays open while iterating, members are listed in a first pass
+            cached = Dbs.get_member_refs([ (file.zipcrc, file.size) for file in self.files() if isinstance(file, ZipFileName) and file.is_json ])
+            files = self.files()
+        new_refs = []
+        for file in files:
+            if isinstance(file, ZipFileName) and not file.is_json:
+                # References are only found in json, don't decompress binaries
                 continue
+            cacheable = use_cache and isinstance(file, ZipFileName)
+            refs = cached.get((file.zipcrc, file.size)) if cacheable else None
+            if refs is None:
+                try:
+                    refs = file.jsonDeps['var']
+                except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+                    continue
+                if cacheable:
+                    new_refs.append((file.zipcrc, file.size, refs))
 
             if with_file:
-                elements = deps['var']
+                elements = refs
             else:
-                elements = list(set([ v.split(':')[0] for v in deps['var'] ]))
+                elements = list(set([ v.split(':')[0] for v in refs ]))
             if elements:
                 debug(f"File {file} in {self.var} references vars: {','.join(sorted(elements))}")
                 all_deps.extend(elements)
+        if new_refs:
+            # In the transaction of the caller, which commits it
+            Dbs.store_member_refs(new_refs)
         if with_file:
             all_deps = [ e for e in list(set(all_deps)) if e.split(':')[0] != self.var ]
         else:
             all_deps = [ e for e in list(set(all_deps)) if e != self.var ]
         return all_deps
 
-    depend_node = []
-
-    @unzip
-    def depend(self, recurse = False, init = True, check = True, stop = True):
+    def depend(self, recurse = False, check = True, stop = True):
         """
         Print depends based on json
+        Each dependency is checked once, which also avoids dependency loops
         """
-        global depend_node
-
-        # For dependency loop tracking, init nodes
         info(f"Checking dep of {self.var}")
-        if init:
-            depend_node = [ self.var ]
-        for dep in sorted(self.dep_fromfiles()):
-            if dep not in depend_node:
-                depend_node.append(dep)
-                try:
-                    with  Var(dep, self.__AddonDir) as var:
-                        debug(f"{self.var} depends on {var}")
-                        if recurse:
-                            var.depend(recurse=True, init = False, check = check)
-                except VarNotFound as e:
-                    if check:
-                        warn(f"{dep} Not found")
-                    if stop:
-                        raise
-                else:
-                    if check:
-                        info(f"{dep} Found")
-            else:
-                debug(f"Avoiding loop from {self.var} with {dep}")
+        depend_node = [ self.var ]
+        stack = [ (self, iter(sorted(self.dep_fromfiles()))) ]
+        while stack:
+            var, deps = stack[-1]
+            dep = next(deps, None)
+            if dep is None:
+                stack.pop()
+                continue
+            if dep in depend_node:
+                debug(f"Avoiding loop from {var.var} with {dep}")
+                continue
+            depend_node.append(dep)
+            try:
+                dvar = Var(dep, self.__AddonDir)
+            except VarNotFound:
+                if check:
+                    warn(f"{dep} Not found")
+                if stop:
+                    raise
+                continue
+            debug(f"{var.var} depends on {dvar}")
+            if check:
+                info(f"{dep} Found")
+            if recurse:
+                info(f"Checking dep of {dvar.var}")
+                stack.append((dvar, iter(sorted(dvar.dep_fromfiles()))))
         return depend_node
 
     def ziprel(self, fname):
+        if not self.__tmpDir:
+            # Member read from zip, already relative
+            return Path(fname).as_posix()
         return Path(os.path.relpath(fname, self.__tmpDir)).as_posix()
 
-    @unzip
     def files(self, with_meta=False, path=None):
+        """
+        Yield files of the var
+        Once extracted (for commands modifying the var), files are from the extracted directory
+        Otherwise they are read from the zip which stays open while iterating
+        """
+        if not self.__tmpDir:
+            with self.zip() as z:
+                for zinfo in z.infolist():
+                    if zinfo.is_dir():
+                        continue
+                    if with_meta or Path(zinfo.filename).name != "meta.json":
+                        yield ZipFileName(z, zinfo)
+            return
         if not path:
             path = self.__tmpDir
         for entry in os.scandir(path):
@@ -338,35 +443,34 @@ class Var(VarFile):
                 if with_meta or entry.name != "meta.json":
                     yield FileName(entry, calc_crc=False)
 
-    @unzip
     def remroot(self):
         debug(f"Removing root from {self.var}")
-        tmpfd, tmpname = tempfile.mkstemp(dir=self.__AddonDir)
-        os.close(tmpfd)
-
-        with ZipFile(tmpname, 'w') as zout:
-            zout.comment = b""
-            for file in self.files(with_meta=True):
-                rel_file = str(file.path.relative_to(self.__tmpDir).as_posix())
-                if rel_file.endswith(".vap") and rel_file.startswith("Custom/Atom/Person/Pose/"):
-                    jvap = file.json
-                    jvap_storables = jvap['storables']
-                    jvap_storables_noroot = []
-
-                    for s in jvap_storables:
-                        if s['id'] not in ['control', 'CharacterPoseSnapRestore']:
-                            jvap_storables_noroot.append(s)
-                        else:
-                            pass
-                            info(f"Removing root from var {rel_file}")
+        replace = {}
+        for file in self.files():
+            rel_file = self.ziprel(file.path)
+            if rel_file.endswith(".vap") and rel_file.startswith("Custom/Atom/Person/Pose/"):
+                jvap = file.json
+                jvap_storables = jvap['storables']
+                jvap_storables_noroot = []
+
+                for s in jvap_storables:
+                    if s['id'] not in ['control', 'CharacterPoseSnapRestore']:
+                        jvap_storables_noroot.append(s)
+                    else:
+                        pass
+                        info(f"Removing root from var {rel_file}")
+                if len(jvap_storables_noroot) != len(jvap_storables):
                     jvap['storables'] = jvap_storables_noroot
+                    replace[rel_file] = json.dumps(jvap, indent=4).encode('utf-8')
+        if not replace:
+            return
 
-                    zout.writestr(rel_file, json.dumps(jvap, indent=4))
-                else:
-                    zout.writestr(rel_file, file.read())
+        tmpfd, tmpname = tempfile.mkstemp(dir=self.__AddonDir)
+        os.close(tmpfd)
+        # Only modified presets are compressed again
+        zip_rewrite(self.path, tmpname, replace=replace, comment=b"")
         shutil.move( tmpname, self.file )
 
-    @unzip
     def remmorphpreload(self, remove=False):
         
         debug(f"Move to preload=False for {self.var}")
@@ -381,18 +485,14 @@ class Var(VarFile):
         if not remove:
             return
         js['customOptions']['preloadMorphs'] = "false"
-        self.write_meta(self.tmpDir, js)
 
 #        tmpfd, tmpname = tempfile.mkstemp(dir=self.__AddonDir)
         tmpfd, tmpname = tempfile.mkstemp(dir=os.getcwd())
         os.close(tmpfd)
         print(f"Setting to false")
 
-        with ZipFile(tmpname, 'w') as zout:
-            zout.comment = b""
-            for file in self.files(with_meta=True):
-                rel_file = str(file.path.relative_to(self.__tmpDir).as_posix())
-                zout.writestr(rel_file, file.read())
+        # Only meta.json is compressed again
+        zip_rewrite(self.path, tmpname, replace={ "meta.json": prettyjson(js).encode('utf-8') }, comment=b"")
         shutil.move( tmpname, self.file )
 
     def move_creator(self):
@@ -434,310 +534,58 @@ class Var(VarFile):
             else:
                 error(f"File {file_to_move} and {newpath} have same name but crc differ {fcrc} vs {ncrc}. Remove yourself.") 
 
-    def treedown(self):
-        """
-        Return down dependency graph
-        Depth first
-        """
-        td_vars = {}
-        def rec(var:Var):
-            varn = var.var
-            td_vars[varn] = { 'dep':[], 'size':0, 'totsize':0 }
-            td_vars[varn]['size'] =  var.size
-            for dep in  var.get_dep():
-                #Descend for that depend if it exists
-                vers = dep.split('.')[2]
-                if vers == "latest":
-                    try:
-                        dep = Var(dep, self.__AddonDir, use_db=True).latest()
-                    except VarNotFound:
-                        pass
-                elif vers.startswith("min"):
-                    try:
-                        dep = Var(dep, self.__AddonDir, use_db=True).min()
-                    except VarNotFound:
-                        pass
-                td_vars[varn]['dep'].append(dep)
-                try:
-                    if dep and Var(dep, self.__AddonDir, use_db=True).exists():
-                        if dep == varn:
-                            error(f"There is a recursion from {varn} to itself, avoiding")
-                            continue
-                        td_vars[varn]['totsize'] += Var(dep, self.__AddonDir, use_db=True).size
-                        rec(Var(dep, self.__AddonDir, use_db=True))
-                except VarNotFound:
-                    pass
-
-        td_vars = {}
-        rec(self)
-        return td_vars
-
-    def dupinfo(self, hide_same_creator=False):
+    def reref_files(self, newref) -> dict:
         """
-        Returns dict about duplication of files with other creators vars
+        Returns { member: new content } of json members where references were replaced
         """
-        dups = { "numdupfiles": 0, "dupsize": 0 }
-
-        for file in self.db_files(with_meta=False):
-            if self.get_file_size(file) <= 4:
-                continue
-
-            ck = self.get_file_cksum(file)
-            ckdup = self.db_fetch("SELECT VARNAME, FILENAME FROM FILES WHERE CKSUM == ? AND VARNAME != ?", (ck, self.var))
-
-            ckdup_creator = []
-            for v, f in ckdup:
-                tvar = VarFile(v, use_db=True)
-                if ( hide_same_creator and tvar.creator == self.creator ):
-                    continue
-                if not( tvar.creator == self.creator and tvar.resource == self.resource ):
-                    ckdup_creator.append((v, f))
-
-            if ckdup_creator:
-                dups['numdupfiles'] += 1
-                dups['dupsize'] += self.get_file_size(file)
-                for dupvar, dupfile in ckdup:
-                    info(f"{self.var}:/{file} is dup of {dupvar}:/{dupfile}")
-            else:
-                debug(f"No dup for {self.var}:/{file}")
-        return dups
-
-    def opt_image(self, fname, optlevel):
-        """
-            1 (1-bit pixels, black and white, stored with one pixel per byte)
-            L (8-bit pixels, black and white)
-            P (8-bit pixels, mapped to any other mode using a color palette)
-            RGB (3x8-bit pixels, true color)
-            RGBA (4x8-bit pixels, true color with transparency mask)
-        """
-        fname = str(Path(fname).as_posix())
-        # Use a temp image for reading
-        old_image = str(Path(fname).with_suffix(".orig"))
-        osize = FileName(fname).size
-        shutil.copyfile(fname, old_image)
-        picture = Image.open(old_image)
-        debug(f"Image mode is : {red(picture.mode)}")
-        if optlevel:
-            if picture.mode in ("RGBA", "P", "I"):
-                #warn(f"Image {fname} is of mode {picture.mode} and we'll convert it to RGB")
-                # Heuristics on Normal / Decal having transparency is flawed as creator don't use them properly
-                # Never convert I to RGB
-                return False
-                picture = picture.convert("RGB")
-            new_image = str(Path(fname).with_suffix(".jpg"))
-            jpeg_qual = 90 if optlevel == 1 else 75
-        else:
-            jpeg_qual = "keep"
-            new_image = fname
-
-        pfname = os.path.relpath(fname, self.__tmpDir)
-        pdname = os.path.relpath(new_image, self.__tmpDir)
-        # Conversion of png to jpg ?
-        has_changed_format = True if Path(fname).name != Path(new_image).name else False
-        picture.save(new_image, optimize = True, quality = jpeg_qual, compress_level=9, progressive=False)
-        nsize = FileName(new_image).size
-        persize = int(100*(1-nsize/osize))
-        info(f"Level {optlevel} - JPEG qual {jpeg_qual} => {red(str(persize)+'% less')}\n{green(pfname+'->'+pdname)}")
-        os.unlink(old_image)
-        # We converted from png to jpg, remove old png
-        if has_changed_format:
-            os.unlink(fname)
-        return has_changed_format
-
-    backed = False
-    optimized = {}
-    def opt_images(self, json_file, optlevel):
-        """
-        optlevel: 0 => lossless
-        optlevel: 1 => convert to 90% Jpg
-        optlevel: 2 => convert to 75% Jpg
-        """
-
-        minsize = 1024*1024*5  # 5MB
-        global backed
-        global optimized
-
-        with open(json_file, 'r') as f:
-            json_content = f.read()
-        if optlevel:
-            pattern = re.compile(r'(".+") : (?:"SELF:/(.+(?:jpg|png)))', re.IGNORECASE)
-        else:
-            pattern = re.compile(r'(".+") : (?:"SELF:/(.+(?:png)))', re.IGNORECASE)
-        for m in re.finditer(pattern, json_content):
-
-            # Don't optimized files aready optimized 
-            if m.group(2) in optimized:
-                continue
-            else:
-                optimized[m.group(2)] = True
-
-            img = FileName(f"{self.tmpDir}\{m.group(2)}")
-            debug(f">> {m.group(1)} image {m.group(2)} ")
-            try:
-                if img.size > minsize:
-                    if backed == False:
-                        #Backups are for sissies
-                        #if Path(self.path).with_suffix(".orig").exists():
-                        #    critical(f"File {Path(self.path).with_suffix('.orig')} already exists, remove backup")
-                        #shutil.copyfile(self.path, Path(self.path).with_suffix('.orig'))
-                        backed = True
-                    # We default to conversion
-                    l_optlevel = optlevel
-
-                    # Logic is flawed as creator don't use them properly it seems.
-                    # Alpha is sometimes used on Spec / GLoss rather than Decal
-                    # We still avoid Normals
-    #                if "Normal" in m.group(1) or "Decal" in m.group(1):
-                    if "Normal" in m.group(1):
-                        # TODO
-                        # If that's a normal, we don't want to convert to jpg
-                        # If that's a decal, it should have transparency (png mode) and we shouldn't convert to RGB
-                        # For other png which don't require transparency, we should be able to convert to RGB and gain a lot
-                        l_optlevel = 0
-                    debug(f">> size {toh(img.size)}, loss_level={l_optlevel}")
-                    has_changed_format = self.opt_image(f"{self.tmpDir}\{m.group(2)}", l_optlevel)
-                    if has_changed_format:
-                        # We keep track of modified images for second pass
-                        optimized[m.group(2)] = str(Path(m.group(2)).with_suffix(".jpg").as_posix())
-            except FileNotFoundError:
-                error(f"Var references inexisting file {m.group(2)} ")
-                continue
-
-        return backed
-
-
-    @unzip
-    def var_opt_images(self,opt_level):
-        global backed
-        global optimized
-        backed = False
-        optimized = {}
-        modified_var = False
-        tdir = self.tmpDir
-        ImageFile.MAXBLOCK = 2**20
-        ImageFile.LOAD_TRUNCATED_IMAGES = True
-        osize = self.size
-        for globf in search_files_indir2(tdir, ".*", recurse=True):
-            if globf.name == "meta.json" or globf.suffix in (".vmi", ".vam", ".vab", ".assetbundle", ".scene", ".tif", ".jpg", ".png", ".dll"):
-                continue
-            if not Path(globf).is_file():
-                continue
-            debug(f"Searching for images in {globf.name}")
-            try:
-                file = FileName(globf)
-                js = file.json
-            except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                continue
-            debug(f"> Searching for images in {green(str(globf.relative_to(self.__tmpDir)))}")
-            modified_var_for_file = self.opt_images(globf, opt_level)
-            modified_var = modified_var or modified_var_for_file
-
-        if modified_var:
-            print(green("Some file types got changed, updating var..."))
-            # The logic is based on scanning json and finding textures.
-            # If we modified an image, it might be referenced in multiple places
-            for globf in search_files_indir2(tdir, ".*", recurse=True):
-                if globf.name == "meta.json" or globf.suffix in (".vmi", ".vam", ".vab", ".assetbundle", ".scene", ".tif", ".jpg", ".png", ".dll"):
-                    continue
-                if not Path(globf).is_file():
-                    continue
-                try:
-                    file = FileName(globf)
-                    js = file.json
-                except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                    continue
-                debug(f"Replacing images in {globf.name}")
-
-                for src, dst in optimized.items():
-                    if isinstance(dst, bool):
-                        # unmodified, proceed to next replacement
-                        continue
-
-                    with open(globf, 'r') as f:
-                        json_content = f.read()
-                    debug(f"Replacing {src} with {dst} in {globf}")
-                    replace_string = json_content.replace(src, dst)
-                    with open(globf, "w") as f:
-                        f.write(replace_string)
-
-            sopt_level={0: "tc_lossless", 1: "tc_nearlossless", 2: "tc_good"}
-            nresource = f"{self.resource}_{sopt_level[opt_level]}"
-            nvar = f"{self.creator}.{nresource}.{self.version}"
-
-            # Create new var
-            new_var = Var(nvar, dir = self.addondir, use_db=True, check_exists=False, check_file_exists=False)
-            new_var._path = str(Path(new_var.addondir, f"{nvar}.var"))
-
-            ometa = self.meta()
-            ometa['packageName'] = nresource
-            new_var.__tmpDir = tdir
-            self.write_meta(tdir, ometa)
-
-            zipdir(tdir, new_var.path)
-
-            #Check it
-            res = ZipFile(new_var.path).testzip()
-            if res != None:
-                critical(f"Warning, reconstructed zip {new_var.path} has CRC problem on file {res}.")
-
-            warn(f"Modified {new_var.path}")
-            new_var.store_update(confirm=False)
-            info(f"Updated DB for {new_var.var}")
-
-            nsize = new_var.size
-            persize = int(100*(1-nsize/osize))
-            warn(f"{toh(osize)}->{toh(nsize)}: {persize}% less")
-
-    def reref_files(self, newref):
-        tdir = self.tmpDir
-        for globf in search_files_indir2(tdir, ".*", recurse=True):
-            if globf.name == "meta.json" or globf.suffix in (".vmi", ".vam", ".vab", ".assetbundle", ".scene", ".tif", ".jpg", ".png", ".dll"):
+        replace = {}
+        for file in self.files():
+            if file.path.suffix in (".vmi", ".vam", ".vab", ".assetbundle", ".scene", ".tif", ".jpg", ".png", ".dll"):
                 continue
+            member = self.ziprel(file.path)
             try:
-                file = FileName(globf)
-                js = file.json
+                fs = file.read().decode('utf-8')
+                _ = json.loads(fs)
             except (UnicodeDecodeError, json.decoder.JSONDecodeError):
                 continue
-            debug(f"> Searching for pattern in {globf}")
+            debug(f"> Searching for pattern in {member}")
+            orig_fs = fs
             for nr in newref:
-                replace_string = ""
-                fs = ""
                 #info(f">> Applying reref for {nr}")
-                with open(globf, 'r') as f:
-                    fs = f.read()
-                    rep = f"{newref[nr]['newvar']}:/{newref[nr]['newfile']}"
-                    replace_string = self.ref_replace(nr, fs, rep)
+                rep = f"{newref[nr]['newvar']}:/{newref[nr]['newfile']}"
+                replace_string = self.ref_replace(nr, fs, rep)
                 if replace_string != fs:
-                    debug(f"In {globf.relative_to(self.tmpDir).as_posix()}, {nr} --> {rep}")
+                    debug(f"In {member}, {nr} --> {rep}")
                     try:
                         _ = json.loads(replace_string)
                     except (UnicodeDecodeError, json.decoder.JSONDecodeError) as e:
                         error(f"While rerefing, something went wrong as we are trying to write non json content\n{e}")
                         critical(replace_string)
-                    with open(globf, "w") as f:
-                        f.write(replace_string)
-                    debug(f"!! Rewrote {globf.relative_to(self.tmpDir)}")
+                    fs = replace_string
+            if fs != orig_fs:
+                replace[member] = fs.encode('utf-8')
+                debug(f"!! Rewrote {member}")
+        return replace
 
     def ref_replace(self, nr, fs, rep):
         replace_string = fs.replace(f"\"SELF:/{nr}\"", f"\"{rep}\"").replace(f"\"/{nr}\"", f"\"{rep}\"")
         return replace_string
 
-    def delete_files(self, newref):
-        tdir = self.tmpDir
+    def delete_files(self, newref) -> list:
+        """
+        Returns members to erase
+        """
+        members = set(self.namelist())
+        delete = []
         for nr in newref:
-            file = tdir / nr
-            debug(f"!! Erased {file.relative_to(self.tmpDir)}")
-            try:
-                os.unlink(file)
-            except FileNotFoundError:
-                warn(f"File {file} not found in var {self.var}. Database is not up to date?")
-
-    def write_meta(self, tdir, mdict: dict):
-        with open(tdir / "meta.json", 'w') as f:
-            f.write(prettyjson(mdict))
+            if nr in members:
+                debug(f"!! Erased {nr}")
+                delete.append(nr)
+            else:
+                warn(f"File {nr} not found in var {self.var}. Database is not up to date?")
+        return delete
 
-    def modify_meta(self, newref):
-        tdir = self.tmpDir
+    def modify_meta(self, newref) -> bytes:
         meta = self.meta()
         for nref in newref:
             newvar = newref[nref]['newvar']
@@ -751,8 +599,8 @@ class Var(VarFile):
                 # The exact file was not mentionned in the contentList
                 pass
 
-        self.write_meta(tdir, meta)
         debug("Modified meta")
+        return prettyjson(meta).encode('utf-8')
 
     def get_new_ref(self, dup) -> dict:
         # Todo propose .latest in choices
@@ -809,9 +657,9 @@ class Var(VarFile):
             new_ref = ensure_binaryfiles(new_ref, ftype)
 
         for file in self.files():
-            pre = file.path.relative_to(self.tmpDir).as_posix()
-            if file in new_ref:
-                debug(f"{ pre } : { green(new_ref[file]['newvar']) }{ green(':/') }{ green(new_ref[file]['newfile']) }")
+            pre = self.ziprel(file.path)
+            if pre in new_ref:
+                debug(f"{ pre } : { green(new_ref[pre]['newvar']) }{ green(':/') }{ green(new_ref[pre]['newfile']) }")
             else:
                 debug(f"{ red(pre) } {red(':')} { red('NO REFERENCE') }")
         return new_ref
@@ -854,25 +702,23 @@ class Var(VarFile):
             info("Asked for dryrun, stopping here")
             return
 
-        self.modify_meta(new_ref)
-        self.reref_files(new_ref)
-        self.delete_files(new_ref)
-        try:
-            del_empty_dirs(self.tmpDir)
-        except:
-            pass
+        replace = self.reref_files(new_ref)
+        replace['meta.json'] = self.modify_meta(new_ref)
+        delete = self.delete_files(new_ref)
         # TODO remove any leaf element not having anything referencing them
 
+        orig = self.path.with_suffix('.orig')
         try:
             if self.path.is_symlink():
                 # if source is a link, don't rename but copy..
-                shutil.copy2(self.path, f"{self.path.with_suffix('.orig')}")
+                shutil.copy2(self.path, f"{orig}")
             else:
-                os.rename(self.path, f"{self.path.with_suffix('.orig')}")
+                os.rename(self.path, f"{orig}")
         except Exception as e:
             critical(f"We could not backup {self.path} to .orig, refusing to proceed for safety {e}")
 
-        zipdir(self.tmpDir, self.path)
+        # Untouched members are copied without recompression
+        zip_rewrite(orig, self.path, replace=replace, delete=delete, comment=f"Repacked on {datetime.now().strftime('%Y%m%dT%H%M%S')}".encode('ascii'))
         res = ZipFile(self.path).testzip()
         if res != None:
             critical(f"Warning, reconstructed zip {self.path} has CRC problem on file {res}.")
@@ -881,182 +727,45 @@ class Var(VarFile):
         self.store_update(confirm=False)
         print(green(f"Updated DB for {self.var}"))
 
-    @unzip
-    def get_thumbs(self)->str:
+    def get_thumbs(self) -> list:
+        """
+        Members which are thumbnails of files in Custom or of jsons at the root, found in the zip listing
+        """
+        names = set(self.namelist())
         thumbs = []
-        custom_bin = search_files_indir(self.tmpDir / "Custom", ".*\.vap", ign=True) + search_files_indir(self.tmpDir / "Custom", ".*\.vaj", ign=True)
-        custom_asset = search_files_indir(self.tmpDir / "Custom", ".*\.assetbundle", ign=True)
-        custom_asset_2 = search_files_indir(self.tmpDir / "Custom", ".*\.scene", ign=True)
-        old_json = search_files_indir(self.tmpDir, ".*\.json", ign=True)
-        for v in custom_bin + custom_asset + custom_asset_2 + old_json:
-            if v.with_suffix(".jpg").exists():
-                thumbs.append(v.with_suffix(".jpg"))
-        return [ str(e) for e in list(set(thumbs)) ]
-
-    @unzip
+        for name in names:
+            path = PurePosixPath(name)
+            parent = path.parent.as_posix().lower()
+            if (parent == "custom" and path.suffix.lower() in (".vap", ".vaj", ".assetbundle", ".scene")) or (parent == "." and path.suffix.lower() == ".json"):
+                thumb = path.with_suffix(".jpg").as_posix()
+                if thumb in names:
+                    thumbs.append(thumb)
+        return sorted(set(thumbs))
+
+    def get_scene_thumbs(self) -> list:
+        """
+        Members which are thumbnails of scenes
+        """
+        return sorted(name for name in self.namelist() if PurePosixPath(name).parent.as_posix().lower() == "saves/scene" and name.lower().endswith(".jpg"))
+
     def get_resources_type(self):
         types = []
-        if search_files_indir(self.tmpDir / "Saves" / "scene", ".*\.jpg", ign=True):
+        # Same as listing files directly in these directories
+        def has(dir, suffix):
+            return any(Path(name).parent.as_posix().lower() == dir.lower() and name.lower().endswith(suffix) for name in names)
+        names = self.namelist()
+        if has("Saves/scene", ".jpg"):
             types.append("scene")
-        if search_files_indir(self.tmpDir / "Custom" / "Clothing", ".*\.vaj", ign=True):
+        if has("Custom/Clothing", ".vaj"):
             types.append("clothes")
-        if search_files_indir(self.tmpDir / "Custom" / "Hair", ".*\.vaj", ign=True):
+        if has("Custom/Hair", ".vaj"):
             types.append("hairs")
-        if search_files_indir(self.tmpDir / "Custom" / "Assets", ".*\.assetbundle", ign=True):
+        if has("Custom/Assets", ".assetbundle"):
             types.append("asset")
-        if search_files_indir(self.tmpDir / "Custom" / "Assets", ".*\.scene", ign=True):
+        if has("Custom/Assets", ".scene"):
             types.append("asset")
         return types
 
-    def ia_upload(self, confirm = True, meta_only = False, verbose = False, dry_run = False, full_thumbs = False, only_cc = False, iaprefix=None):
-
-        info(f"Uploading {self.var} [size {toh(self.size)}] to IA")
-        if self.is_uploaded_on_ia:
-            info(f"{self.var} already on IA, not uploading")
-            return
-
-        title = self.var
-        creator = self.creator
-        license_url = get_license_url(self.license)
-        if not license_url and only_cc:
-            info('License is not CC')
-            return False
-        #
-        print(f"Uploading {self}, {int(self.size/1000)/1000}MB")
-        choice = False
-        mchoice = "N"
-        if choice:
-            mchoice = input("Confirm [Y]ND ?").upper()
-            if mchoice == "N":
-                error("Cancelled")
-                return
-            elif mchoice == "D":
-                error("Will not ask anymore")
-                self.ia_set_uploaded()
-                return
-
-        types = self.get_resources_type()
-        identifier = ia_identifier(self.varq, iaprefix or IA_IDENTIFIER_PREFIX)
-
-        if not self.exists():
-            critical(f"Var {self.var} is not in the database. Can't upload to IA.")
-            return False
-
-        if not meta_only and self.latest() != self.var:
-            info(f"Not uploading {self.var}, there is a higher version {self.latest()}")
-            self.ia_set_uploaded()
-            return False
-
-        if not license_url:
-            warn(f"License is {self.license}, no URL.")
-
-        thumbs = self.get_thumbs()
-        if not thumbs:
-            warn(f"No thumbs, not uploading.")
-            # Comment this for uploading images not linked to jsons for example
-            return False
-
-        debug(f"var {self.var} contains: {types}")
-        subjects = ['scene'] if "scene" in types else types
-        subjects.extend(IA_BASETAGS)
-
-        description = f"<div><i>{self.varq}</i></div><br />"
-        f"<div><br />By {creator}<br /></div>"
-        f"<div><br />{self.meta()['description']}<br /></div>"
-        f"<div><br /> <a href=\"{self.meta()['promotionalLink']}\">{creator}</a> <br /></div>"
-
-        md = {
-            'title': title,
-            'mediatype' : IA_MEDIATYPE,
-            'collection': IA_COLL,
-            'date': time.strftime("%Y-%m-%d", time.gmtime(self.mtime)),
-            'description': description,
-            'subject': subjects,
-            'creator': creator,
-            'licenseurl': license_url
-        }
-
-        iavar = get_item(identifier)
-        
-        # Meta only: no overwrite confirmation
-        if not meta_only and confirm and (iavar.exists or not iavar.identifier_available()):
-            self.ia_set_uploaded()
-            if input(f"Item {self.var} exists, update if different Y [N] ? ").upper() != "Y":
-                self.ia_set_uploaded()
-                return False
-        if meta_only:
-            if iavar.exists:
-                debug(f"Modifying metadata for {identifier}")
-                # Clear subject
-                if dry_run:
-                    return True
-                else :
-                    res = iavar.modify_metadata(metadata = { "subject": "REMOVE_TAG" })
-                    if res:
-                        info("Subject and topics cleared")
-                    else:
-                        warn(f"Subject was not changed: {res.content}")
-                    res = iavar.modify_metadata(metadata = { "subject": subjects }, append=True)
-                    if res:
-                        info(f"Subject and topics set to {subjects}")
-                    else:
-                        error(f"Subject was not set: {res.content}")
-                    return res.status_code == 200 if not dry_run else True
-            else:
-                warn("Item does not exists on IA, can't update metadata")
-                return False
-        else:
-            scene_thumbs = search_files_indir(self.tmpDir / "Saves" / "scene", ".*\.jpg", ign=True)
-
-            if full_thumbs or not scene_thumbs:
-                files = thumbs
-            else:
-                files = []
-
-            files.append(str(self.path))
-
-
-            # Remove scene thumbs from files
-            scene_thumbs_fn = [ str(e) for e in scene_thumbs ]
-            files = [ e for e in files if e not in scene_thumbs_fn ]
-
-            ok_s = True
-            if scene_thumbs:
-                scene_files = { "00-" + e.name:str(e) for e in scene_thumbs }
-                if dry_run:
-                    print(f"Would upload:\n{CR.join([Path(a).as_posix() for a in scene_files])}")
-                    ok_s = False
-                else:
-                    res_s = iavar.upload(
-                        validate_identifier=True,
-                        checksum=True,
-                        verify=True,
-                        files = scene_files,
-                        metadata=md,
-                        verbose=verbose)
-                    debug(res_s)
-                    ok_s = all(resp.status_code == 200 or resp.status_code == None for resp in res_s)
-
-            if not dry_run:
-                res = iavar.upload(
-                    validate_identifier=True,
-                    checksum=True,
-                    verify=True,
-                    files = files,
-                    metadata=md,
-                    verbose=verbose)
-                debug(res)
-            else:
-                print(f"Would upload:\n{CR.join([Path(a).as_posix() for a in files])}")
-                return False
-            # Upload will return empty Response() when checksum match. BAD
-            if ok_s and all(resp.status_code == 200 or resp.status_code == None for resp in res):
-                print(f"Var file url is https://archive.org/download/{ia_identifier(self.var)}/{self.file}")
-                self.ia_set_uploaded()
-                return True
-            else:
-                return False
-
     def anon_upload(self, apikey, dry_run = False):
         info(f"Uploading {self.var} [size {toh(self.size)}] to Anonfiles")
         if self.is_uploaded_on_anon:
@@ -1068,6 +777,7 @@ class Var(VarFile):
             print(f"Would upload\n{self.path}")
             return False
         else:
+            import requests
             r =  requests.post(url, files={'file': open(self.path, 'rb')})
             j = r.json()
             if r.status_code == 200:
@@ -1094,36 +804,3 @@ class Var(VarFile):
         res = sorted([ e[0] for e in res ], key = lambda s: s.casefold())
         return res
 
-    def rec_dep(self, stop = True, dir=None, func = None):
-        def rec(var:Var, depth=0):
-            msg = ">" * (depth+1) + f" {var.var}"
-            if not var.exists():
-                warn(f"{msg:<130}" + ": Not Found")
-                if stop:
-                    raise VarNotFound(var.var)
-                return
-            else:
-                info(f"{msg:<130}" + ":     Found")
-            res = var.get_dep()
-            info(f"Found {len(res) if len(res) else 'no'} dependencies for {var.var}{', searching their own dependencies' if len(res) else ''}")
-            for varfile in res:
-                try:
-                    if dir == None:
-                        depvar = VarFile(varfile, use_db=True)                        
-                    else:
-                        try:
-                            depvar = Var(varfile, dir=dir, use_db=True)
-                        except VarNotFound as e:
-                            if stop:
-                                raise VarNotFound(varfile.var)
-                            else:
-                                error(f"Var {varfile} not found")
-                                continue
-                    if func:
-                        func(depvar)
-                except (VarExtNotCorrect, VarNameNotCorrect, VarVersionNotCorrect):
-                    error(f"We skipped a broken dependency from {self.var}")
-                    continue
-                rec(depvar, depth+1 )
-        rec(self)
-
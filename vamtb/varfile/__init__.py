@@ -2,7 +2,7 @@
 from pathlib import Path
 
 from vamtb.db import Dbs
-from vamtb.file import FileName
+from vamtb.file import FileName, ZipFileName
 
 from vamtb.vamex import *
 from vamtb.utils import *
@@ -39,7 +39,7 @@ class VarFile:
                 if self.__sVersion == "latest":
                     mlatest = self.latest()
                     if mlatest:
-                        self.__iVersion = self.latest().split('.',3)[2]
+                        self.__iVersion = mlatest.split('.',3)[2]
                 elif self.__sVersion.startswith('min'):
                     try:
                         self.__iMinVer = int(self.__sVersion[3:])
@@ -128,17 +128,35 @@ class VarFile:
         else:
             assert(False)
 
+    def db_execmany(self, sql, rows):
+        if self.__Dbs:
+            self.__Dbs.executemany(sql, rows)
+        else:
+            assert(False)
+
+    def db_transaction(self):
+        if self.__Dbs:
+            return self.__Dbs.var_transaction()
+        else:
+            assert(False)
+
     def db_commit(self, rollback = False):
         if self.__Dbs:
             if rollback:
-                self.__Dbs.getConn().rollback()
+                self.__Dbs.rollback()
             else:
                 self.__Dbs.getConn().commit()
         else:
             assert(False)
 
-    def _store_var(self) -> None:
-        """ Insert (if NE) or update (if Time>) or do nothing (if Time=) """
+    def db_versions(self):
+        if self.__Dbs:
+            return self.__Dbs.versions()
+        else:
+            assert(False)
+
+    def _var_rows(self) -> dict:
+        """ Compute VARS, FILES and DEPS rows of the var without touching the database """
         creator, version, modified_time, cksum = (self.creator, self.version, self.mtime, self.crc)
         size = FileName(self.path).size
         # Will force var files (but not creator) to be ISREF
@@ -148,37 +166,57 @@ class VarFile:
         meta = self.meta()
         license = meta['licenseType']
 
-        sql = """INSERT INTO VARS(VARNAME,ISREF,CREATOR,VERSION,LICENSE,MODIFICATION_TIME,SIZE,CKSUM) VALUES (?,?,?,?,?,?,?,?)"""
-        row = (self.var, v_isref, creator, version, license, modified_time, size, cksum)
-        self.db_exec(sql, row)
-
-        sql = """INSERT INTO UPLOAD(VARNAME, IA, ANON) VALUES (?,?,?)"""
-        row = (self.var, "NO", "NO")
-        self.db_exec(sql, row)
+        rows = { 'vars': (self.var, v_isref, creator, version, license, modified_time, size, cksum), 'files': [], 'deps': [], 'memberrefs': [] }
 
+        # Checksum of json files also extracts their references, keep them for dependencies
+        content_files = []
         for f in self.files(with_meta=True):
             crcf = f.crc
             sizef = f.size
+            if f.path.name != "meta.json":
+                content_files.append(f)
+                if isinstance(f, ZipFileName) and f.is_json:
+                    try:
+                        rows['memberrefs'].append((f.zipcrc, sizef, f.jsonDeps['var']))
+                    except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+                        pass
             if creator in C_REF_CREATORS or force_isref:
                 f_isref = "YES"
             else:
                 f_isref = "UNKNOWN"
+            rows['files'].append((None, self.ziprel(f.path), f_isref, self.varq, sizef, crcf))
+
+        for dep in self.dep_fromfiles(with_file=True, files=content_files):
+            depvar, depfile = dep.split(':')
+            depfile = depfile.lstrip('/')
+            rows['deps'].append((None, self.var, depvar, depfile))
+        return rows
+
+    def _store_rows(self, rows: dict) -> None:
+        """ Insert rows computed by _var_rows, caller handles the transaction """
+        sql = """INSERT INTO VARS(VARNAME,ISREF,CREATOR,VERSION,LICENSE,MODIFICATION_TIME,SIZE,CKSUM) VALUES (?,?,?,?,?,?,?,?)"""
+        self.db_exec(sql, rows['vars'])
+        self.db_versions().add(self.var)
+
+        sql = """INSERT INTO UPLOAD(VARNAME, IA, ANON) VALUES (?,?,?)"""
+        row = (self.var, "NO", "NO")
+        self.db_exec(sql, row)
 
-            sql = """INSERT INTO FILES (ID,FILENAME,ISREF,VARNAME,SIZE,CKSUM) VALUES (?,?,?,?,?,?)"""
-            row = (None, self.ziprel(f.path), f_isref, self.varq, sizef, crcf)
-            self.db_exec(sql, row)
+        sql = """INSERT INTO FILES (ID,FILENAME,ISREF,VARNAME,SIZE,CKSUM) VALUES (?,?,?,?,?,?)"""
+        self.db_execmany(sql, rows['files'])
 
         debug(f"Stored var {self.var} and files in databases")
         sql = """INSERT INTO DEPS(ID,VAR,DEPVAR,DEPFILE) VALUES (?,?,?,?)"""
-        for dep in self.dep_fromfiles(with_file=True):
-            depvar, depfile = dep.split(':')
-            depfile = depfile.lstrip('/')
-            row = (None, self.var, depvar, depfile)
-            self.db_exec(sql, row)
+        self.db_execmany(sql, rows['deps'])
+        Dbs.store_member_refs(rows['memberrefs'])
 
-        self.db_commit()
         info(f"Stored var {self.var} in DB")
 
+    def _store_var(self) -> None:
+        """ Insert (if NE) or update (if Time>) or do nothing (if Time=) """
+        with self.db_transaction():
+            self._store_rows(self._var_rows())
+
     def exists(self):
         if self.var.endswith(".latest"):
             return (self.latest() != None)
@@ -189,29 +227,19 @@ class VarFile:
 
     def latest(self):
         # assert(self.var.endswith(".latest"))
-        sql="SELECT VARNAME FROM VARS WHERE VARNAME LIKE ? COLLATE NOCASE"
         var_nov = self.var_nov
-        row = (f"{var_nov}%", )
-        res = self.db_fetch(sql, row)
-        versions = [ e[0].split('.',3)[2] for e in res ]
-        versions.sort(key=int, reverse=True)
-        if versions:
-            return f"{var_nov}.{versions[0]}"
+        version = self.db_versions().latest(var_nov)
+        if version is not None:
+            return f"{var_nov}.{version}"
         else:
             return None
 
     def min(self):
         assert(self.version.startswith("min"))
-        minver = self.minversion
-        sql="SELECT VARNAME FROM VARS WHERE VARNAME LIKE ? COLLATE NOCASE"
         var_nov = self.var_nov
-        row = (f"{var_nov}%", )
-        res = self.db_fetch(sql, row)
-        versions = [ e[0].split('.',3)[2] for e in res ]
-        versions = [ int(v) for v in versions if int(v) >= minver ]
-        versions.sort(key=int, reverse=True)
-        if versions:
-            return f"{var_nov}.{versions[0]}"
+        version = self.db_versions().min(var_nov, self.minversion)
+        if version is not None:
+            return f"{var_nov}.{version}"
         else:
             return None
 
@@ -274,6 +302,7 @@ class VarFile:
         self.db_exec(sql, row)
         sql = f"DELETE FROM UPLOAD WHERE VARNAME=?"
         self.db_exec(sql, row)
+        self.db_versions().remove(self.var)
 
     def db_var_setref(self, isref, files=False):
         self.db_update("VARS", {"VARNAME": self.var}, {"ISREF": "YES" if isref else "UNKNOWN"})